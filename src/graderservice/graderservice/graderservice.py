@@ -6,6 +6,7 @@ from datetime import datetime
 from os import path
 from pathlib import Path
 from secrets import token_hex
+from urllib.parse import urlencode
 
 from kubernetes import client
 from kubernetes import config
@@ -59,6 +60,23 @@ nbgrader_db_password = os.environ.get("POSTGRES_NBGRADER_PASSWORD")
 nbgrader_db_user = os.environ.get("POSTGRES_NBGRADER_USER")
 nbgrader_db_port = os.environ.get("POSTGRES_NBGRADER_PORT")
 nbgrader_db_name = os.environ.get("POSTGRES_NBGRADER_DB_NAME")
+# storage of the course gradebooks, with the same values used by the hub: "database" (a
+# database per course) or "schema" (a schema per course within the shared database)
+NBGRADER_DB_STORAGE = (os.environ.get("NBGRADER_DB_STORAGE") or "database").lower()
+NBGRADER_DB_SHARED_DATABASE = os.environ.get("NBGRADER_DB_SHARED_DATABASE")
+
+
+def nbgrader_format_db_url(org_name: str, course_id: str) -> str:
+    """
+    Returns the url of the course gradebook used by the hub: the course database or, when
+    the courses are stored as schemas, the course schema of the shared database.
+    """
+    server_url = f"postgresql://{nbgrader_db_user}:{nbgrader_db_password}@{nbgrader_db_host}:{nbgrader_db_port or 5432}"
+    if NBGRADER_DB_STORAGE == "schema":
+        database_name = NBGRADER_DB_SHARED_DATABASE or f"{org_name}_nbgrader"
+        options = urlencode({"options": f"-csearch_path={course_id}"})
+        return f"{server_url}/{database_name}?{options}"
+    return f"{server_url}/{org_name}_{course_id}"
 
 
 class GraderServiceLauncher:
@@ -184,7 +202,7 @@ class GraderServiceLauncher:
         grader_home_nbconfig_content = NBGRADER_HOME_CONFIG_TEMPLATE.format(
             grader_name=self.grader_name,
             course_id=self.course_id,
-            db_url=f"postgresql://{nbgrader_db_user}:{nbgrader_db_password}@{nbgrader_db_host}:5432/{self.org_name}_{self.course_id}",
+            db_url=nbgrader_format_db_url(self.org_name, self.course_id),
         )
         grader_nbconfig_path.write_text(grader_home_nbconfig_content)
         # Write the nbgrader_config.py file at grader home directory
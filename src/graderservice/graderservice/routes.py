@@ -6,6 +6,7 @@ from pathlib import Path
 
 from flask import Blueprint
 from flask import jsonify
+from flask import request
 
 from .graderservice import NB_GID
 from .graderservice import NB_UID
@@ -176,7 +177,35 @@ def assignment_dir_creation(org_name: str, course_id: str, assignment_name: str)
     Returns:
         JSON: True if the assignment directories were successfully created, false otherwise
     """
+    if not _is_valid_assignment_name(assignment_name):
+        return jsonify(success=False, error="Invalid assignment name"), 400
     launcher = GraderServiceLauncher(org_name=org_name, course_id=course_id)
+    assignment_dir = _create_assignment_source_dir(launcher, assignment_name)
+    return jsonify(
+        success=True,
+        message=f"Created new assignment directory: {assignment_dir}",
+    )
+
+
+def _is_valid_assignment_name(assignment_name: str) -> bool:
+    """Returns True if the assignment name is a single path component, so its source
+    directory is created within the course's source directory.
+    """
+    return (
+        isinstance(assignment_name, str)
+        and assignment_name not in ("", ".", "..")
+        and "/" not in assignment_name
+    )
+
+
+def _create_assignment_source_dir(
+    launcher: GraderServiceLauncher, assignment_name: str
+) -> str:
+    """Creates the source directory of an assignment owned by the grader user.
+
+    Returns:
+        The assignment source directory
+    """
     assignment_dir = os.path.abspath(
         Path(launcher.course_dir, "source", assignment_name)
     )
@@ -199,9 +228,34 @@ def assignment_dir_creation(org_name: str, course_id: str, assignment_name: str)
     except Exception as e:
         logger.error(f"Exception when updating assignment directory permissions: {e}")
     logger.info("Creating new assignment directory %s OK" % assignment_dir)
+    return assignment_dir
+
+
+@grader_setup_bp.route("/courses/<org_name>/<course_id>", methods=["POST"])
+def assignment_dirs_creation(org_name: str, course_id: str):
+    """Creates the directories required to manage several assignments, with their names
+    in the "assignments" list of the JSON body.
+
+    Args:
+        org_name: the organization name
+        course_id: the course id (label)
+
+    Returns:
+        JSON: True if the assignment directories were successfully created, false otherwise
+    """
+    assignment_names = (request.get_json(silent=True) or {}).get("assignments")
+    if not isinstance(assignment_names, list) or not all(
+        _is_valid_assignment_name(name) for name in assignment_names
+    ):
+        return jsonify(success=False, error="Invalid assignments"), 400
+    launcher = GraderServiceLauncher(org_name=org_name, course_id=course_id)
+    assignment_dirs = [
+        _create_assignment_source_dir(launcher, assignment_name)
+        for assignment_name in assignment_names
+    ]
     return jsonify(
         success=True,
-        message=f"Created new assignment directory: {assignment_dir}",
+        message=f"Created {len(assignment_dirs)} assignment directories",
     )
 
 
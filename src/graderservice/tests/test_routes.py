@@ -25,3 +25,11 @@ def test_get_groups_from_services_endpoint(client):
         json_data = resp.get_json()
         assert json_data["groups"]["formgrade-intro101"] == ["grader-intro101"]
         assert resp.status_code == 200
+
+
+def test_assignments_endpoint_rejects_names_outside_the_source_dir(client):
+    """Ensure the assignment names that resolve outside the course source directory are rejected."""
+    with client as c:
+        for name in ("..", ".", "lab1/../..", ""):
+            resp = c.post("/courses/my-org/intro101", json={"assignments": [name]})
+            assert resp.status_code == 400
@@ -0,0 +1,100 @@
+"""
+Benchmark of the bulk gradebook upserts.
+
+Writes a roster and the assignments of a semester to a course gradebook with a gradebook
+session and commit per row (add_user_to_nbgrader_gradebook and register_assignment) and
+with the bulk upserts (bulk_upsert_students and bulk_upsert_assignments), then writes
+them again to measure the updates. The report shows the rows written per second.
+
+The gradebook is a SQLite file by default, set BENCH_GRADEBOOK_URL to the url of an
+empty local postgres database (the database is cleared) to measure INSERT ... ON CONFLICT.
+
+Usage:
+    python3 -m pip install -e .
+    python3 benchmarks/bench_gradebook_upsert.py [students] [assignments] [chunk_size]
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+from nbgrader.api import Base
+from sqlalchemy import create_engine
+
+from illumidesk.apis.nbgrader_service import NbGraderServiceHelper
+from illumidesk.apis.nbgrader_service import get_gradebook_engine_registry
+
+
+def reset(db_url):
+    get_gradebook_engine_registry().dispose()
+    engine = create_engine(db_url)
+    Base.metadata.drop_all(bind=engine)
+    engine.execute("DROP TABLE IF EXISTS alembic_version")
+    engine.dispose()
+
+
+def measure(func, rows):
+    start = time.perf_counter()
+    func()
+    return rows / (time.perf_counter() - start)
+
+
+def main():
+    students = int(sys.argv[1]) if len(sys.argv) > 1 else 3000
+    assignments = int(sys.argv[2]) if len(sys.argv) > 2 else 60
+    chunk_size = int(sys.argv[3]) if len(sys.argv) > 3 else 500
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_url = (
+            os.environ.get("BENCH_GRADEBOOK_URL") or f"sqlite:///{tmp_dir}/bench.db"
+        )
+        helper = NbGraderServiceHelper("bench101")
+        helper.db_url = db_url
+        roster = [
+            {"username": f"student{i}", "lms_user_id": f"user-{i}"}
+            for i in range(students)
+        ]
+        semester = [
+            {"name": f"lab{i}", "duedate": "2021-05-31 23:59:00 UTC"}
+            for i in range(assignments)
+        ]
+
+        def per_row_students():
+            for student in roster:
+                helper.add_user_to_nbgrader_gradebook(
+                    student["username"], student["lms_user_id"]
+                )
+
+        def per_row_assignments():
+            for assignment in semester:
+                helper.register_assignment(
+                    assignment["name"], duedate=assignment["duedate"]
+                )
+
+        def bulk_students():
+            helper.bulk_upsert_students(iter(roster), chunk_size=chunk_size)
+
+        def bulk_assignments():
+            helper.bulk_upsert_assignments(iter(semester), chunk_size=chunk_size)
+
+        print(f"gradebook={db_url.split(':')[0]} chunk_size={chunk_size}")
+        for name, rows, per_row, bulk in (
+            ("students", students, per_row_students, bulk_students),
+            ("assignments", assignments, per_row_assignments, bulk_assignments),
+        ):
+            results = {}
+            for label, func in (("per row", per_row), ("bulk", bulk)):
+                reset(db_url)
+                results[label] = (measure(func, rows), measure(func, rows))
+            for i, phase in enumerate(("insert", "update")):
+                before = results["per row"][i]
+                after = results["bulk"][i]
+                print(
+                    f"{name:11s} {phase}: per row {before:10.1f} rows/s  "
+                    f"bulk {after:10.1f} rows/s  ({after / before:.1f}x)"
+                )
+        reset(db_url)
+
+
+if __name__ == "__main__":
+    main()
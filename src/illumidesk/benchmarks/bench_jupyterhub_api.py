@@ -0,0 +1,126 @@
+"""
+Benchmark of the JupyterHubAPI client against a local stand-in for the hub api.
+
+The stand-in serves the group and user endpoints used by the course setup with a fixed
+latency and fails a fraction of the requests with a 503, like a hub under load. The
+report shows the throughput and latency of the requests sent with a client per call (as
+the authenticator did before) and with the shared client, the peak number of concurrent
+requests seen by the hub and the retry budget left.
+
+Usage:
+    python3 -m pip install -e .
+    python3 benchmarks/bench_jupyterhub_api.py [requests] [concurrency] [error_rate] [curl]
+"""
+
+import asyncio
+import logging
+import os
+import random
+import statistics
+import sys
+import time
+
+from tornado.httpclient import HTTPClientError
+from tornado.httpserver import HTTPServer
+from tornado.netutil import bind_sockets
+from tornado.web import Application
+from tornado.web import RequestHandler
+
+LATENCY = 0.005
+
+logging.getLogger("tornado.access").disabled = True
+
+
+class StandInHandler(RequestHandler):
+    error_rate = 0.0
+    in_flight = 0
+    peak = 0
+
+    async def handle(self, *args):
+        cls = StandInHandler
+        cls.in_flight += 1
+        cls.peak = max(cls.peak, cls.in_flight)
+        try:
+            await asyncio.sleep(LATENCY)
+            if random.random() < self.error_rate:
+                self.set_status(503)
+                return self.finish()
+            self.finish({"name": "nbgrader-intro101", "users": ["student1"]})
+        finally:
+            cls.in_flight -= 1
+
+    get = handle
+    post = handle
+
+
+def start_stand_in(error_rate: float) -> int:
+    StandInHandler.error_rate = error_rate
+    sockets = bind_sockets(0, "127.0.0.1")
+    server = HTTPServer(Application([(r"/hub/api/(.*)", StandInHandler)]))
+    server.add_sockets(sockets)
+    return sockets[0].getsockname()[1]
+
+
+async def run(make_api, requests: int, concurrency: int):
+    latencies = []
+    errors = 0
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def call(i):
+        nonlocal errors
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                await make_api()._request(f"groups/nbgrader-course{i % 50}")
+            except (HTTPClientError, OSError):
+                errors += 1
+            latencies.append(time.perf_counter() - start)
+
+    StandInHandler.peak = 0
+    start = time.perf_counter()
+    await asyncio.gather(*[call(i) for i in range(requests)])
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return (
+        requests / elapsed,
+        statistics.median(latencies) * 1000,
+        latencies[int(len(latencies) * 0.99) - 1] * 1000,
+        errors,
+        StandInHandler.peak,
+    )
+
+
+async def main():
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    concurrency = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    error_rate = float(sys.argv[3]) if len(sys.argv) > 3 else 0.05
+    use_curl = len(sys.argv) > 4 and sys.argv[4] == "curl"
+
+    port = start_stand_in(error_rate)
+    os.environ["JUPYTERHUB_API_TOKEN"] = "bench"
+    os.environ["JUPYTERHUB_API_URL"] = f"http://127.0.0.1:{port}/hub/api"
+
+    from illumidesk.apis.jupyterhub_api import JupyterHubAPI
+
+    print(
+        f"requests={requests} concurrency={concurrency} error_rate={error_rate} "
+        f"latency={LATENCY * 1000:.0f}ms curl={use_curl}"
+    )
+    per_call = await run(
+        lambda: JupyterHubAPI(max_retries=0, use_curl=use_curl), requests, concurrency
+    )
+    shared_api = JupyterHubAPI(use_curl=use_curl)
+    shared = await run(lambda: shared_api, requests, concurrency)
+    for name, (throughput, p50, p99, errors, peak) in (
+        ("client per call", per_call),
+        ("shared client", shared),
+    ):
+        print(
+            f"{name:16s}: {throughput:8.1f} req/s p50={p50:7.2f}ms p99={p99:7.2f}ms "
+            f"errors={errors} hub_concurrency={peak}"
+        )
+    print(f"retry budget left: {shared_api.retry_budget.tokens:.1f} tokens")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,87 @@
+"""
+Micro-benchmark of the tool's key handling: serving the JWKS and signing the client
+assertions sent to the LMS token endpoint.
+
+Compares the previous code, which read and parsed the LTI13_PRIVATE_KEY pem file with
+every JWKS request and every signed assertion, with the KeyStore, which parses the keys
+once and only checks the file for changes.
+
+Usage:
+    python3 -m pip install -e .
+    python3 benchmarks/bench_key_store.py [iterations]
+"""
+
+import os
+import sys
+import tempfile
+import time
+import uuid
+
+import jwt
+import pem
+from Crypto.PublicKey import RSA
+
+from illumidesk.lti13.auth import KeyStore
+from illumidesk.lti13.auth import get_jwk
+
+
+def legacy_jwks(key_path):
+    private_key = pem.parse_file(key_path)
+    public_key = RSA.import_key(private_key[0].as_text()).publickey().exportKey()
+    return {"keys": [get_jwk(public_key)]}
+
+
+def legacy_sign(key_path, payload):
+    # the previous code parsed the pem file and derived the kid with every assertion
+    private_key = pem.parse_file(key_path)[0].as_text()
+    public_key = RSA.import_key(private_key).publickey().exportKey()
+    headers = {"kid": get_jwk(public_key).get("kid")}
+    return jwt.encode(payload, private_key, algorithm="RS256", headers=headers).decode()
+
+
+def make_payload():
+    return {
+        "iss": "client-id",
+        "sub": "client-id",
+        "aud": "https://my.platform.domain/login/oauth2/token",
+        "iat": int(time.time()) - 5,
+        "exp": int(time.time()) + 60,
+        "jti": str(uuid.uuid4()),
+    }
+
+
+def measure(func, iterations):
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    return iterations / (time.perf_counter() - start)
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        key_path = os.path.join(tmp_dir, "private.key")
+        with open(key_path, "wb") as key_file:
+            key_file.write(RSA.generate(2048).exportKey("PEM"))
+        key_store = KeyStore(key_path)
+        assert legacy_jwks(key_path) == key_store.jwks
+
+        print(f"iterations={iterations}")
+        for name, legacy, current in (
+            ("jwks", lambda: legacy_jwks(key_path), lambda: key_store.jwks),
+            (
+                "sign assertion",
+                lambda: legacy_sign(key_path, make_payload()),
+                lambda: key_store.sign(make_payload()),
+            ),
+        ):
+            before = measure(legacy, iterations)
+            after = measure(current, iterations)
+            print(
+                f"{name:15s}: parse per call {before:10.1f} ops/s  "
+                f"key store {after:10.1f} ops/s  ({after / before:.1f}x)"
+            )
+
+
+if __name__ == "__main__":
+    main()
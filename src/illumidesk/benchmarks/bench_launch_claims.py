@@ -0,0 +1,150 @@
+"""
+Benchmark of the per-launch overhead of validating an LTI 1.3 launch request and
+extracting the values used by the authenticator.
+
+Compares the previous flow (global required claims, per-message-type required claims
+and the authenticator's chain of nested lookups) with the single pass done by
+LTI13LaunchValidator.parse_launch_request.
+
+Usage:
+    python3 -m pip install -e .
+    python3 benchmarks/bench_launch_claims.py [iterations]
+"""
+
+import sys
+import time
+
+from illumidesk.authenticators import constants
+from illumidesk.authenticators.claims import LTI13_LAUNCH_CLAIMS_SCHEMA
+from illumidesk.authenticators.utils import LTIUtils
+
+MESSAGE_TYPE = "https://purl.imsglobal.org/spec/lti/claim/message_type"
+
+LAUNCH_REQUEST = {
+    MESSAGE_TYPE: "LtiResourceLinkRequest",
+    "https://purl.imsglobal.org/spec/lti/claim/version": "1.3.0",
+    "https://purl.imsglobal.org/spec/lti/claim/resource_link": {
+        "id": "b81accac78543cb7cd239f3792bcfdc7c6efeadb",
+        "title": "Assignment 1",
+    },
+    "aud": "125900000000000071",
+    "azp": "125900000000000071",
+    "https://purl.imsglobal.org/spec/lti/claim/deployment_id": "847:b81accac78543",
+    "exp": 1589843421,
+    "iat": 1589839821,
+    "iss": "https://canvas.instructure.com",
+    "nonce": "125687018437687229621589839822",
+    "sub": "8171934b-f5e2-4f4e-bdbd-6d798615b93e",
+    "https://purl.imsglobal.org/spec/lti/claim/target_link_uri": "https://edu.example.com/hub",
+    "https://purl.imsglobal.org/spec/lti/claim/context": {
+        "id": "b81accac78543cb7cd239f3792bcfdc7c6efeadb",
+        "label": "intro101",
+        "title": "intro101",
+    },
+    "https://purl.imsglobal.org/spec/lti/claim/tool_platform": {"name": "IllumiDesk"},
+    "https://purl.imsglobal.org/spec/lti/claim/launch_presentation": {
+        "return_url": "https://illumidesk.instructure.com/courses/147/external_content",
+    },
+    "https://purl.imsglobal.org/spec/lti/claim/roles": [
+        "http://purl.imsglobal.org/vocab/lis/v2/institution/person#Student",
+        "http://purl.imsglobal.org/vocab/lis/v2/membership#Learner",
+        "http://purl.imsglobal.org/vocab/lis/v2/system/person#User",
+    ],
+    "https://purl.imsglobal.org/spec/lti/claim/custom": {"lms_user_id": "4"},
+    "email": "foo@example.com",
+}
+
+
+def legacy_validate_and_extract(jwt_decoded):  # noqa: C901
+    for claim in constants.LTI13_GENERAL_REQUIRED_CLAIMS:
+        if claim not in jwt_decoded:
+            raise ValueError(claim)
+    if jwt_decoded.get("https://purl.imsglobal.org/spec/lti/claim/version") != "1.3.0":
+        raise ValueError("version")
+    context_claim = jwt_decoded.get(
+        "https://purl.imsglobal.org/spec/lti/claim/context", None
+    )
+    context_label = (
+        jwt_decoded.get("https://purl.imsglobal.org/spec/lti/claim/context").get(
+            "label"
+        )
+        if context_claim
+        else None
+    )
+    if context_label == "":
+        raise ValueError("label")
+    message_type = jwt_decoded.get(MESSAGE_TYPE, None)
+    if (
+        message_type != constants.LTI13_RESOURCE_LINK_REQUIRED_CLAIMS[MESSAGE_TYPE]
+        and message_type != constants.LTI13_DEEP_LINKING_REQUIRED_CLAIMS[MESSAGE_TYPE]
+    ):
+        raise ValueError("message_type")
+    is_deep_linking = jwt_decoded.get(MESSAGE_TYPE, None) == "LtiDeepLinkingRequest"
+    required_claims_by_message_type = (
+        constants.ILLUMIDESK_LTI13_DEEP_LINKING_REQUIRED_CLAIMS
+        if is_deep_linking
+        else constants.ILLUMIDESK_LTI13_RESOURCE_LINK_REQUIRED_CLAIMS
+    )
+    for claim, v in required_claims_by_message_type.items():
+        if claim not in jwt_decoded:
+            raise ValueError(claim)
+    if not is_deep_linking:
+        if (
+            jwt_decoded.get(
+                "https://purl.imsglobal.org/spec/lti/claim/resource_link"
+            ).get("id")
+            == ""
+        ):
+            raise ValueError("resource_link")
+
+    course_id = jwt_decoded["https://purl.imsglobal.org/spec/lti/claim/context"][
+        "label"
+    ]
+    username = ""
+    if "email" in jwt_decoded and jwt_decoded["email"]:
+        username = LTIUtils().email_to_username(jwt_decoded["email"])
+    elif "name" in jwt_decoded and jwt_decoded["name"]:
+        username = jwt_decoded["name"]
+    user_role = "Learner"
+    for role in jwt_decoded["https://purl.imsglobal.org/spec/lti/claim/roles"]:
+        if role.find("Instructor") >= 1:
+            user_role = "Instructor"
+        elif role.find("Learner") >= 1 or role.find("Student") >= 1:
+            user_role = "Learner"
+    launch_return_url = ""
+    if (
+        "https://purl.imsglobal.org/spec/lti/claim/launch_presentation" in jwt_decoded
+        and "return_url"
+        in jwt_decoded["https://purl.imsglobal.org/spec/lti/claim/launch_presentation"]
+    ):
+        launch_return_url = jwt_decoded[
+            "https://purl.imsglobal.org/spec/lti/claim/launch_presentation"
+        ]["return_url"]
+    if not jwt_decoded.get(MESSAGE_TYPE, None) == "LtiDeepLinkingRequest":
+        resource_link = jwt_decoded[
+            "https://purl.imsglobal.org/spec/lti/claim/resource_link"
+        ]
+        _ = resource_link["title"] or ""
+    lms_user_id = jwt_decoded["sub"] if "sub" in jwt_decoded else username
+    return course_id, username, user_role, lms_user_id, launch_return_url
+
+
+def single_pass_parse(jwt_decoded):
+    return LTI13_LAUNCH_CLAIMS_SCHEMA.parse(jwt_decoded)
+
+
+def run(func, iterations):
+    start = time.process_time()
+    for _ in range(iterations):
+        func(LAUNCH_REQUEST)
+    return (time.process_time() - start) / iterations * 1e6
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    for func in (legacy_validate_and_extract, single_pass_parse):
+        print(f"{func.__name__:>28}: {run(func, iterations):8.2f} us/launch")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""
+Benchmark of the LTI 1.3 nonce stores at a sustained rate of launches per second.
+
+Launches are simulated with an increasing clock, so several hours of traffic run in a
+few seconds. The report shows the number of remembered nonces, the memory used by the
+in-memory store and the average cost of check_and_add for each simulated minute.
+
+Usage:
+    python3 -m pip install -e .
+    python3 benchmarks/bench_nonce_store.py [memory|sqlite] [minutes] [launches_per_second]
+"""
+
+import asyncio
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+
+from illumidesk.authenticators.nonce import MemoryNonceStore
+from illumidesk.authenticators.nonce import SQLiteNonceStore
+
+
+async def run():
+    backend = sys.argv[1] if len(sys.argv) > 1 else "memory"
+    minutes = int(sys.argv[2]) if len(sys.argv) > 2 else 30
+    rate = int(sys.argv[3]) if len(sys.argv) > 3 else 1000
+    ttl = 600
+
+    if backend == "sqlite":
+        path = os.path.join(tempfile.mkdtemp(), "nonces.db")
+        store = SQLiteNonceStore(path, ttl=ttl)
+    else:
+        tracemalloc.start()
+        store = MemoryNonceStore(ttl=ttl)
+
+    print(f"backend={backend} ttl={ttl}s rate={rate}/s")
+    clock = 0.0
+    for minute in range(minutes):
+        elapsed = 0.0
+        for _ in range(60 * rate):
+            clock += 1.0 / rate
+            nonce = uuid.uuid4().hex
+            start = time.perf_counter()
+            await store.check_and_add(nonce, now=clock)
+            elapsed += time.perf_counter() - start
+        if backend == "sqlite":
+            size = store._conn.execute("SELECT COUNT(*) FROM lti_nonces").fetchone()[0]
+            memory = os.path.getsize(path) / 2 ** 20
+        else:
+            size = len(store)
+            memory = tracemalloc.get_traced_memory()[0] / 2 ** 20
+        print(
+            f"minute {minute + 1:4d}: nonces={size:8d} memory={memory:7.1f}MiB "
+            f"check_and_add={elapsed / (60 * rate) * 1e6:6.2f}us"
+        )
+
+
+def main():
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main()
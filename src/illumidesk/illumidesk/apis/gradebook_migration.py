@@ -0,0 +1,221 @@
+"""
+Moves the course gradebooks stored as a database per course into schemas of the shared
+gradebook database, used with NBGRADER_DB_STORAGE=schema.
+
+Course databases are copied table by table into a schema named after the course, the row
+counts of the source and the schema are compared and, with --drop, the course database is dropped. Courses with a
+schema that already has the gradebook tables are skipped, so the migration can be run
+again after a failure. Set NBGRADER_DB_STORAGE=schema once the courses were migrated,
+and create the grader services again so their nbgrader config uses the schemas.
+
+The migration requires downtime: stop the hub and the grader services before running it,
+since the gradebook writes made after a course was copied are not moved to its schema and
+are lost when the course database is dropped with --drop.
+
+Usage (with the env vars used by the hub):
+    python3 -m illumidesk.apis.gradebook_migration [--jobs N] [--drop] [course_id ...]
+"""
+
+import argparse
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+
+from nbgrader import dbutil
+from nbgrader.api import Base
+from sqlalchemy import create_engine
+from sqlalchemy import func
+from sqlalchemy import select
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import NullPool
+
+from illumidesk.apis.nbgrader_service import NBGRADER_DB_SHARED_DATABASE
+from illumidesk.apis.nbgrader_service import NBGRADER_DB_TEMPLATE
+from illumidesk.apis.nbgrader_service import GradebookDatabaseCatalog
+from illumidesk.apis.nbgrader_service import GradebookSchemaCatalog
+from illumidesk.apis.nbgrader_service import get_database_schema_version
+from illumidesk.apis.nbgrader_service import get_schema_version
+from illumidesk.apis.nbgrader_service import nbgrader_format_database_url
+from illumidesk.apis.nbgrader_service import nbgrader_format_schema_url
+from illumidesk.apis.nbgrader_service import org_name
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+# rows read and written at a time
+CHUNK_SIZE = 1000
+
+
+class CourseMigrationResult(NamedTuple):
+    """
+    The result of moving a course database: the rows copied per table, or the error.
+    """
+
+    course_id: str
+    rows: Dict[str, int]
+    skipped: bool = False
+    error: Optional[str] = None
+
+
+def copy_gradebook(source: Engine, target: Engine) -> Dict[str, int]:
+    """
+    Copies the gradebook tables of a database into another one, with a single transaction
+    in the target. The tables are copied in dependency order, from a single snapshot of the
+    source, and the rows of each table are counted in the source and in the target.
+
+    Args:
+      source: engine of the course database
+      target: engine of the course schema, the schema is the connections' search_path
+
+    Returns:
+      The number of rows copied per table
+
+    Raises:
+      ValueError if the row counts of the source and the target do not match
+    """
+    version = get_database_schema_version(source)
+    # the counts and the copied rows are read from the same snapshot of the source
+    isolation_level = "SERIALIZABLE"
+    if source.dialect.name == "postgresql":
+        isolation_level = "REPEATABLE READ"
+    snapshot = source.execution_options(isolation_level=isolation_level)
+    rows = {}
+    with snapshot.begin() as source_conn, target.begin() as target_conn:
+        Base.metadata.create_all(bind=target_conn)
+        for table in Base.metadata.sorted_tables:
+            expected = source_conn.execute(
+                select([func.count()]).select_from(table)
+            ).scalar()
+            result = source_conn.execution_options(stream_results=True).execute(
+                table.select()
+            )
+            copied = 0
+            while True:
+                chunk = result.fetchmany(CHUNK_SIZE)
+                if not chunk:
+                    break
+                target_conn.execute(table.insert(), [dict(row) for row in chunk])
+                copied += len(chunk)
+            count = target_conn.execute(select([func.count()]).select_from(table))
+            if count.scalar() != expected or copied != expected:
+                raise ValueError(f"Row counts of table {table.name} do not match")
+            rows[table.name] = copied
+        target_conn.execute(
+            text("CREATE TABLE alembic_version (version_num VARCHAR(32) NOT NULL)")
+        )
+        target_conn.execute(
+            text("INSERT INTO alembic_version (version_num) VALUES (:version)"),
+            version=version,
+        )
+    return rows
+
+
+def list_course_databases() -> List[str]:
+    """
+    Returns the course ids of the gradebooks stored as a database per course.
+    """
+    catalog = GradebookDatabaseCatalog(template="")
+    prefix = f"{org_name}_"
+    excluded = (NBGRADER_DB_SHARED_DATABASE, NBGRADER_DB_TEMPLATE)
+    return sorted(
+        name[len(prefix) :]
+        for name in catalog._list_databases()
+        if name.startswith(prefix) and name not in excluded
+    )
+
+
+def migrate_course(
+    course_id: str, schema_catalog: GradebookSchemaCatalog, drop: bool = False
+) -> CourseMigrationResult:
+    """
+    Moves the gradebook of a course from its database to a schema of the shared database.
+    The course database is upgraded to the installed nbgrader version first.
+    """
+    database_url = nbgrader_format_database_url(f"{org_name}_{course_id}")
+    schema_url = nbgrader_format_schema_url(schema_catalog.database, course_id)
+    source = create_engine(database_url, poolclass=NullPool)
+    target = create_engine(schema_url, poolclass=NullPool)
+    try:
+        if schema_catalog.exists(course_id) and get_database_schema_version(target):
+            logger.info("Course %s was already migrated" % course_id)
+            return CourseMigrationResult(course_id, {}, skipped=True)
+        if get_database_schema_version(source) != get_schema_version():
+            dbutil.upgrade(database_url)
+        schema_catalog.create(course_id)
+        rows = copy_gradebook(source, target)
+    except Exception as e:
+        logger.error("Error migrating course %s: %s" % (course_id, e))
+        return CourseMigrationResult(course_id, {}, error=f"{type(e).__name__}: {e}")
+    finally:
+        source.dispose()
+        target.dispose()
+    logger.info("Migrated course %s: %s" % (course_id, rows))
+    if drop:
+        try:
+            drop_course_database(course_id)
+        except Exception as e:
+            # the rows were copied, the database can be dropped once it is not in use
+            logger.error(
+                "Error dropping the database of course %s: %s" % (course_id, e)
+            )
+            return CourseMigrationResult(
+                course_id, rows, error=f"{type(e).__name__}: {e}"
+            )
+    return CourseMigrationResult(course_id, rows)
+
+
+def drop_course_database(course_id: str) -> None:
+    """
+    Drops the database of a course, it fails while the database has connections.
+    """
+    server = GradebookDatabaseCatalog(template="")
+    quote = server.engine.dialect.identifier_preparer.quote
+    server.engine.execute(text(f"DROP DATABASE {quote(f'{org_name}_{course_id}')}"))
+
+
+def migrate_courses(
+    course_ids: List[str] = None, jobs: int = 4, drop: bool = False
+) -> List[CourseMigrationResult]:
+    """
+    Moves the gradebooks of the courses, all the course databases by default, running
+    `jobs` courses at a time.
+    """
+    course_ids = course_ids or list_course_databases()
+    schema_catalog = GradebookSchemaCatalog()
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        return list(
+            executor.map(
+                lambda course_id: migrate_course(course_id, schema_catalog, drop=drop),
+                course_ids,
+            )
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Moves the course gradebook databases to schemas of the shared "
+        "gradebook database"
+    )
+    parser.add_argument(
+        "course_ids", nargs="*", help="the course ids, all the courses by default"
+    )
+    parser.add_argument("--jobs", type=int, default=4, help="courses moved at a time")
+    parser.add_argument(
+        "--drop", action="store_true", help="drop the course databases once copied"
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    results = migrate_courses(args.course_ids, jobs=args.jobs, drop=args.drop)
+    print(json.dumps([result._asdict() for result in results], indent=2))
+    if any(result.error for result in results):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
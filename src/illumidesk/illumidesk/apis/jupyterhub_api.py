@@ -1,27 +1,349 @@
+import asyncio
 import json
 import os
+import random
+import threading
+import time
+from collections import deque
 from typing import Any
+from typing import AsyncIterator
 from typing import Awaitable
+from typing import Callable
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Set
+from urllib.parse import urlencode
 
 from tornado.httpclient import AsyncHTTPClient
 from tornado.httpclient import HTTPClientError
 from tornado.httpclient import HTTPResponse  # noqa: F401
+from tornado.ioloop import IOLoop
 from traitlets.config import LoggingConfigurable
 
+from illumidesk.metrics import JUPYTERHUB_API_RETRIES_TOTAL
+from illumidesk.metrics import JUPYTERHUB_GROUP_BATCH_USERS
+from illumidesk.metrics import RetryOutcome
+
+# maximum number of concurrent connections to the hub api
+JUPYTERHUB_API_MAX_CLIENTS = int(os.environ.get("JUPYTERHUB_API_MAX_CLIENTS") or 20)
+# use tornado's curl client, which keeps connections alive, when pycurl is installed
+JUPYTERHUB_API_USE_CURL = (
+    os.environ.get("JUPYTERHUB_API_USE_CURL") or "false"
+).lower() in ("1", "true", "yes")
+# default timeouts (seconds) of each request, a call can override them
+JUPYTERHUB_API_CONNECT_TIMEOUT = float(
+    os.environ.get("JUPYTERHUB_API_CONNECT_TIMEOUT") or 5
+)
+JUPYTERHUB_API_REQUEST_TIMEOUT = float(
+    os.environ.get("JUPYTERHUB_API_REQUEST_TIMEOUT") or 20
+)
+# retries of a request that failed with a 429, a 5xx or a connection error
+JUPYTERHUB_API_MAX_RETRIES = int(os.environ.get("JUPYTERHUB_API_MAX_RETRIES") or 3)
+# fraction of the requests that can be retried when the hub is struggling
+JUPYTERHUB_API_RETRY_BUDGET_RATIO = float(
+    os.environ.get("JUPYTERHUB_API_RETRY_BUDGET_RATIO") or 0.2
+)
+
+# seconds the members of a group are trusted before fetching them again
+JUPYTERHUB_GROUP_CACHE_TTL = float(os.environ.get("JUPYTERHUB_GROUP_CACHE_TTL") or 300)
+
+# seconds new group members wait for other additions to the same group
+JUPYTERHUB_GROUP_BATCH_WINDOW = float(
+    os.environ.get("JUPYTERHUB_GROUP_BATCH_WINDOW") or 0.05
+)
+# maximum number of users added to a group with a single request
+JUPYTERHUB_GROUP_BATCH_SIZE = int(os.environ.get("JUPYTERHUB_GROUP_BATCH_SIZE") or 100)
+
+# items requested per page when listing users and groups, the hub caps it to its
+# api_page_max_limit (200 by default)
+JUPYTERHUB_API_PAGE_SIZE = int(os.environ.get("JUPYTERHUB_API_PAGE_SIZE") or 200)
+# pages requested concurrently when listing users and groups
+JUPYTERHUB_API_PAGE_CONCURRENCY = int(
+    os.environ.get("JUPYTERHUB_API_PAGE_CONCURRENCY") or 2
+)
+# media type of the paginated responses, supported since JupyterHub 2.0
+PAGINATION_MEDIA_TYPE = "application/jupyterhub-pagination+json"
+
+# status codes of the responses worth retrying, 599 is a timeout or connection error
+RETRYABLE_STATUS_CODES = frozenset({429, 500, 502, 503, 504, 599})
+# requests that can be sent again after an error without changing the outcome
+IDEMPOTENT_METHODS = frozenset({"GET", "HEAD", "OPTIONS", "PUT", "DELETE"})
+# curl error raised when the connection could not be opened (CURLE_COULDNT_CONNECT)
+CURL_COULDNT_CONNECT = 7
+
+
+class RetryBudget:
+    """
+    Token bucket shared by all the requests to the hub api. Every request deposits ratio
+    tokens and every retry withdraws one, so retries stay below a fraction of the traffic
+    and a struggling hub is not hammered by retry storms. The bucket starts full, to allow
+    the retries of the first requests after a restart.
+
+    Attributes:
+      ratio: tokens deposited by each request
+      capacity: maximum number of tokens
+    """
+
+    def __init__(
+        self, ratio: float = JUPYTERHUB_API_RETRY_BUDGET_RATIO, capacity: float = 10
+    ):
+        if ratio < 0:
+            raise ValueError("ratio must not be negative")
+        if capacity <= 0:
+            raise ValueError("capacity must be greater than zero")
+        self.ratio = ratio
+        self.capacity = capacity
+        self.tokens = capacity
+        self._lock = threading.Lock()
+
+    def deposit(self) -> None:
+        """Registers a request"""
+        with self._lock:
+            self.tokens = min(self.capacity, self.tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        """
+        Registers a retry. Returns False if the budget is exhausted.
+        """
+        with self._lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class GroupMembershipCache:
+    """
+    Index of the hub's groups and their members, so the membership of a user is checked
+    locally with each launch instead of fetching the group's complete member list. Groups
+    are loaded with their first lookup, updated with our own writes and loaded again once
+    their entry is older than the ttl. Groups not in the cache may not exist.
+
+    Attributes:
+      ttl: seconds the members of a group are trusted before fetching them again
+    """
+
+    def __init__(self, ttl: float = JUPYTERHUB_GROUP_CACHE_TTL):
+        self.ttl = ttl
+        self._members: Dict[str, Set[str]] = {}
+        self._loaded_at: Dict[str, float] = {}
+
+    def __len__(self) -> int:
+        return len(self._members)
+
+    def __contains__(self, group_name: str) -> bool:
+        return group_name in self._members
+
+    def is_member(self, group_name: str, username: str) -> bool:
+        """Returns True if the user is a member of the group, fresh or not"""
+        return username in self._members.get(group_name, ())
+
+    def is_fresh(self, group_name: str, now: float = None) -> bool:
+        """Returns True if the group's members were loaded within the ttl"""
+        now = now if now is not None else time.monotonic()
+        loaded_at = self._loaded_at.get(group_name)
+        return loaded_at is not None and now - loaded_at < self.ttl
+
+    def set_members(
+        self, group_name: str, members: Iterable[str], now: float = None
+    ) -> None:
+        """Replaces the group's members with the members returned by the hub"""
+        self._members[group_name] = set(members)
+        self._loaded_at[group_name] = now if now is not None else time.monotonic()
+
+    def add_member(self, group_name: str, username: str) -> None:
+        """Registers a user added to a group by this process"""
+        self._members.setdefault(group_name, set()).add(username)
+        # the other members are unknown until the group is loaded
+        self._loaded_at.setdefault(group_name, float("-inf"))
+
+    def invalidate(self, group_name: str) -> None:
+        """Forgets a group, so its members are fetched with the next lookup"""
+        self._members.pop(group_name, None)
+        self._loaded_at.pop(group_name, None)
+
+    def clear(self) -> None:
+        """Forgets all the groups"""
+        self._members.clear()
+        self._loaded_at.clear()
+
+
+_group_membership_cache: Optional[GroupMembershipCache] = None
+
+
+def get_group_membership_cache() -> GroupMembershipCache:
+    """
+    Returns the process-wide group membership cache.
+    """
+    global _group_membership_cache
+    if _group_membership_cache is None:
+        _group_membership_cache = GroupMembershipCache()
+    return _group_membership_cache
+
+
+# refreshes of stale groups running in the background
+_background_refreshes: Set[asyncio.Future] = set()
+
+
+class GroupMemberBatcher:
+    """
+    Write-behind batcher of the users added to JupyterHub groups. Additions to a group are
+    collected during a short window and written with a single request per group, and
+    the users unknown to the hub are created with a single request as well. Each caller
+    waits for the request that includes its user, at most the window plus the request
+    time, and gets its error if the request fails. Users rejected by the hub are retried
+    one by one, so a bad username does not fail the rest of the batch.
+
+    Attributes:
+      api: the JupyterHubAPI used to send the requests
+      window: seconds additions wait for other additions to the same group
+      max_batch: number of pending users that flushes a group before the window ends
+    """
+
+    def __init__(
+        self,
+        api: "JupyterHubAPI",
+        window: float = JUPYTERHUB_GROUP_BATCH_WINDOW,
+        max_batch: int = JUPYTERHUB_GROUP_BATCH_SIZE,
+    ):
+        if max_batch <= 0:
+            raise ValueError("max_batch must be greater than zero")
+        self.api = api
+        self.window = window
+        self.max_batch = max_batch
+        self._pending: Dict[str, Dict[str, asyncio.Future]] = {}
+        self._timers: Dict[str, asyncio.TimerHandle] = {}
+        self._writes: Set[asyncio.Future] = set()
+
+    async def add(self, group_name: str, username: str) -> None:
+        """
+        Adds a user to a group with the next request for the group.
+
+        Raises:
+          HTTPClientError if the hub rejected the user
+        """
+        pending = self._pending.setdefault(group_name, {})
+        future = pending.get(username)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            pending[username] = future
+            if len(pending) >= self.max_batch:
+                self._flush(group_name)
+            elif group_name not in self._timers:
+                self._timers[group_name] = asyncio.get_running_loop().call_later(
+                    self.window, self._flush, group_name
+                )
+        # callers that stop waiting do not cancel the addition for the rest
+        await asyncio.shield(future)
+
+    async def flush(self) -> None:
+        """
+        Writes the pending additions of all the groups and waits for the requests.
+        """
+        for group_name in list(self._pending):
+            self._flush(group_name)
+        if self._writes:
+            await asyncio.gather(*self._writes, return_exceptions=True)
+
+    def _flush(self, group_name: str) -> None:
+        timer = self._timers.pop(group_name, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self._pending.pop(group_name, None)
+        if batch:
+            task = asyncio.ensure_future(self._write(group_name, batch))
+            self._writes.add(task)
+            task.add_done_callback(self._writes.discard)
+
+    async def _write(self, group_name: str, batch: Dict[str, asyncio.Future]) -> None:
+        usernames = list(batch)
+        JUPYTERHUB_GROUP_BATCH_USERS.observe(len(usernames))
+        try:
+            await self._add_members(group_name, usernames)
+        except Exception as e:
+            if len(usernames) > 1 and getattr(e, "code", None) == 400:
+                # isolate the users rejected by the hub
+                results = await asyncio.gather(
+                    *[self._add_members(group_name, [user]) for user in usernames],
+                    return_exceptions=True,
+                )
+                for username, result in zip(usernames, results):
+                    self._resolve(
+                        batch[username],
+                        result if isinstance(result, Exception) else None,
+                    )
+            else:
+                for future in batch.values():
+                    self._resolve(future, e)
+            return
+        for future in batch.values():
+            self._resolve(future, None)
+
+    async def _add_members(self, group_name: str, usernames: List[str]) -> None:
+        try:
+            await self.api.add_group_members(group_name, *usernames)
+        except HTTPClientError as e:
+            if e.code == 409:
+                return
+            if e.code != 400:
+                raise
+            # the hub does not know some of the users yet
+            try:
+                await self.api.create_users(*usernames)
+            except HTTPClientError as create_error:
+                # all the users exist
+                if create_error.code != 409:
+                    raise
+            await self.api.add_group_members(group_name, *usernames)
+
+    @staticmethod
+    def _resolve(future: asyncio.Future, error: Optional[Exception]) -> None:
+        if future.done():
+            return
+        if error is None:
+            future.set_result(None)
+        else:
+            future.set_exception(error)
+            # retrieved here in case all the callers stopped waiting
+            future.exception()
+
 
 class JupyterHubAPI(LoggingConfigurable):
     """
-    Class used to communicate with JupyterHub using the REST API.
+    Class used to communicate with JupyterHub using the REST API. Use get_jupyterhub_api to
+    share the connection pool and the retry budget within the process.
+
+    Failed idempotent requests with a 429, a 5xx or a connection error are retried with
+    jittered exponential backoff, as long as the retry budget allows it. Other requests
+    (POST) are retried only when the hub did not receive them: the connection was refused
+    or the hub rejected them with a 429.
 
     Attributes:
       client: an instance of tornado's AsyncHTTPClient
       token: valid JupyterHub API token
       api_root_url: JupyterHUb's API url endpoint
       default_headers: default request headers
+      max_clients: maximum number of concurrent connections
+      max_retries: maximum number of retries of a request
+      retry_budget: the RetryBudget shared by the requests
+      group_cache: the GroupMembershipCache used to check the group memberships
+      group_batcher: the GroupMemberBatcher used to add users to groups
     """
 
-    def __init__(self):
-        self.client = AsyncHTTPClient()
+    # backoff before the first retry and upper bound, in seconds
+    backoff_base = 0.1
+    backoff_cap = 2.0
+
+    def __init__(
+        self,
+        max_clients: int = JUPYTERHUB_API_MAX_CLIENTS,
+        max_retries: int = JUPYTERHUB_API_MAX_RETRIES,
+        retry_budget: RetryBudget = None,
+        use_curl: bool = JUPYTERHUB_API_USE_CURL,
+        group_cache: GroupMembershipCache = None,
+    ):
         self.token = os.environ.get("JUPYTERHUB_API_TOKEN")
         if not self.token:
             raise EnvironmentError("JUPYTERHUB_API_TOKEN env-var is not set")
@@ -32,14 +354,82 @@ class JupyterHubAPI(LoggingConfigurable):
             "Authorization": f"token {self.token}",
             "Content-Type": "application/json",
         }
+        self.max_clients = max_clients
+        self.max_retries = max_retries
+        self.retry_budget = retry_budget or RetryBudget()
+        self.group_cache = (
+            group_cache if group_cache is not None else get_group_membership_cache()
+        )
+        self.group_batcher = GroupMemberBatcher(self)
+        # running group requests indexed by operation and group name
+        self._group_requests: Dict[str, asyncio.Future] = {}
+        self._client_class = AsyncHTTPClient
+        if use_curl:
+            try:
+                from tornado.curl_httpclient import CurlAsyncHTTPClient
+
+                self._client_class = CurlAsyncHTTPClient
+            except ImportError:
+                self.log.warning("pycurl is not installed, using tornado's http client")
+        self._client: Optional[AsyncHTTPClient] = None
+
+    @property
+    def client(self) -> AsyncHTTPClient:
+        """
+        The client of the running event loop, created with the first request so the pool
+        is bound to the hub's event loop. The client of a previous event loop is closed.
+        """
+        if self._client is None or self._client.io_loop is not IOLoop.current():
+            if self._client is not None:
+                self._client.close()
+            self._client = self._client_class(
+                force_instance=True,
+                max_clients=self.max_clients,
+                defaults={
+                    "connect_timeout": JUPYTERHUB_API_CONNECT_TIMEOUT,
+                    "request_timeout": JUPYTERHUB_API_REQUEST_TIMEOUT,
+                },
+            )
+        return self._client
+
+    @staticmethod
+    def _is_retryable(method: str, error: Exception) -> bool:
+        # connection errors raised by the simple client are retried as 599s
+        code = error.code if isinstance(error, HTTPClientError) else 599
+        if code not in RETRYABLE_STATUS_CODES:
+            return False
+        if method.upper() in IDEMPOTENT_METHODS:
+            return True
+        # the request was not received by the hub, so sending it again is safe
+        return (
+            code == 429
+            or isinstance(error, ConnectionRefusedError)
+            or (
+                isinstance(error, HTTPClientError)
+                and getattr(error, "errno", None) == CURL_COULDNT_CONNECT
+            )
+        )
+
+    def _backoff(self, attempt: int, error: Exception) -> float:
+        # honour the hub's retry-after header with 429s, bounded by the backoff cap
+        response = getattr(error, "response", None)
+        if getattr(error, "code", None) == 429 and response is not None:
+            retry_after = response.headers.get("Retry-After")
+            if retry_after and retry_after.isdigit():
+                return min(float(retry_after), self.backoff_cap)
+        # full jitter
+        return random.uniform(
+            0, min(self.backoff_cap, self.backoff_base * 2 ** attempt)
+        )
 
     async def _request(self, endpoint: str, **kwargs: Any) -> Awaitable["HTTPResponse"]:
         """
-        Wrapper for the AsyncHTTPClient.fetch method which adds additional log outputs
-        and headers.
+        Wrapper for the AsyncHTTPClient.fetch method which adds additional log outputs,
+        headers and retries.
 
         Args:
           endpoint: JupyterHub REST API endpoint
+          kwargs: arguments of AsyncHTTPClient.fetch, such as request_timeout
 
         Returns:
           HTTPResponse returned as a tornado.concurrent.Future object.
@@ -50,7 +440,30 @@ class JupyterHubAPI(LoggingConfigurable):
         headers.update(self.default_headers)
         url = f"{self.api_root_url}/{endpoint}"
         self.log.debug(f"Creating request with url: {url}")
-        return await self.client.fetch(url, headers=headers, **kwargs)
+        self.retry_budget.deposit()
+        attempt = 0
+        while True:
+            try:
+                return await self.client.fetch(url, headers=headers, **kwargs)
+            except (HTTPClientError, OSError) as e:
+                code = e.code if isinstance(e, HTTPClientError) else 599
+                if (
+                    not self._is_retryable(kwargs.get("method", "GET"), e)
+                    or attempt >= self.max_retries
+                ):
+                    raise
+                if not self.retry_budget.withdraw():
+                    JUPYTERHUB_API_RETRIES_TOTAL.labels(
+                        outcome=RetryOutcome.budget_exhausted
+                    ).inc()
+                    raise
+                JUPYTERHUB_API_RETRIES_TOTAL.labels(outcome=RetryOutcome.retried).inc()
+                delay = self._backoff(attempt, e)
+                self.log.warning(
+                    f"Retrying request {url} in {delay:.2f}s after error {code}: {e}"
+                )
+                attempt += 1
+                await asyncio.sleep(delay)
 
     async def create_group(self, group_name: str) -> Awaitable["HTTPResponse"]:
         """
@@ -90,6 +503,122 @@ class JupyterHubAPI(LoggingConfigurable):
         self.log.debug(f"Getting group with path groups/{group_name}")
         return await self._request(f"groups/{group_name}")
 
+    async def _iter_pages(
+        self,
+        endpoint: str,
+        params: Dict[str, Any] = None,
+        page_size: int = JUPYTERHUB_API_PAGE_SIZE,
+        concurrency: int = JUPYTERHUB_API_PAGE_CONCURRENCY,
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Yields the items of a paginated list endpoint in order. Once the first page tells
+        the total, up to concurrency pages are requested ahead of the consumer, so at most
+        concurrency + 1 pages are held in memory. Items added or removed while iterating
+        may be skipped or repeated, as with any offset based pagination.
+        """
+        if page_size <= 0:
+            raise ValueError("page_size must be greater than zero")
+        if concurrency <= 0:
+            raise ValueError("concurrency must be greater than zero")
+        params = {key: value for key, value in (params or {}).items() if value}
+
+        async def fetch(offset: int) -> Any:
+            query = urlencode({**params, "offset": offset, "limit": page_size})
+            resp = await self._request(
+                f"{endpoint}?{query}", headers={"Accept": PAGINATION_MEDIA_TYPE}
+            )
+            return json.loads(resp.body)
+
+        page = await fetch(0)
+        if isinstance(page, list):
+            # hubs older than 2.0 ignore the pagination parameters
+            for item in page:
+                yield item
+            return
+        pagination = page.get("_pagination") or {}
+        total = pagination.get("total")
+        # the hub may return less items than requested per page
+        limit = pagination.get("limit") or len(page["items"]) or page_size
+        pending = deque()
+        offsets = iter(range(limit, total, limit)) if total is not None else iter(())
+        for offset in offsets:
+            pending.append(asyncio.ensure_future(fetch(offset)))
+            if len(pending) >= concurrency:
+                break
+        try:
+            while True:
+                for item in page["items"]:
+                    yield item
+                if pending:
+                    page = await pending.popleft()
+                    offset = next(offsets, None)
+                    if offset is not None:
+                        pending.append(asyncio.ensure_future(fetch(offset)))
+                elif total is None and (page.get("_pagination") or {}).get("next"):
+                    # without the total follow the next links one page at a time
+                    page = await fetch(page["_pagination"]["next"]["offset"])
+                else:
+                    return
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def iter_users(
+        self,
+        state: str = None,
+        page_size: int = JUPYTERHUB_API_PAGE_SIZE,
+        concurrency: int = JUPYTERHUB_API_PAGE_CONCURRENCY,
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Iterates over the hub's users one page at a time.
+
+        Args:
+          state: the users' server state (active, inactive or ready), all the users if None
+          page_size: users requested per page
+          concurrency: pages requested ahead of the consumer
+
+        Returns:
+          An async iterator of user models
+        """
+        async for user in self._iter_pages(
+            "users", {"state": state}, page_size, concurrency
+        ):
+            yield user
+
+    async def iter_groups(
+        self,
+        page_size: int = JUPYTERHUB_API_PAGE_SIZE,
+        concurrency: int = JUPYTERHUB_API_PAGE_CONCURRENCY,
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Iterates over the hub's groups one page at a time.
+
+        Args:
+          page_size: groups requested per page
+          concurrency: pages requested ahead of the consumer
+
+        Returns:
+          An async iterator of group models
+        """
+        async for group in self._iter_pages("groups", None, page_size, concurrency):
+            yield group
+
+    async def iter_group_members(self, group_name: str) -> AsyncIterator[str]:
+        """
+        Iterates over the members of a group. The hub returns the members of a group
+        within the group model, which is not paginated, so only one group is held in
+        memory at a time.
+
+        Args:
+          group_name: the group name
+
+        Returns:
+          An async iterator of usernames
+        """
+        resp = await self.get_group(group_name)
+        for username in json.loads(resp.body)["users"]:
+            yield username
+
     async def create_users(self, *users: str) -> Awaitable["HTTPResponse"]:
         """
         Creates users from a list
@@ -149,15 +678,41 @@ class JupyterHubAPI(LoggingConfigurable):
             method="POST",
         )
 
+    async def add_group_members(
+        self, group_name: str, *usernames: str
+    ) -> Awaitable["HTTPResponse"]:
+        """
+        Adds users to a group with a single request
+
+        Args:
+          group_name: the group name
+          usernames: the users' unique names
+
+        Returns:
+          Response from the endpoint
+        """
+        if not group_name:
+            raise ValueError("group_name missing")
+        if not usernames:
+            raise ValueError("usernames missing")
+        self.log.debug("Adding users %s to group %s" % (usernames, group_name))
+        return await self._request(
+            f"groups/{group_name}/users",
+            body=json.dumps({"users": list(usernames)}),
+            method="POST",
+        )
+
     async def add_student_to_jupyterhub_group(
         self, course_id: str, student: str
-    ) -> Awaitable["HTTPResponse"]:
+    ) -> bool:
         """
         Adds a student to the student course group.
 
         Args:
             course_id: The normalized string which represents the course label.
             student: The student name
+        Returns:
+            True if the student is a member of the group, False if there was an error
         Raises:
             HTTPClientError: when adding user to group
         """
@@ -168,29 +723,34 @@ class JupyterHubAPI(LoggingConfigurable):
         group_name = f"nbgrader-{course_id}"
         self.log.debug("Student group name is %s" % group_name)
         try:
-            await self.create_group(group_name)
+            await self._create_group_once(group_name)
         except HTTPClientError as e:
             if e.code != 409:
                 self.log.error("Error creating instructors group %e", e)
+                return False
         else:
             try:
-                await self._add_user_to_jupyterhub_group(student, group_name)
+                return await self._add_user_to_jupyterhub_group(student, group_name)
             except HTTPClientError as e:
                 if e.code != 409:
                     self.log.error(
                         "Error adding user %s to group %s with exception %s"
                         % (student, group_name, e)
                     )
+                    return False
+        return True
 
     async def add_instructor_to_jupyterhub_group(
         self, course_id: str, instructor: str
-    ) -> Awaitable["HTTPResponse"]:
+    ) -> bool:
         """
         Adds a an instructor to the student course group.
 
         Args:
             course_id: The normalized string which represents the course label.
             instructor: The instructor name
+        Returns:
+            True if the instructor is a member of the group, False if there was an error
         Raises:
             HTTPClientError: when adding user to group
         """
@@ -201,29 +761,109 @@ class JupyterHubAPI(LoggingConfigurable):
         group_name = f"formgrade-{course_id}"
         self.log.debug("Instructor group name is %s" % group_name)
         try:
-            await self.create_group(group_name)
+            await self._create_group_once(group_name)
         except HTTPClientError as e:
             if e.code != 409:
                 self.log.error("Error creating instructors group %e", e)
+                return False
         else:
             try:
-                await self._add_user_to_jupyterhub_group(instructor, group_name)
+                return await self._add_user_to_jupyterhub_group(instructor, group_name)
             except HTTPClientError as e:
                 if e.code != 409:
                     self.log.error(
                         "Error adding user %s to group %s with exception %s"
                         % (instructor, group_name, e)
                     )
+                    return False
+        return True
+
+    async def _run_group_request(
+        self, key: str, func: Callable[[], Awaitable[Any]]
+    ) -> Any:
+        """
+        Runs a group request, or awaits the running request with the same key, so
+        concurrent launches send a single request. Requests are coalesced within the
+        process only, without the provisioning locks and metrics.
+        """
+        request = self._group_requests.get(key)
+        if request is None:
+            request = asyncio.ensure_future(func())
+            self._group_requests[key] = request
+
+            def done(request: asyncio.Future) -> None:
+                if self._group_requests.get(key) is request:
+                    del self._group_requests[key]
+                # retrieved here in case all the callers stopped waiting
+                if not request.cancelled():
+                    request.exception()
+
+            request.add_done_callback(done)
+        return await asyncio.shield(request)
+
+    async def _create_group_once(self, group_name: str) -> None:
+        """
+        Creates a group unless it is in the membership cache. Concurrent launches of the
+        course create the group once, and the members returned by the hub seed the cache.
+        """
+        if group_name in self.group_cache:
+            return
+        response = await self._run_group_request(
+            f"create:{group_name}", lambda: self.create_group(group_name)
+        )
+        if response is not None:
+            self._cache_group_members(group_name, response)
+
+    def _cache_group_members(self, group_name: str, response: "HTTPResponse") -> None:
+        try:
+            members = json.loads(response.body)["users"]
+        except (TypeError, ValueError, KeyError):
+            self.log.debug("Response for group %s has no members" % group_name)
+            return
+        self.group_cache.set_members(group_name, members)
+
+    async def _load_group_members(self, group_name: str) -> None:
+        """
+        Fetches the group's members into the membership cache, concurrent calls for the
+        same group send a single request.
+        """
+
+        async def load() -> None:
+            resp = await self.get_group(group_name)
+            self.log.debug("Getting response %s" % resp.body)
+            self._cache_group_members(group_name, resp)
+
+        await self._run_group_request(f"members:{group_name}", load)
+
+    def _refresh_group_members(self, group_name: str) -> None:
+        # refreshes a stale group without blocking the launch
+        task = asyncio.ensure_future(self._load_group_members(group_name))
+        _background_refreshes.add(task)
+
+        def done(task: asyncio.Future) -> None:
+            _background_refreshes.discard(task)
+            if not task.cancelled() and task.exception() is not None:
+                self.log.error(
+                    "Error refreshing the members of group %s: %s"
+                    % (group_name, task.exception())
+                )
+
+        task.add_done_callback(done)
 
     async def _add_user_to_jupyterhub_group(
         self, username: str, group_name: str
-    ) -> Awaitable["HTTPResponse"]:
+    ) -> bool:
         """
-        Adds a user to a JupyterHub group.
+        Adds a user to a JupyterHub group. The membership is checked with the group
+        membership cache, which is loaded with the first lookup of the group and when its
+        entry is stale and the user is not a member. Members of stale groups are refreshed
+        in the background. The user is created only if the hub does not know them yet.
 
         Args:
             usernames: The user's name
             group_name: The group's name
+        Returns:
+            True if the user is a member of the group, False if there was an error
         Raises:
             HTTPClientError: when adding user to group
         """
@@ -231,22 +871,34 @@ class JupyterHubAPI(LoggingConfigurable):
             raise ValueError("username missing")
         if not group_name:
             raise ValueError("group_name missing")
+        cache = self.group_cache
+        if cache.is_member(group_name, username):
+            if not cache.is_fresh(group_name):
+                self._refresh_group_members(group_name)
+            return True
+        if not cache.is_fresh(group_name):
+            await self._load_group_members(group_name)
+            if cache.is_member(group_name, username):
+                return True
+        self.log.debug("Adding %s to group %s" % (username, group_name))
         try:
-            self.log.debug("Creating %s" % (username))
-            await self.create_user(username)
+            await self.group_batcher.add(group_name, username)
         except HTTPClientError as http_error:
-            if http_error.code != 409:
-                self.log.debug("Error adding %s" % username)
-        resp = await self.get_group(group_name)
-        self.log.debug("Getting response %s" % resp.body)
-        group_users = json.loads(resp.body)["users"]
-        self.log.debug("Group %s users are: %s" % (group_name, group_users))
-        if username not in group_users:
-            try:
-                self.log.debug("Adding %s to group %s" % (username, group_name))
-                await self.add_group_member(group_name, username)
-            except HTTPClientError as http_error:
-                if http_error.code != 409:
-                    self.log.error(
-                        "Error adding user to jupyterhub group %s" % http_error
-                    )
+            self.log.error("Error adding user to jupyterhub group %s" % http_error)
+            return False
+        cache.add_member(group_name, username)
+        return True
+
+
+_jupyterhub_api: Optional[JupyterHubAPI] = None
+
+
+def get_jupyterhub_api() -> JupyterHubAPI:
+    """
+    Returns the process-wide JupyterHubAPI client, configured with the JUPYTERHUB_API_*
+    env vars.
+    """
+    global _jupyterhub_api
+    if _jupyterhub_api is None:
+        _jupyterhub_api = JupyterHubAPI()
+    return _jupyterhub_api
@@ -1,14 +1,63 @@
+import argparse
+import asyncio
+import functools
 import logging
 import os
+import threading
+import time
+import weakref
+from collections import Counter
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Set
+from typing import Tuple
+from urllib.parse import urlencode
 
+from nbgrader import dbutil
+from nbgrader import utils
 from nbgrader.api import Assignment
+from nbgrader.api import Base
 from nbgrader.api import Course
 from nbgrader.api import Gradebook
 from nbgrader.api import InvalidEntry
-from sqlalchemy_utils import create_database
-from sqlalchemy_utils import database_exists
+from nbgrader.api import Student
+from nbgrader.api import get_alembic_version
+from nbgrader.api import new_uuid
+from sqlalchemy import Table
+from sqlalchemy import bindparam
+from sqlalchemy import create_engine
+from sqlalchemy import literal_column
+from sqlalchemy import select
+from sqlalchemy import text
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.engine import Connection
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import ProgrammingError
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import scoped_session
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool
 
-from illumidesk.authenticators.utils import LTIUtils
+from illumidesk.authenticators.utils import normalize_string
+from illumidesk.metrics import GRADEBOOK_TASK_DURATION_SECONDS
+from illumidesk.metrics import GRADEBOOK_TASKS
+from illumidesk.metrics import NBGRADER_DB_CONNECTIONS
+from illumidesk.metrics import NBGRADER_DB_ENGINE_EVICTIONS_TOTAL
+from illumidesk.metrics import NBGRADER_DB_ENGINE_REQUESTS_TOTAL
+from illumidesk.metrics import NBGRADER_DB_ENGINES
+from illumidesk.metrics import NBGRADER_DB_UPSERT_ROWS_TOTAL
+from illumidesk.metrics import ConnectionState
+from illumidesk.metrics import EngineEvictionReason
+from illumidesk.metrics import EngineRequestResult
+from illumidesk.metrics import GradebookTaskState
+from illumidesk.metrics import UpsertOutcome
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
@@ -25,6 +74,37 @@ org_name = os.environ.get("ORGANIZATION_NAME") or "my-org"
 if not org_name:
     raise EnvironmentError("ORGANIZATION_NAME env-var is not set")
 
+# storage of the course gradebooks: "database" (a database per course) or "schema" (a
+# schema per course within the shared database)
+NBGRADER_DB_STORAGE = (os.environ.get("NBGRADER_DB_STORAGE") or "database").lower()
+if NBGRADER_DB_STORAGE not in ("database", "schema"):
+    raise EnvironmentError("NBGRADER_DB_STORAGE must be database or schema")
+# database with the course schemas when NBGRADER_DB_STORAGE is schema
+NBGRADER_DB_SHARED_DATABASE = (
+    os.environ.get("NBGRADER_DB_SHARED_DATABASE") or f"{org_name}_nbgrader"
+)
+
+# maximum number of threads used to write to the gradebook databases
+NBGRADER_GRADEBOOK_WORKERS = int(os.environ.get("NBGRADER_GRADEBOOK_WORKERS") or 4)
+# connections kept per course database
+NBGRADER_DB_POOL_SIZE = int(os.environ.get("NBGRADER_DB_POOL_SIZE") or 2)
+# connections open to all the course databases, idle course engines are disposed first
+NBGRADER_DB_MAX_CONNECTIONS = int(os.environ.get("NBGRADER_DB_MAX_CONNECTIONS") or 50)
+# course engines kept, the least recently used engines are disposed first
+NBGRADER_DB_MAX_ENGINES = int(os.environ.get("NBGRADER_DB_MAX_ENGINES") or 100)
+# database copied to create the course databases, empty to create empty databases
+NBGRADER_DB_TEMPLATE = os.environ.get("NBGRADER_DB_TEMPLATE") or ""
+# seconds the listing of the databases is used to check whether a course database exists
+NBGRADER_DB_CATALOG_TTL = int(os.environ.get("NBGRADER_DB_CATALOG_TTL") or 60)
+# seconds a course engine is kept without gradebook operations
+NBGRADER_DB_ENGINE_IDLE_TIMEOUT = int(
+    os.environ.get("NBGRADER_DB_ENGINE_IDLE_TIMEOUT") or 300
+)
+# rows written with a single statement and transaction by the bulk upserts
+NBGRADER_DB_UPSERT_CHUNK_SIZE = int(
+    os.environ.get("NBGRADER_DB_UPSERT_CHUNK_SIZE") or 500
+)
+
 
 def nbgrader_format_db_url(course_id: str) -> str:
     """
@@ -33,11 +113,587 @@ def nbgrader_format_db_url(course_id: str) -> str:
     Args:
       course_id: the course id (usually associated with the course label) from which the launch was initiated.
     """
-    course_id = LTIUtils().normalize_string(course_id)
+    course_id = normalize_string(course_id)
+    if NBGRADER_DB_STORAGE == "schema":
+        return nbgrader_format_schema_url(NBGRADER_DB_SHARED_DATABASE, course_id)
     database_name = f"{org_name}_{course_id}"
+    return nbgrader_format_database_url(database_name)
+
+
+def nbgrader_format_database_url(database_name: str) -> str:
+    """
+    Returns the url of a database of the nbgrader postgres server.
+    """
     return f"postgresql://{nbgrader_db_user}:{nbgrader_db_password}@{nbgrader_db_host}:{nbgrader_db_port}/{database_name}"
 
 
+def nbgrader_format_schema_url(database_name: str, schema_name: str) -> str:
+    """
+    Returns the url of a schema of a database of the nbgrader postgres server. The schema
+    is set as the connections' search_path, so nbgrader uses it without changes.
+    """
+    options = urlencode({"options": f"-csearch_path={schema_name}"})
+    return f"{nbgrader_format_database_url(database_name)}?{options}"
+
+
+@functools.lru_cache(maxsize=1)
+def get_schema_version() -> str:
+    """
+    Returns the gradebook schema version (alembic head) of the installed nbgrader. nbgrader
+    runs alembic in a subprocess to get it, so it is done once per process.
+    """
+    return get_alembic_version()
+
+
+def get_database_schema_version(engine: Engine) -> Optional[str]:
+    """
+    Returns the gradebook schema version of a database, or None if the database does not
+    have the gradebook tables.
+    """
+    if not engine.has_table("alembic_version"):
+        return None
+    return engine.execute(text("SELECT version_num FROM alembic_version")).scalar()
+
+
+class CourseEngine:
+    """
+    A course database engine kept by the GradebookEngineRegistry.
+
+    Attributes:
+      db_url: the course database url
+      engine: the sqlalchemy engine, with its connection pool
+      initialized: whether the gradebook tables were checked with this engine
+      leases: number of gradebooks using the engine
+      last_used: monotonic timestamp of the last gradebook closed
+    """
+
+    __slots__ = ("db_url", "engine", "initialized", "leases", "last_used")
+
+    def __init__(self, db_url: str, engine: Engine):
+        self.db_url = db_url
+        self.engine = engine
+        self.initialized = False
+        self.leases = 0
+        self.last_used = time.monotonic()
+
+    def connections(self) -> Tuple[int, int]:
+        """Returns the number of idle and in use connections of the engine's pool"""
+        pool = self.engine.pool
+        if not hasattr(pool, "checkedin"):
+            return 0, 0
+        return pool.checkedin(), pool.checkedout()
+
+
+class GradebookEngineRegistry:
+    """
+    Process-wide registry of the sqlalchemy engines of the course gradebook databases,
+    keyed by database url, so the gradebook operations reuse the course's connection pool
+    instead of creating an engine and a connection with every operation.
+
+    Each course engine keeps up to pool_size connections. The number of connections open
+    to all the course databases is kept under max_connections by disposing the least
+    recently used engines without gradebooks in use, and gradebooks wait for a connection
+    when max_connections are in use. Engines are also disposed once they are not used for
+    idle_timeout seconds or when there are more than max_engines.
+
+    Attributes:
+      pool_size: connections kept per course database
+      max_connections: connections open to all the course databases
+      max_engines: course engines kept
+      idle_timeout: seconds an engine is kept without gradebook operations
+      timeout: seconds to wait for a connection
+    """
+
+    def __init__(
+        self,
+        pool_size: int = NBGRADER_DB_POOL_SIZE,
+        max_connections: int = NBGRADER_DB_MAX_CONNECTIONS,
+        max_engines: int = NBGRADER_DB_MAX_ENGINES,
+        idle_timeout: int = NBGRADER_DB_ENGINE_IDLE_TIMEOUT,
+        timeout: int = 30,
+    ):
+        if pool_size <= 0 or max_connections <= 0 or max_engines <= 0:
+            raise ValueError("pool sizes must be greater than zero")
+        self.pool_size = pool_size
+        self.max_connections = max_connections
+        self.max_engines = max_engines
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._engines: "OrderedDict[str, CourseEngine]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._in_use = threading.BoundedSemaphore(max_connections)
+
+    def __len__(self) -> int:
+        return len(self._engines)
+
+    def __contains__(self, db_url: str) -> bool:
+        return db_url in self._engines
+
+    def checkout(self, db_url: str) -> CourseEngine:
+        """
+        Returns the course engine for a database url, created with the first call. Every
+        checkout must be followed by a checkin.
+
+        Raises:
+          TimeoutError if max_connections are in use for longer than timeout
+        """
+        if not self._in_use.acquire(timeout=self.timeout):
+            raise TimeoutError("Timed out waiting for a gradebook database connection")
+        try:
+            with self._lock:
+                entry = self._engines.get(db_url)
+                if entry is None:
+                    NBGRADER_DB_ENGINE_REQUESTS_TOTAL.labels(
+                        result=EngineRequestResult.miss
+                    ).inc()
+                    entry = self._engines[db_url] = CourseEngine(
+                        db_url, self._create_engine(db_url)
+                    )
+                else:
+                    NBGRADER_DB_ENGINE_REQUESTS_TOTAL.labels(
+                        result=EngineRequestResult.hit
+                    ).inc()
+                    self._engines.move_to_end(db_url)
+                entry.leases += 1
+                self._evict()
+        except Exception:
+            self._in_use.release()
+            raise
+        return entry
+
+    def checkin(self, entry: CourseEngine) -> None:
+        """Returns a course engine obtained with checkout"""
+        with self._lock:
+            entry.leases -= 1
+            entry.last_used = time.monotonic()
+            self._evict()
+        self._in_use.release()
+
+    def dispose(self) -> None:
+        """Disposes the engines without gradebooks in use"""
+        with self._lock:
+            for db_url, entry in list(self._engines.items()):
+                if not entry.leases:
+                    entry.engine.dispose()
+                    del self._engines[db_url]
+            self._update_metrics()
+
+    def _create_engine(self, db_url: str) -> Engine:
+        if db_url.startswith("sqlite"):
+            # sqlite uses its own pool classes, without size arguments
+            return create_engine(db_url, echo=False)
+        return create_engine(
+            db_url,
+            echo=False,
+            pool_size=self.pool_size,
+            max_overflow=0,
+            pool_timeout=self.timeout,
+            pool_pre_ping=True,
+        )
+
+    def _evict(self) -> None:
+        now = time.monotonic()
+        idle, in_use = self._count_connections()
+        # engines are kept in least recently used order
+        for db_url, entry in list(self._engines.items()):
+            if entry.leases:
+                continue
+            if (
+                len(self._engines) > self.max_engines
+                or idle + in_use > self.max_connections
+            ):
+                reason = EngineEvictionReason.capacity
+            elif now - entry.last_used > self.idle_timeout:
+                reason = EngineEvictionReason.idle
+            else:
+                continue
+            idle -= entry.connections()[0]
+            entry.engine.dispose()
+            del self._engines[db_url]
+            NBGRADER_DB_ENGINE_EVICTIONS_TOTAL.labels(reason=reason).inc()
+            logger.debug(
+                "Disposed gradebook engine of %s (%s)"
+                % (entry.engine.url.database, reason)
+            )
+        self._update_metrics()
+
+    def _count_connections(self) -> Tuple[int, int]:
+        idle = in_use = 0
+        for entry in self._engines.values():
+            entry_idle, entry_in_use = entry.connections()
+            idle += entry_idle
+            in_use += entry_in_use
+        return idle, in_use
+
+    def _update_metrics(self) -> None:
+        idle, in_use = self._count_connections()
+        NBGRADER_DB_ENGINES.set(len(self._engines))
+        NBGRADER_DB_CONNECTIONS.labels(state=ConnectionState.idle).set(idle)
+        NBGRADER_DB_CONNECTIONS.labels(state=ConnectionState.in_use).set(in_use)
+
+
+_gradebook_engine_registry: Optional[GradebookEngineRegistry] = None
+
+
+def get_gradebook_engine_registry() -> GradebookEngineRegistry:
+    """
+    Returns the process-wide gradebook engine registry configured with the
+    NBGRADER_DB_* env vars.
+    """
+    global _gradebook_engine_registry
+    if _gradebook_engine_registry is None:
+        _gradebook_engine_registry = GradebookEngineRegistry()
+    return _gradebook_engine_registry
+
+
+class PooledGradebook(Gradebook):
+    """
+    nbgrader Gradebook that uses the course engine from the GradebookEngineRegistry. The
+    gradebook tables are checked once per engine, and closing the gradebook returns the
+    engine to the registry instead of disposing it.
+    """
+
+    def __init__(
+        self,
+        db_url: str,
+        course_id: str = "default_course",
+        authenticator: Any = None,
+        registry: GradebookEngineRegistry = None,
+    ):
+        self.registry = (
+            registry if registry is not None else get_gradebook_engine_registry()
+        )
+        self.course_engine = self.registry.checkout(db_url)
+        self.engine = self.course_engine.engine
+        self.db = scoped_session(sessionmaker(autoflush=True, bind=self.engine))
+        try:
+            if not self.course_engine.initialized:
+                self._create_tables()
+                self.course_engine.initialized = True
+            self.check_course(course_id=course_id)
+        except Exception:
+            self.close()
+            raise
+        self.course_id = course_id
+        self.authenticator = authenticator
+
+    def _create_tables(self) -> None:
+        # databases with a stored schema version, such as the copies of the template
+        # database, already have the gradebook tables. The alembic head, which nbgrader
+        # reads in a subprocess, is only needed to stamp new gradebooks
+        if get_database_schema_version(self.engine) is not None:
+            return
+        # same as nbgrader's Gradebook.__init__
+        db_exists = len(self.engine.table_names()) > 0
+        Base.metadata.create_all(bind=self.engine)
+        if not db_exists:
+            alembic_version = get_schema_version()
+            self.db.execute(
+                "CREATE TABLE alembic_version (version_num VARCHAR(32) NOT NULL);"
+            )
+            self.db.execute(
+                "INSERT INTO alembic_version (version_num) VALUES ('{}');".format(
+                    alembic_version
+                )
+            )
+            self.db.commit()
+
+    def close(self) -> None:
+        """Closes the session, the engine's connections stay in the pool"""
+        if self.course_engine is None:
+            return
+        self.db.remove()
+        self.registry.checkin(self.course_engine)
+        self.course_engine = None
+
+
+class GradebookDatabaseCatalog:
+    """
+    Cached listing of the databases of the nbgrader postgres server, so the launches check
+    whether the course database exists without a round-trip to the server. The listing is
+    read again after ttl seconds and before creating a database.
+
+    When a template database is configured, course databases are created as copies of the
+    template (CREATE DATABASE ... TEMPLATE), which already has the gradebook schema, instead
+    of creating the schema with the course's first gradebook operation. The template is
+    created with the first course database and upgraded when its schema version does not
+    match the installed nbgrader.
+
+    Attributes:
+      server_url: url of the server's maintenance database
+      template: name of the template database, empty to create empty databases
+      ttl: seconds the listing is used before it is read again
+    """
+
+    def __init__(
+        self,
+        server_url: str = None,
+        template: str = NBGRADER_DB_TEMPLATE,
+        ttl: int = NBGRADER_DB_CATALOG_TTL,
+    ):
+        self.server_url = server_url or nbgrader_format_database_url("postgres")
+        self.template = template
+        self.ttl = ttl
+        self._databases: Set[str] = set()
+        self._listed_at: Optional[float] = None
+        self._template_ready = False
+        self._engine: Optional[Engine] = None
+        self._lock = threading.Lock()
+
+    @property
+    def engine(self) -> Engine:
+        if self._engine is None:
+            # CREATE DATABASE can't run within a transaction
+            self._engine = create_engine(
+                self.server_url, isolation_level="AUTOCOMMIT", poolclass=NullPool
+            )
+        return self._engine
+
+    def clear(self) -> None:
+        """Drops the cached listing"""
+        with self._lock:
+            self._databases.clear()
+            self._listed_at = None
+            self._template_ready = False
+
+    def exists(self, database_name: str) -> bool:
+        """
+        Checks whether a database exists with the cached listing, read again when it is
+        older than ttl or does not include the database.
+        """
+        with self._lock:
+            if database_name in self._databases and self._is_fresh():
+                return True
+            self._refresh()
+            return database_name in self._databases
+
+    def create(self, database_name: str) -> None:
+        """
+        Creates a database, as a copy of the template database if it is configured. A
+        database created meanwhile by another process is not an error.
+        """
+        with self._lock:
+            template = self._prepare_template() if self.template else None
+            self._create(database_name, template)
+            self._databases.add(database_name)
+
+    def prepare_template(self) -> None:
+        """Creates the template database or upgrades its schema if needed"""
+        with self._lock:
+            self._template_ready = False
+            self._prepare_template()
+
+    def _is_fresh(self) -> bool:
+        return (
+            self._listed_at is not None
+            and time.monotonic() - self._listed_at < self.ttl
+        )
+
+    def _refresh(self) -> None:
+        self._databases = set(self._list_databases())
+        self._listed_at = time.monotonic()
+
+    def _list_databases(self) -> List[str]:
+        return [
+            row[0]
+            for row in self.engine.execute(
+                text("SELECT datname FROM pg_database WHERE NOT datistemplate")
+            )
+        ]
+
+    def _create(self, database_name: str, template: str = None) -> None:
+        quote = self.engine.dialect.identifier_preparer.quote
+        statement = f"CREATE DATABASE {quote(database_name)}"
+        if template:
+            statement += f" TEMPLATE {quote(template)}"
+        try:
+            self.engine.execute(text(statement))
+        except ProgrammingError as e:
+            if "already exists" not in str(e):
+                raise
+        logger.debug("Created database %s (template %s)" % (database_name, template))
+
+    def _prepare_template(self) -> Optional[str]:
+        if self._template_ready:
+            return self.template
+        if self.template not in self._databases:
+            self._refresh()
+        if self.template not in self._databases:
+            self._create(self.template)
+            self._databases.add(self.template)
+        template_url = nbgrader_format_database_url(self.template)
+        # nbgrader's gradebook disposes its engine with close, the template can't have
+        # open connections while it is copied
+        engine = create_engine(template_url, poolclass=NullPool)
+        try:
+            version = get_database_schema_version(engine)
+            if version is None:
+                Gradebook(template_url).close()
+            elif version != get_schema_version():
+                logger.info(
+                    "Upgrading template database %s from %s" % (self.template, version)
+                )
+                dbutil.upgrade(template_url)
+            version = get_database_schema_version(engine)
+        finally:
+            engine.dispose()
+        if version != get_schema_version():
+            logger.error(
+                "Template database %s has schema version %s, creating empty databases"
+                % (self.template, version)
+            )
+            return None
+        self._template_ready = True
+        return self.template
+
+
+class GradebookSchemaCatalog(GradebookDatabaseCatalog):
+    """
+    Cached listing of the course schemas of the shared gradebook database, used when the
+    courses are stored as schemas (NBGRADER_DB_STORAGE=schema). The shared database is
+    created with the first course, and the gradebook tables are created within the course
+    schema with the course's first gradebook operation, templates are not used.
+
+    Attributes:
+      database: the shared database
+      ttl: seconds the listing is used before it is read again
+    """
+
+    def __init__(
+        self,
+        database: str = NBGRADER_DB_SHARED_DATABASE,
+        ttl: int = NBGRADER_DB_CATALOG_TTL,
+    ):
+        super().__init__(
+            server_url=nbgrader_format_database_url(database), template="", ttl=ttl
+        )
+        self.database = database
+        self._database_ready = False
+
+    def _list_databases(self) -> List[str]:
+        # lists the schemas of the shared database
+        self._create_shared_database()
+        return [
+            row[0]
+            for row in self.engine.execute(
+                text("SELECT schema_name FROM information_schema.schemata")
+            )
+        ]
+
+    def _create(self, schema_name: str, template: str = None) -> None:
+        self._create_shared_database()
+        quote = self.engine.dialect.identifier_preparer.quote
+        self.engine.execute(text(f"CREATE SCHEMA IF NOT EXISTS {quote(schema_name)}"))
+        logger.debug("Created schema %s in %s" % (schema_name, self.database))
+
+    def _create_shared_database(self) -> None:
+        if self._database_ready:
+            return
+        server = GradebookDatabaseCatalog(template="")
+        if not server.exists(self.database):
+            server.create(self.database)
+        self._database_ready = True
+
+
+_gradebook_database_catalog: Optional[GradebookDatabaseCatalog] = None
+
+
+def get_gradebook_database_catalog() -> GradebookDatabaseCatalog:
+    """
+    Returns the process-wide gradebook database catalog configured with the
+    NBGRADER_DB_STORAGE, NBGRADER_DB_TEMPLATE and NBGRADER_DB_CATALOG_TTL env vars.
+    """
+    global _gradebook_database_catalog
+    if _gradebook_database_catalog is None:
+        if NBGRADER_DB_STORAGE == "schema":
+            _gradebook_database_catalog = GradebookSchemaCatalog()
+        else:
+            _gradebook_database_catalog = GradebookDatabaseCatalog()
+    return _gradebook_database_catalog
+
+
+class UpsertResult(NamedTuple):
+    """
+    The outcome of a row written by a bulk upsert, with the error if it was not written.
+    """
+
+    key: Optional[str]
+    outcome: UpsertOutcome
+    error: Optional[str] = None
+
+
+def upsert_rows(
+    connection: Connection,
+    table: Table,
+    key: str,
+    rows: List[Dict[str, Any]],
+    update_columns: List[str],
+) -> Dict[str, UpsertOutcome]:
+    """
+    Inserts the rows, or updates the update_columns of the rows whose key exists, with a
+    multi-row INSERT ... ON CONFLICT statement on postgres. Other databases (sqlite, used in
+    development) read the existing keys and run an INSERT and an UPDATE for the rows of
+    each kind. The keys must be unique within the rows and the rows must have the same
+    columns.
+
+    Args:
+      connection: the connection, within the transaction of the rows
+      table: the table
+      key: the column with the unique key
+      rows: the rows to write
+      update_columns: the columns updated in the existing rows
+
+    Returns:
+      The outcome of each key
+    """
+    if connection.dialect.name == "postgresql":
+        statement = postgresql.insert(table).values(rows)
+        # DO NOTHING would not return the existing rows
+        columns = update_columns or [key]
+        statement = statement.on_conflict_do_update(
+            index_elements=[table.c[key]],
+            set_={column: statement.excluded[column] for column in columns},
+        ).returning(table.c[key], literal_column("xmax = 0"))
+        return {
+            row_key: UpsertOutcome.inserted if inserted else UpsertOutcome.updated
+            for row_key, inserted in connection.execute(statement)
+        }
+    keys = [row[key] for row in rows]
+    existing = {
+        row[0]
+        for row in connection.execute(
+            select([table.c[key]]).where(table.c[key].in_(keys))
+        )
+    }
+    new_rows = [row for row in rows if row[key] not in existing]
+    if new_rows:
+        connection.execute(table.insert(), new_rows)
+    if existing and update_columns:
+        # bind names can't be the names of the updated columns
+        statement = (
+            table.update()
+            .where(table.c[key] == bindparam("_key"))
+            .values({column: bindparam(f"_{column}") for column in update_columns})
+        )
+        connection.execute(
+            statement,
+            [
+                {
+                    "_key": row[key],
+                    **{f"_{column}": row[column] for column in update_columns},
+                }
+                for row in rows
+                if row[key] in existing
+            ],
+        )
+    return {
+        row_key: (
+            UpsertOutcome.updated if row_key in existing else UpsertOutcome.inserted
+        )
+        for row_key in keys
+    }
+
+
 class NbGraderServiceHelper:
     """
     Helper class to use the nbgrader database and gradebook
@@ -49,13 +705,15 @@ class NbGraderServiceHelper:
       gid: the group id that owns the grader home directory
       db_url: the database string connection uri
       database_name: the database name
+      schema_name: the course schema within the shared database, None when the course has
+        its own database
     """
 
     def __init__(self, course_id: str, check_database_exists: bool = False):
         if not course_id:
             raise ValueError("course_id missing")
 
-        self.course_id = LTIUtils().normalize_string(course_id)
+        self.course_id = normalize_string(course_id)
         self.course_dir = (
             f"{mnt_root}/{org_name}/home/grader-{self.course_id}/{self.course_id}"
         )
@@ -63,17 +721,22 @@ class NbGraderServiceHelper:
         self.gid = int(os.environ.get("NB_GRADER_GID") or "100")
 
         self.db_url = nbgrader_format_db_url(course_id)
-        self.database_name = f"{org_name}_{self.course_id}"
+        if NBGRADER_DB_STORAGE == "schema":
+            self.database_name = NBGRADER_DB_SHARED_DATABASE
+            self.schema_name = self.course_id
+        else:
+            self.database_name = f"{org_name}_{self.course_id}"
+            self.schema_name = None
         if check_database_exists:
             self.create_database_if_not_exists()
 
     def create_database_if_not_exists(self) -> None:
         """Creates a new database if it doesn't exist"""
-        conn_uri = nbgrader_format_db_url(self.course_id)
-
-        if not database_exists(conn_uri):
+        catalog = get_gradebook_database_catalog()
+        name = self.schema_name or self.database_name
+        if not catalog.exists(name):
             logger.debug("db not exist, create database")
-            create_database(conn_uri)
+            catalog.create(name)
 
     def add_user_to_nbgrader_gradebook(self, username: str, lms_user_id: str) -> None:
         """
@@ -90,7 +753,7 @@ class NbGraderServiceHelper:
         if not lms_user_id:
             raise ValueError("lms_user_id missing")
 
-        with Gradebook(self.db_url, course_id=self.course_id) as gb:
+        with PooledGradebook(self.db_url, course_id=self.course_id) as gb:
             try:
                 gb.update_or_create_student(username, lms_user_id=lms_user_id)
                 logger.debug(
@@ -100,18 +763,176 @@ class NbGraderServiceHelper:
             except InvalidEntry as e:
                 logger.debug("Error during adding student to gradebook: %s" % e)
 
+    def add_users_to_nbgrader_gradebook(
+        self, users: Iterable[Tuple[str, str]]
+    ) -> List[str]:
+        """
+        Adds users to the nbgrader gradebook database for the course with a single
+        gradebook session.
+
+        Args:
+            users: the (username, lms_user_id) pairs
+        Returns:
+            The usernames that were added or updated
+        """
+        students = (
+            {"username": username, "lms_user_id": lms_user_id}
+            for username, lms_user_id in users
+            if username and lms_user_id
+        )
+        added = [
+            result.key
+            for result in self.bulk_upsert_students(students)
+            if result.outcome in (UpsertOutcome.inserted, UpsertOutcome.updated)
+        ]
+        logger.debug("Added %s users to gradebook" % len(added))
+        return added
+
+    def bulk_upsert_students(
+        self,
+        students: Iterable[Dict[str, Any]],
+        chunk_size: int = NBGRADER_DB_UPSERT_CHUNK_SIZE,
+    ) -> List[UpsertResult]:
+        """
+        Adds or updates students in the nbgrader gradebook database for the course, with a
+        multi-row upsert and a transaction per chunk of students instead of a gradebook
+        session and commit per student. The students are read as the chunks are written.
+
+        Args:
+            students: dicts with the student's username and, optionally, the lms_user_id,
+              first_name, last_name and email
+            chunk_size: students written with a single statement and transaction
+        Returns:
+            The outcome of each student, in the order of the input
+        """
+        rows = (
+            {
+                "id": student.get("username"),
+                **{k: v for k, v in student.items() if k != "username"},
+            }
+            for student in students
+        )
+        return self._bulk_upsert(
+            Student.__table__, "id", rows, ("id",), chunk_size=chunk_size
+        )
+
+    def bulk_upsert_assignments(
+        self,
+        assignments: Iterable[Dict[str, Any]],
+        chunk_size: int = NBGRADER_DB_UPSERT_CHUNK_SIZE,
+    ) -> List[UpsertResult]:
+        """
+        Adds or updates assignments in the nbgrader gradebook database for the course, with
+        a multi-row upsert and a transaction per chunk of assignments instead of a gradebook
+        session and commit per assignment. The assignments are read as the chunks are
+        written.
+
+        Args:
+            assignments: dicts with the assignment's name and, optionally, the duedate
+            chunk_size: assignments written with a single statement and transaction
+        Returns:
+            The outcome of each assignment, in the order of the input
+        """
+        rows = (
+            {
+                **assignment,
+                **(
+                    {"duedate": utils.parse_utc(assignment["duedate"])}
+                    if "duedate" in assignment
+                    else {}
+                ),
+                "id": new_uuid(),
+                "course_id": self.course_id,
+            }
+            for assignment in assignments
+        )
+        return self._bulk_upsert(
+            Assignment.__table__,
+            "name",
+            rows,
+            ("id", "name", "course_id"),
+            chunk_size=chunk_size,
+        )
+
+    def _bulk_upsert(
+        self,
+        table: Table,
+        key: str,
+        rows: Iterable[Dict[str, Any]],
+        fixed_columns: Tuple[str, ...],
+        chunk_size: int,
+    ) -> List[UpsertResult]:
+        # rows are written when the chunk is full, or before a row whose key is already
+        # in the chunk or whose columns differ, as a statement takes a key once and the
+        # same columns for all its rows
+        results: List[Optional[UpsertResult]] = []
+        chunk: Dict[str, Tuple[int, Dict[str, Any]]] = {}
+        with PooledGradebook(self.db_url, course_id=self.course_id) as gb:
+            for row in rows:
+                row_key = row.get(key)
+                unknown = set(row) - set(table.c.keys())
+                if not row_key or unknown:
+                    error = f"unknown columns {sorted(unknown)}" if unknown else None
+                    results.append(
+                        UpsertResult(row_key, UpsertOutcome.invalid, error or "no key")
+                    )
+                    continue
+                if chunk:
+                    _, first_row = next(iter(chunk.values()))
+                    if row_key in chunk or set(row) != set(first_row):
+                        self._write_chunk(gb, table, key, chunk, fixed_columns, results)
+                chunk[row_key] = (len(results), row)
+                results.append(None)
+                if len(chunk) >= chunk_size:
+                    self._write_chunk(gb, table, key, chunk, fixed_columns, results)
+            self._write_chunk(gb, table, key, chunk, fixed_columns, results)
+        for outcome, count in Counter(result.outcome for result in results).items():
+            NBGRADER_DB_UPSERT_ROWS_TOTAL.labels(table=table.name, outcome=outcome).inc(
+                count
+            )
+        return results
+
+    def _write_chunk(
+        self,
+        gb: Gradebook,
+        table: Table,
+        key: str,
+        chunk: Dict[str, Tuple[int, Dict[str, Any]]],
+        fixed_columns: Tuple[str, ...],
+        results: List[Optional[UpsertResult]],
+    ) -> None:
+        if not chunk:
+            return
+        rows = [row for _, row in chunk.values()]
+        update_columns = [column for column in rows[0] if column not in fixed_columns]
+        error = None
+        try:
+            outcomes = upsert_rows(gb.db.connection(), table, key, rows, update_columns)
+            gb.db.commit()
+        except SQLAlchemyError as e:
+            gb.db.rollback()
+            logger.error("Error writing %s rows to %s: %s" % (len(rows), table.name, e))
+            outcomes = {}
+            error = str(e)
+        for row_key, (index, _) in chunk.items():
+            results[index] = UpsertResult(
+                row_key, outcomes.get(row_key, UpsertOutcome.failed), error
+            )
+        logger.debug("Wrote %s rows to %s" % (len(rows), table.name))
+        chunk.clear()
+
     def update_course(self, **kwargs) -> None:
         """
         Updates the course in nbgrader database
         """
-        with Gradebook(self.db_url, course_id=self.course_id) as gb:
+        with PooledGradebook(self.db_url, course_id=self.course_id) as gb:
             gb.update_course(self.course_id, **kwargs)
 
     def get_course(self) -> Course:
         """
         Gets the course model instance
         """
-        with Gradebook(self.db_url, course_id=self.course_id) as gb:
+        with PooledGradebook(self.db_url, course_id=self.course_id) as gb:
             course = gb.check_course(self.course_id)
             logger.debug(f"course got from db:{course}")
             return course
@@ -131,10 +952,186 @@ class NbGraderServiceHelper:
             "Assignment name normalized %s to save in gradebook" % assignment_name
         )
         assignment = None
-        with Gradebook(self.db_url, course_id=self.course_id) as gb:
+        with PooledGradebook(self.db_url, course_id=self.course_id) as gb:
             try:
                 assignment = gb.update_or_create_assignment(assignment_name, **kwargs)
                 logger.debug("Added assignment %s to gradebook" % assignment_name)
             except InvalidEntry as e:
                 logger.debug("Error ocurred by adding assignment to gradebook: %s" % e)
         return assignment
+
+
+class GradebookExecutor:
+    """
+    Runs the blocking gradebook operations (Postgres I/O through SQLAlchemy) in a bounded
+    thread pool, so they do not block JupyterHub's event loop. Operations for the same
+    course run one at a time, in the order they were submitted, to avoid write conflicts
+    within the course's gradebook; operations for different courses run concurrently.
+
+    Attributes:
+      max_workers: maximum number of threads used to run the operations
+    """
+
+    def __init__(self, max_workers: int = NBGRADER_GRADEBOOK_WORKERS):
+        if max_workers <= 0:
+            raise ValueError("max_workers must be greater than zero")
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="gradebook"
+        )
+        # operations only leave the queue when a thread is free, so the queued metric
+        # reflects the real backlog
+        self._slots = asyncio.Semaphore(max_workers)
+        # locks are dropped once no operation for the course is waiting or running
+        self._course_locks: weakref.WeakValueDictionary = weakref.WeakValueDictionary()
+
+    async def run(
+        self, course_id: str, func: Callable[..., Any], *args, **kwargs
+    ) -> Any:
+        """
+        Runs a blocking function in the thread pool, serialized per course.
+
+        Args:
+          course_id: the normalized course id
+          func: the blocking function
+          args, kwargs: the function's arguments
+
+        Returns:
+          The value returned by the function
+        """
+        operation = getattr(func, "__name__", "unknown")
+        lock = self._course_locks.get(course_id)
+        if lock is None:
+            lock = self._course_locks[course_id] = asyncio.Lock()
+        GRADEBOOK_TASKS.labels(state=GradebookTaskState.queued).inc()
+        queued = True
+        try:
+            async with lock, self._slots:
+                GRADEBOOK_TASKS.labels(state=GradebookTaskState.queued).dec()
+                GRADEBOOK_TASKS.labels(state=GradebookTaskState.running).inc()
+                queued = False
+                start = time.perf_counter()
+                status = "success"
+                try:
+                    return await asyncio.get_running_loop().run_in_executor(
+                        self._executor, functools.partial(func, *args, **kwargs)
+                    )
+                except Exception:
+                    status = "failure"
+                    raise
+                finally:
+                    GRADEBOOK_TASK_DURATION_SECONDS.labels(
+                        operation=operation, status=status
+                    ).observe(time.perf_counter() - start)
+                    GRADEBOOK_TASKS.labels(state=GradebookTaskState.running).dec()
+        finally:
+            if queued:
+                # cancelled while waiting for the course or for a free thread
+                GRADEBOOK_TASKS.labels(state=GradebookTaskState.queued).dec()
+
+    def shutdown(self, wait: bool = True) -> None:
+        self._executor.shutdown(wait=wait)
+
+
+_gradebook_executor: Optional[GradebookExecutor] = None
+
+
+def get_gradebook_executor() -> GradebookExecutor:
+    """
+    Returns the process-wide gradebook executor configured with the
+    NBGRADER_GRADEBOOK_WORKERS env var.
+    """
+    global _gradebook_executor
+    if _gradebook_executor is None:
+        _gradebook_executor = GradebookExecutor()
+    return _gradebook_executor
+
+
+class AsyncNbGraderServiceHelper:
+    """
+    Async facade for NbGraderServiceHelper used from JupyterHub's event loop (authenticators
+    and post auth hooks). The gradebook operations run in the GradebookExecutor.
+
+    Attrs:
+      helper: the wrapped NbGraderServiceHelper
+      course_id: the normalized course id
+    """
+
+    def __init__(self, course_id: str, executor: GradebookExecutor = None):
+        # the database is created with create_database_if_not_exists, which is awaitable
+        self.helper = NbGraderServiceHelper(course_id)
+        self.course_id = self.helper.course_id
+        self.executor = executor or get_gradebook_executor()
+
+    async def create_database_if_not_exists(self) -> None:
+        """Creates a new database if it doesn't exist"""
+        await self.executor.run(
+            self.course_id, self.helper.create_database_if_not_exists
+        )
+
+    async def add_user_to_nbgrader_gradebook(
+        self, username: str, lms_user_id: str
+    ) -> None:
+        """Adds a user to the nbgrader gradebook database for the course."""
+        await self.executor.run(
+            self.course_id,
+            self.helper.add_user_to_nbgrader_gradebook,
+            username,
+            lms_user_id,
+        )
+
+    async def add_users_to_nbgrader_gradebook(
+        self, users: Iterable[Tuple[str, str]]
+    ) -> List[str]:
+        """Adds users to the nbgrader gradebook database for the course."""
+        return await self.executor.run(
+            self.course_id, self.helper.add_users_to_nbgrader_gradebook, list(users)
+        )
+
+    async def bulk_upsert_students(
+        self, students: Iterable[Dict[str, Any]], **kwargs
+    ) -> List[UpsertResult]:
+        """Adds or updates students in the nbgrader gradebook database for the course."""
+        return await self.executor.run(
+            self.course_id, self.helper.bulk_upsert_students, students, **kwargs
+        )
+
+    async def bulk_upsert_assignments(
+        self, assignments: Iterable[Dict[str, Any]], **kwargs
+    ) -> List[UpsertResult]:
+        """Adds or updates assignments in the nbgrader gradebook database for the course."""
+        return await self.executor.run(
+            self.course_id, self.helper.bulk_upsert_assignments, assignments, **kwargs
+        )
+
+    async def update_course(self, **kwargs) -> None:
+        """Updates the course in nbgrader database"""
+        await self.executor.run(self.course_id, self.helper.update_course, **kwargs)
+
+    async def get_course(self) -> Course:
+        """Gets the course model instance"""
+        return await self.executor.run(self.course_id, self.helper.get_course)
+
+    async def register_assignment(
+        self, assignment_name: str, **kwargs: dict
+    ) -> Assignment:
+        """Adds an assignment to nbgrader database"""
+        return await self.executor.run(
+            self.course_id, self.helper.register_assignment, assignment_name, **kwargs
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Creates the nbgrader template database set with NBGRADER_DB_TEMPLATE "
+        "or upgrades its schema to the installed nbgrader version"
+    )
+    parser.parse_args()
+    if not NBGRADER_DB_TEMPLATE:
+        raise SystemExit("NBGRADER_DB_TEMPLATE env-var is not set")
+    logging.basicConfig(level=logging.INFO)
+    get_gradebook_database_catalog().prepare_template()
+
+
+if __name__ == "__main__":
+    main()
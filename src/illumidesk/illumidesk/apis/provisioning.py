@@ -0,0 +1,683 @@
+import asyncio
+import functools
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from enum import Enum
+from typing import Any
+from typing import Awaitable
+from typing import Callable
+from typing import Dict
+from typing import NamedTuple
+from typing import Optional
+from typing import Set
+from typing import Tuple
+from typing import TypeVar
+from urllib.parse import urlparse
+
+from sqlalchemy import create_engine
+from sqlalchemy import text
+
+from illumidesk.metrics import PROVISIONING_SINGLE_FLIGHT_CALLS_TOTAL
+from illumidesk.metrics import PROVISIONING_STEP_DURATION_SECONDS
+from illumidesk.metrics import SingleFlightRole
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+# seconds a completed provisioning step is trusted before running it again
+PROVISIONING_LEDGER_TTL = int(os.environ.get("PROVISIONING_LEDGER_TTL") or 3600)
+# backend used to remember completed steps, memory:// (default) or sqlite:///<path>
+PROVISIONING_LEDGER_URL = os.environ.get("PROVISIONING_LEDGER_URL") or "memory://"
+# database used to lock provisioning operations across hub replicas, postgresql://...
+# (disabled by default, operations are only coalesced within the hub process)
+PROVISIONING_LOCK_URL = os.environ.get("PROVISIONING_LOCK_URL") or ""
+# seconds a hub replica waits for the lock before running the operation anyway
+PROVISIONING_LOCK_TIMEOUT = float(os.environ.get("PROVISIONING_LOCK_TIMEOUT") or 30)
+
+T = TypeVar("T")
+
+
+def step_key(key: Tuple[str, str], step: str) -> Tuple[str, str]:
+    """
+    Key of a single step within a course, enrollment or assignment setup.
+    """
+    return (key[0], f"{key[1]}:{step}")
+
+
+def course_key(course_id: str) -> Tuple[str, str]:
+    """
+    Key of the course level setup (grader notebook service).
+    """
+    return (course_id, f"course:{course_id}")
+
+
+def enrollment_key(
+    course_id: str, username: str, user_role: str, lms_user_id: str
+) -> Tuple[str, str]:
+    """
+    Key of the user level setup within a course (gradebook student and jupyterhub
+    group membership). A change in the role or lms user id runs the setup again.
+    """
+    return (
+        course_id,
+        f"enrollment:{course_id}:{username}:{user_role}:{lms_user_id}",
+    )
+
+
+def assignment_key(course_id: str, assignment_name: str) -> Tuple[str, str]:
+    """
+    Key of the assignment setup (gradebook assignment and source directory).
+    """
+    return (course_id, f"assignment:{course_id}:{assignment_name}")
+
+
+class ProvisioningLedger:
+    """
+    Base class for the ledgers that remember the provisioning steps completed for
+    courses, enrollments and assignments, so repeated launches can skip them. Entries
+    expire after a time window (ttl) and can be invalidated explicitly, for example
+    when a course is removed.
+
+    Keys are (course_id, key) tuples built with course_key, enrollment_key and
+    assignment_key.
+
+    Attributes:
+      ttl: seconds that a completed step is remembered
+    """
+
+    def __init__(self, ttl: int = PROVISIONING_LEDGER_TTL):
+        if ttl <= 0:
+            raise ValueError("ttl must be greater than zero")
+        self.ttl = ttl
+
+    async def is_done(self, key: Tuple[str, str], now: float = None) -> bool:
+        """
+        Returns True if the step was completed within the time window.
+        """
+        raise NotImplementedError()
+
+    async def mark_done(
+        self, key: Tuple[str, str], now: float = None, expires: bool = True
+    ) -> None:
+        """
+        Registers a completed step. With expires=False the step is remembered until it is
+        invalidated, regardless of the ttl.
+        """
+        raise NotImplementedError()
+
+    async def invalidate(self, key: Tuple[str, str]) -> None:
+        """
+        Forgets a completed step, so it runs again with the next launch.
+        """
+        raise NotImplementedError()
+
+    async def invalidate_course(self, course_id: str) -> None:
+        """
+        Forgets all the completed steps of a course.
+        """
+        raise NotImplementedError()
+
+    def clear(self) -> None:
+        """Removes all the entries"""
+        raise NotImplementedError()
+
+
+class MemoryProvisioningLedger(ProvisioningLedger):
+    """
+    In-process ledger. The least recently used entries are dropped when the ledger
+    holds more than max_entries.
+
+    Attributes:
+      ttl: seconds that a completed step is remembered
+      max_entries: maximum number of steps remembered
+    """
+
+    def __init__(self, ttl: int = PROVISIONING_LEDGER_TTL, max_entries: int = 100000):
+        super().__init__(ttl)
+        if max_entries <= 0:
+            raise ValueError("max_entries must be greater than zero")
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[Tuple[str, str], float]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    async def is_done(self, key: Tuple[str, str], now: float = None) -> bool:
+        now = now if now is not None else time.time()
+        with self._lock:
+            expires_at = self._entries.get(key)
+            if expires_at is None:
+                return False
+            if expires_at <= now:
+                del self._entries[key]
+                return False
+            self._entries.move_to_end(key)
+            return True
+
+    async def mark_done(
+        self, key: Tuple[str, str], now: float = None, expires: bool = True
+    ) -> None:
+        now = now if now is not None else time.time()
+        with self._lock:
+            self._entries[key] = now + self.ttl if expires else float("inf")
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    async def invalidate(self, key: Tuple[str, str]) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    async def invalidate_course(self, course_id: str) -> None:
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == course_id]:
+                del self._entries[key]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+class SQLiteProvisioningLedger(ProvisioningLedger):
+    """
+    Ledger backed by a SQLite file, which survives hub restarts and can be shared by
+    hub replicas running on the same host or sharing a volume. The SQLite queries run in
+    a single dedicated thread, so a locked database does not block the event loop.
+
+    Attributes:
+      ttl: seconds that a completed step is remembered
+      path: the sqlite database file
+    """
+
+    def __init__(self, path: str, ttl: int = PROVISIONING_LEDGER_TTL):
+        super().__init__(ttl)
+        self.path = path
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="provisioning-ledger"
+        )
+        self._conn = sqlite3.connect(path, timeout=5, check_same_thread=False)
+        with self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS provisioning_ledger "
+                "(key TEXT PRIMARY KEY, course_id TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS provisioning_ledger_course_id "
+                "ON provisioning_ledger (course_id)"
+            )
+
+    async def _run_in_executor(self, func: Callable[..., Any], *args, **kwargs) -> Any:
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, functools.partial(func, *args, **kwargs)
+        )
+
+    async def is_done(self, key: Tuple[str, str], now: float = None) -> bool:
+        return await self._run_in_executor(self._is_done, key, now)
+
+    def _is_done(self, key: Tuple[str, str], now: float = None) -> bool:
+        now = now if now is not None else time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT expires_at FROM provisioning_ledger WHERE key = ?", (key[1],)
+            ).fetchone()
+        return row is not None and row[0] > now
+
+    async def mark_done(
+        self, key: Tuple[str, str], now: float = None, expires: bool = True
+    ) -> None:
+        await self._run_in_executor(self._mark_done, key, now, expires)
+
+    def _mark_done(
+        self, key: Tuple[str, str], now: float = None, expires: bool = True
+    ) -> None:
+        now = now if now is not None else time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO provisioning_ledger (key, course_id, expires_at) "
+                "VALUES (?, ?, ?)",
+                (key[1], key[0], now + self.ttl if expires else float("inf")),
+            )
+
+    async def invalidate(self, key: Tuple[str, str]) -> None:
+        await self._run_in_executor(self._invalidate, key)
+
+    def _invalidate(self, key: Tuple[str, str]) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(
+                "DELETE FROM provisioning_ledger WHERE key = ?", (key[1],)
+            )
+
+    async def invalidate_course(self, course_id: str) -> None:
+        await self._run_in_executor(self._invalidate_course, course_id)
+
+    def _invalidate_course(self, course_id: str) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(
+                "DELETE FROM provisioning_ledger WHERE course_id = ?", (course_id,)
+            )
+
+    def clear(self) -> None:
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM provisioning_ledger")
+
+
+def create_provisioning_ledger(
+    url: str, ttl: int = PROVISIONING_LEDGER_TTL
+) -> ProvisioningLedger:
+    """
+    Creates a provisioning ledger from a url with the format memory:// or
+    sqlite:///<path>.
+    """
+    scheme = urlparse(url).scheme
+    if scheme in ("", "memory"):
+        return MemoryProvisioningLedger(ttl)
+    if scheme == "sqlite":
+        # same format as sqlalchemy, sqlite:///relative.db or sqlite:////absolute.db
+        path = url[len("sqlite:///") :] if url.startswith("sqlite:///") else ""
+        if not path:
+            raise ValueError("sqlite provisioning ledger requires a file path")
+        return SQLiteProvisioningLedger(path, ttl)
+    raise ValueError(f"Unsupported provisioning ledger url {url}")
+
+
+_provisioning_ledger: Optional[ProvisioningLedger] = None
+
+
+def get_provisioning_ledger() -> ProvisioningLedger:
+    """
+    Returns the process-wide provisioning ledger configured with the
+    PROVISIONING_LEDGER_URL env var.
+    """
+    global _provisioning_ledger
+    if _provisioning_ledger is None:
+        _provisioning_ledger = create_provisioning_ledger(PROVISIONING_LEDGER_URL)
+        logger.debug(
+            "Using provisioning ledger %s" % type(_provisioning_ledger).__name__
+        )
+    return _provisioning_ledger
+
+
+class StepFailurePolicy(Enum):
+    """
+    What a launch does when a provisioning step fails or misses its deadline
+
+    block: the launch waits for the step and fails if the step fails
+    warn: the launch waits for the step up to its deadline and logs the failure
+    defer: the step runs in the background and the launch does not wait for it
+    """
+
+    block = "block"
+    warn = "warn"
+    defer = "defer"
+
+    def __str__(self):
+        return self.value
+
+
+class ProvisioningStep(NamedTuple):
+    """
+    A provisioning step with its deadline (in seconds) and failure policy.
+    """
+
+    name: str
+    timeout: float
+    policy: StepFailurePolicy
+
+
+class StepTiming(NamedTuple):
+    """
+    The outcome of a provisioning step: success, failure, error, timeout or deferred.
+    """
+
+    status: str
+    seconds: float
+
+
+class ProvisioningError(Exception):
+    """Raised when a provisioning step with the block policy does not succeed"""
+
+    pass
+
+
+def get_provisioning_step(
+    name: str,
+    default_timeout: float = 10,
+    default_policy: StepFailurePolicy = StepFailurePolicy.warn,
+) -> ProvisioningStep:
+    """
+    Returns the step configured with the SETUP_COURSE_<NAME>_TIMEOUT and
+    SETUP_COURSE_<NAME>_POLICY env vars.
+    """
+    prefix = f"SETUP_COURSE_{name.upper()}"
+    timeout = float(os.environ.get(f"{prefix}_TIMEOUT") or default_timeout)
+    policy = StepFailurePolicy(
+        os.environ.get(f"{prefix}_POLICY") or default_policy.value
+    )
+    return ProvisioningStep(name, timeout, policy)
+
+
+# provisioning steps run with each launch, configured with the SETUP_COURSE_<STEP>_TIMEOUT
+# and SETUP_COURSE_<STEP>_POLICY env vars. The launch fails by default if the user is not
+# registered in the gradebook, the grades sent back to the LMS need the user's lms_user_id
+GRADEBOOK_STEP = get_provisioning_step(
+    "gradebook", default_policy=StepFailurePolicy.block
+)
+GROUP_STEP = get_provisioning_step("group")
+GRADER_SERVICE_STEP = get_provisioning_step("grader_service")
+
+
+# steps that keep running after the launch stopped waiting for them
+_background_steps: Set[asyncio.Future] = set()
+
+
+async def _run_step(
+    step: ProvisioningStep, func: Callable[[], Awaitable[bool]]
+) -> StepTiming:
+    start = time.perf_counter()
+    status = "failure"
+    try:
+        if await func():
+            status = "success"
+    except Exception as e:
+        status = "error"
+        logger.error("Provisioning step %s failed with exception %s" % (step.name, e))
+    seconds = time.perf_counter() - start
+    PROVISIONING_STEP_DURATION_SECONDS.labels(step=step.name, status=status).observe(
+        seconds
+    )
+    return StepTiming(status, seconds)
+
+
+def _run_in_background(task: asyncio.Future) -> None:
+    _background_steps.add(task)
+    task.add_done_callback(_background_steps.discard)
+
+
+async def run_provisioning_steps(
+    steps: Dict[ProvisioningStep, Callable[[], Awaitable[bool]]],
+    description: str = "",
+    wait_all: bool = False,
+) -> Dict[str, StepTiming]:
+    """
+    Runs independent provisioning steps concurrently. The launch waits for each step up
+    to its deadline, except for deferred steps, and steps that miss their deadline keep
+    running in the background. A timing breakdown is logged with every launch.
+
+    Args:
+      steps: the coroutine functions indexed by step, they return True if the step succeeded
+      description: text added to the timing breakdown log, such as the course and user
+      wait_all: wait for every step to finish, regardless of its deadline and policy, so
+        the timings hold the steps' outcome (used by the jobs that no launch waits for)
+
+    Returns:
+      The StepTiming of each step indexed by name
+
+    Raises:
+      ProvisioningError if a step with the block policy fails or misses its deadline
+    """
+    start = time.perf_counter()
+    tasks = {
+        step: asyncio.ensure_future(_run_step(step, func))
+        for step, func in steps.items()
+    }
+
+    async def wait(step: ProvisioningStep, task: asyncio.Future) -> StepTiming:
+        if wait_all:
+            return await task
+        try:
+            return await asyncio.wait_for(asyncio.shield(task), step.timeout)
+        except asyncio.TimeoutError:
+            _run_in_background(task)
+            return StepTiming("timeout", step.timeout)
+
+    timings: Dict[str, StepTiming] = {}
+    waited = [
+        step for step in tasks if wait_all or step.policy is not StepFailurePolicy.defer
+    ]
+    for step, timing in zip(
+        waited, await asyncio.gather(*[wait(step, tasks[step]) for step in waited])
+    ):
+        timings[step.name] = timing
+    for step, task in tasks.items():
+        if step not in waited:
+            _run_in_background(task)
+            timings[step.name] = StepTiming("deferred", 0.0)
+
+    if timings:
+        critical_path = max(timings, key=lambda name: timings[name].seconds)
+        logger.info(
+            "Provisioning %s took %.3fs (critical path: %s): %s"
+            % (
+                description,
+                time.perf_counter() - start,
+                critical_path,
+                ", ".join(
+                    f"{name}={timing.status}/{timing.seconds:.3f}s"
+                    for name, timing in timings.items()
+                ),
+            )
+        )
+    for step in waited:
+        timing = timings[step.name]
+        if timing.status != "success":
+            if step.policy is StepFailurePolicy.block:
+                raise ProvisioningError(
+                    f"Provisioning step {step.name} did not succeed: {timing.status}"
+                )
+            logger.warning(
+                "Provisioning step %s did not succeed: %s" % (step.name, timing.status)
+            )
+    return timings
+
+
+class ProvisioningLock:
+    """
+    Base class for the locks shared by hub replicas, so a provisioning operation for a
+    course and step runs in one replica at a time.
+
+    Attributes:
+      timeout: seconds to wait for a lock
+    """
+
+    def __init__(self, timeout: float = PROVISIONING_LOCK_TIMEOUT):
+        self.timeout = timeout
+
+    async def acquire(self, key: str) -> bool:
+        """
+        Waits for the lock up to the timeout. Returns False if the lock was not acquired.
+        """
+        raise NotImplementedError()
+
+    async def release(self, key: str) -> None:
+        """
+        Releases a lock acquired by this process.
+        """
+        raise NotImplementedError()
+
+
+class PostgresProvisioningLock(ProvisioningLock):
+    """
+    Lock backed by postgres session level advisory locks, usually on the server that hosts
+    the gradebook databases. Each held lock keeps a connection checked out of the pool,
+    so the lock is released by the server if the hub dies while holding it.
+
+    Attributes:
+      timeout: seconds to wait for a lock
+      poll_interval: seconds between attempts to acquire a lock held by another replica
+    """
+
+    def __init__(
+        self,
+        url: str,
+        timeout: float = PROVISIONING_LOCK_TIMEOUT,
+        poll_interval: float = 0.1,
+    ):
+        super().__init__(timeout)
+        self.poll_interval = poll_interval
+        self._engine = create_engine(url, pool_pre_ping=True)
+        self._connections: Dict[str, Any] = {}
+
+    @staticmethod
+    def lock_id(key: str) -> int:
+        """
+        Returns the advisory lock id of a key, a signed 64 bit integer.
+        """
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest()
+        return int.from_bytes(digest, "big", signed=True)
+
+    async def acquire(self, key: str) -> bool:
+        loop = asyncio.get_running_loop()
+        lock_id = self.lock_id(key)
+        conn = await loop.run_in_executor(None, self._engine.connect)
+        deadline = time.monotonic() + self.timeout
+        try:
+            while True:
+                acquired = await loop.run_in_executor(
+                    None,
+                    lambda: conn.execute(
+                        text("SELECT pg_try_advisory_lock(:lock_id)"),
+                        {"lock_id": lock_id},
+                    ).scalar(),
+                )
+                if acquired:
+                    self._connections[key] = conn
+                    return True
+                if time.monotonic() >= deadline:
+                    return False
+                await asyncio.sleep(self.poll_interval)
+        finally:
+            if key not in self._connections:
+                conn.close()
+
+    async def release(self, key: str) -> None:
+        conn = self._connections.pop(key, None)
+        if conn is None:
+            return
+
+        def unlock() -> None:
+            try:
+                conn.execute(
+                    text("SELECT pg_advisory_unlock(:lock_id)"),
+                    {"lock_id": self.lock_id(key)},
+                )
+            finally:
+                conn.close()
+
+        await asyncio.get_running_loop().run_in_executor(None, unlock)
+
+
+def create_provisioning_lock(
+    url: str, timeout: float = PROVISIONING_LOCK_TIMEOUT
+) -> Optional[ProvisioningLock]:
+    """
+    Creates the lock shared by hub replicas from a postgresql:// url, or returns None
+    with an empty url.
+    """
+    if not url:
+        return None
+    scheme = urlparse(url).scheme
+    if scheme.startswith("postgres"):
+        return PostgresProvisioningLock(url, timeout)
+    raise ValueError(f"Unsupported provisioning lock url {url}")
+
+
+class SingleFlight:
+    """
+    Runs at most one provisioning operation per course and step at a time. Callers that
+    arrive while the operation is running await its outcome instead of running it again,
+    so a burst of first launches creates the course's gradebook database, groups and
+    grader service once. With a ProvisioningLock the operation is also serialized across
+    hub replicas.
+
+    Attributes:
+      lock: the lock shared by the hub replicas or None
+    """
+
+    def __init__(self, lock: Optional[ProvisioningLock] = None):
+        self.lock = lock
+        self._flights: Dict[Tuple[str, str], asyncio.Future] = {}
+
+    def __len__(self) -> int:
+        return len(self._flights)
+
+    async def run(
+        self, course_id: str, step: str, func: Callable[[], Awaitable[T]]
+    ) -> T:
+        """
+        Runs the operation, or awaits the running operation for the same course and step.
+
+        Args:
+          course_id: the normalized course id
+          step: the operation within the course, qualifiers such as an assignment name
+            follow a colon (assignment:<name>)
+          func: the coroutine function that runs the operation
+
+        Returns:
+          The result of the operation, exceptions are raised to every caller
+        """
+        key = (course_id, step)
+        label = step.split(":", 1)[0]
+        flight = self._flights.get(key)
+        if flight is None:
+            PROVISIONING_SINGLE_FLIGHT_CALLS_TOTAL.labels(
+                step=label, role=SingleFlightRole.leader
+            ).inc()
+            flight = asyncio.ensure_future(self._run(key, func))
+            self._flights[key] = flight
+            flight.add_done_callback(lambda done: self._finish(key, done))
+        else:
+            PROVISIONING_SINGLE_FLIGHT_CALLS_TOTAL.labels(
+                step=label, role=SingleFlightRole.follower
+            ).inc()
+        # callers that stop waiting (deadlines) do not cancel the operation for the rest
+        return await asyncio.shield(flight)
+
+    def _finish(self, key: Tuple[str, str], flight: asyncio.Future) -> None:
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+        # the outcome is retrieved here in case all the callers stopped waiting
+        if not flight.cancelled():
+            flight.exception()
+
+    async def _run(self, key: Tuple[str, str], func: Callable[[], Awaitable[T]]) -> T:
+        if self.lock is None:
+            return await func()
+        lock_key = f"{key[0]}:{key[1]}"
+        try:
+            acquired = await self.lock.acquire(lock_key)
+        except Exception as e:
+            acquired = False
+            logger.error("Error acquiring provisioning lock %s: %s" % (lock_key, e))
+        if not acquired:
+            logger.warning(
+                "Running provisioning operation %s without the lock" % lock_key
+            )
+        try:
+            return await func()
+        finally:
+            if acquired:
+                await self.lock.release(lock_key)
+
+
+_single_flight: Optional[SingleFlight] = None
+
+
+def get_single_flight() -> SingleFlight:
+    """
+    Returns the process-wide SingleFlight, which uses the lock configured with the
+    PROVISIONING_LOCK_URL env var.
+    """
+    global _single_flight
+    if _single_flight is None:
+        _single_flight = SingleFlight(create_provisioning_lock(PROVISIONING_LOCK_URL))
+    return _single_flight
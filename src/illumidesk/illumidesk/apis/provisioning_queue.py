@@ -0,0 +1,436 @@
+import asyncio
+import functools
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+from typing import Awaitable
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+# when enabled the setup hooks enqueue the course setup and return immediately
+PROVISIONING_QUEUE_ENABLED = (
+    os.environ.get("PROVISIONING_QUEUE_ENABLED") or "false"
+).lower() in ("1", "true", "yes")
+# backend used to persist the jobs, sqlite:////<absolute path> or memory://, required
+# when the queue is enabled
+PROVISIONING_QUEUE_URL = os.environ.get("PROVISIONING_QUEUE_URL") or ""
+if PROVISIONING_QUEUE_ENABLED and not PROVISIONING_QUEUE_URL:
+    raise EnvironmentError(
+        "PROVISIONING_QUEUE_URL env-var is required with PROVISIONING_QUEUE_ENABLED"
+    )
+# number of workers draining the queue within the hub process
+PROVISIONING_QUEUE_WORKERS = int(os.environ.get("PROVISIONING_QUEUE_WORKERS") or 2)
+# attempts before a job is marked as failed
+PROVISIONING_QUEUE_MAX_ATTEMPTS = int(
+    os.environ.get("PROVISIONING_QUEUE_MAX_ATTEMPTS") or 5
+)
+# seconds the finished (done or failed) jobs are kept for the status endpoint
+PROVISIONING_QUEUE_RETENTION = int(
+    os.environ.get("PROVISIONING_QUEUE_RETENTION") or 604800
+)
+
+# job status values
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+# coroutine functions that run the jobs indexed by kind, they return True on success
+_job_handlers: Dict[str, Callable[[Dict[str, Any]], Awaitable[bool]]] = {}
+
+
+def register_job_handler(
+    kind: str, handler: Callable[[Dict[str, Any]], Awaitable[bool]]
+) -> None:
+    """
+    Registers the coroutine function that runs the jobs of a kind. The function receives
+    the job's payload and returns True if the job succeeded.
+    """
+    _job_handlers[kind] = handler
+
+
+class ProvisioningQueue:
+    """
+    Durable queue of provisioning jobs (course setup, assignment setup, etc.) backed by
+    SQLite, drained by workers running within the hub's event loop. The SQLite queries run
+    in a single dedicated thread, so they do not block the event loop. Jobs are enqueued with
+    an idempotency key: enqueuing a job with the key of a pending or running job returns
+    the existing job instead of adding a new one. Failed jobs are retried with exponential
+    backoff up to max_attempts, and jobs left running by a hub restart run again. The
+    workers remove the jobs that finished more than `retention` seconds ago.
+
+    Attributes:
+      path: the sqlite database file, or :memory:
+      workers: number of workers started with start or the first enqueued job, zero to
+        drain the queue only with run_pending
+      max_attempts: attempts before a job is marked as failed
+      poll_interval: seconds between checks for jobs waiting for a retry
+      retention: seconds the finished jobs are kept
+    """
+
+    max_backoff = 300
+    # seconds between removals of the expired jobs
+    purge_interval = 3600
+
+    def __init__(
+        self,
+        path: str,
+        workers: int = PROVISIONING_QUEUE_WORKERS,
+        max_attempts: int = PROVISIONING_QUEUE_MAX_ATTEMPTS,
+        poll_interval: float = 1.0,
+        retention: int = PROVISIONING_QUEUE_RETENTION,
+    ):
+        if max_attempts <= 0:
+            raise ValueError("max_attempts must be greater than zero")
+        if retention <= 0:
+            raise ValueError("retention must be greater than zero")
+        self.path = path
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self._purged_at = 0.0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="provisioning-queue"
+        )
+        self._tasks: List[asyncio.Task] = []
+        self._wakeup: Optional[asyncio.Event] = None
+        self._conn = sqlite3.connect(path, timeout=5, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._conn:
+            if path != ":memory:":
+                self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS provisioning_jobs ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "idempotency_key TEXT NOT NULL UNIQUE, "
+                "kind TEXT NOT NULL, "
+                "payload TEXT NOT NULL, "
+                "course_id TEXT, "
+                "username TEXT, "
+                "status TEXT NOT NULL, "
+                "attempts INTEGER NOT NULL DEFAULT 0, "
+                "next_run_at REAL NOT NULL, "
+                "last_error TEXT, "
+                "created_at REAL NOT NULL, "
+                "updated_at REAL NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS provisioning_jobs_status "
+                "ON provisioning_jobs (status, next_run_at)"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS provisioning_jobs_username "
+                "ON provisioning_jobs (username)"
+            )
+            # jobs interrupted by a restart run again
+            self._conn.execute(
+                "UPDATE provisioning_jobs SET status = ? WHERE status = ?",
+                (PENDING, RUNNING),
+            )
+
+    async def _run_in_executor(self, func: Callable[..., Any], *args, **kwargs) -> Any:
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, functools.partial(func, *args, **kwargs)
+        )
+
+    async def enqueue(
+        self,
+        kind: str,
+        payload: Dict[str, Any],
+        idempotency_key: str,
+        course_id: str = None,
+        username: str = None,
+    ) -> int:
+        """
+        Adds a job to the queue, or returns the pending or running job with the same
+        idempotency key. Finished jobs with the same key are queued again.
+
+        Returns:
+          The job id
+        """
+        job_id = await self._run_in_executor(
+            self._enqueue, kind, payload, idempotency_key, course_id, username
+        )
+        self.start()
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return job_id
+
+    def _enqueue(
+        self,
+        kind: str,
+        payload: Dict[str, Any],
+        idempotency_key: str,
+        course_id: str = None,
+        username: str = None,
+    ) -> int:
+        now = time.time()
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT id, status FROM provisioning_jobs WHERE idempotency_key = ?",
+                (idempotency_key,),
+            ).fetchone()
+            if row is None:
+                job_id = self._conn.execute(
+                    "INSERT INTO provisioning_jobs (idempotency_key, kind, payload, "
+                    "course_id, username, status, next_run_at, created_at, updated_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        idempotency_key,
+                        kind,
+                        json.dumps(payload),
+                        course_id,
+                        username,
+                        PENDING,
+                        now,
+                        now,
+                        now,
+                    ),
+                ).lastrowid
+            else:
+                job_id = row["id"]
+                if row["status"] in (DONE, FAILED):
+                    self._conn.execute(
+                        "UPDATE provisioning_jobs SET payload = ?, status = ?, "
+                        "attempts = 0, next_run_at = ?, last_error = NULL, "
+                        "updated_at = ? WHERE id = ?",
+                        (json.dumps(payload), PENDING, now, now, job_id),
+                    )
+        return job_id
+
+    async def get(self, job_id: int) -> Optional[Dict[str, Any]]:
+        """
+        Returns the job's status as a dict or None if the job does not exist.
+        """
+        return await self._run_in_executor(self._get, job_id)
+
+    def _get(self, job_id: int) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT * FROM provisioning_jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        return self._to_dict(row) if row else None
+
+    async def get_user_jobs(
+        self, username: str, course_id: str = None
+    ) -> List[Dict[str, Any]]:
+        """
+        Returns the status of the user's jobs and of the course's jobs that do not belong
+        to a user (such as assignments), most recent first.
+        """
+        return await self._run_in_executor(self._get_user_jobs, username, course_id)
+
+    def _get_user_jobs(
+        self, username: str, course_id: str = None
+    ) -> List[Dict[str, Any]]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT * FROM provisioning_jobs WHERE username = ? "
+                "OR (username IS NULL AND course_id = ?) ORDER BY updated_at DESC",
+                (username, course_id),
+            ).fetchall()
+        return [self._to_dict(row) for row in rows]
+
+    def close(self) -> None:
+        """Closes the database connection"""
+        self._executor.shutdown(wait=True)
+        self._conn.close()
+
+    def purge(self, now: float = None) -> int:
+        """
+        Removes the done and failed jobs not updated within the retention window.
+
+        Returns:
+          The number of jobs removed
+        """
+        now = now if now is not None else time.time()
+        with self._lock, self._conn:
+            return self._conn.execute(
+                "DELETE FROM provisioning_jobs WHERE status IN (?, ?) AND updated_at < ?",
+                (DONE, FAILED, now - self.retention),
+            ).rowcount
+
+    def clear(self) -> None:
+        """Removes all the jobs"""
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM provisioning_jobs")
+
+    async def run_pending(self) -> int:
+        """
+        Runs the jobs that are ready until there are none left, without the workers.
+
+        Returns:
+          The number of jobs run
+        """
+        count = 0
+        while await self._run_next():
+            count += 1
+        return count
+
+    def _claim(self) -> Optional[sqlite3.Row]:
+        now = time.time()
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT * FROM provisioning_jobs WHERE status = ? AND next_run_at <= ? "
+                "ORDER BY next_run_at LIMIT 1",
+                (PENDING, now),
+            ).fetchone()
+            if row is not None:
+                self._conn.execute(
+                    "UPDATE provisioning_jobs SET status = ?, attempts = attempts + 1, "
+                    "updated_at = ? WHERE id = ?",
+                    (RUNNING, now, row["id"]),
+                )
+        return row
+
+    def _finish(self, job_id: int, attempts: int, error: str = None) -> None:
+        now = time.time()
+        if error is None:
+            status, next_run_at = DONE, now
+        elif attempts >= self.max_attempts:
+            status, next_run_at = FAILED, now
+        else:
+            status = PENDING
+            next_run_at = now + min(2 ** attempts, self.max_backoff)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE provisioning_jobs SET status = ?, next_run_at = ?, "
+                "last_error = ?, updated_at = ? WHERE id = ?",
+                (status, next_run_at, error, now, job_id),
+            )
+        if status == FAILED:
+            logger.error(
+                "Provisioning job %s failed after %s attempts: %s"
+                % (job_id, attempts, error)
+            )
+
+    async def _run_next(self) -> bool:
+        row = await self._run_in_executor(self._claim)
+        if row is None:
+            return False
+        error = None
+        try:
+            handler = _job_handlers[row["kind"]]
+            if not await handler(json.loads(row["payload"])):
+                error = "job did not succeed"
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        await self._run_in_executor(self._finish, row["id"], row["attempts"] + 1, error)
+        return True
+
+    def start(self) -> None:
+        """
+        Starts the workers within the running event loop, if they were not started. The
+        workers run the pending jobs, including the jobs interrupted by a restart.
+        """
+        if self.workers <= 0 or self._tasks:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self._wakeup = asyncio.Event()
+        self._tasks = [loop.create_task(self._worker()) for _ in range(self.workers)]
+        logger.debug("Started %s provisioning queue workers" % self.workers)
+
+    async def _worker(self) -> None:
+        while True:
+            try:
+                if await self._run_next():
+                    continue
+                if time.time() - self._purged_at >= self.purge_interval:
+                    self._purged_at = time.time()
+                    purged = await self._run_in_executor(self.purge)
+                    logger.debug("Removed %s finished provisioning jobs" % purged)
+            except Exception as e:
+                logger.error("Provisioning queue worker error: %s" % e)
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def stop(self) -> None:
+        """Cancels the workers, running jobs run again with the next start"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def _to_dict(self, row: sqlite3.Row) -> Dict[str, Any]:
+        return {
+            "id": row["id"],
+            "kind": row["kind"],
+            "course_id": row["course_id"],
+            "status": row["status"],
+            "attempts": row["attempts"],
+            "last_error": row["last_error"],
+            "created_at": row["created_at"],
+            "updated_at": row["updated_at"],
+        }
+
+
+def create_provisioning_queue(url: str, **kwargs: Any) -> ProvisioningQueue:
+    """
+    Creates a provisioning queue from a url with the format sqlite:////<absolute path>
+    or memory://, which is not durable and intended for tests.
+    """
+    scheme = urlparse(url).scheme
+    if scheme == "memory":
+        return ProvisioningQueue(":memory:", **kwargs)
+    if scheme == "sqlite":
+        # same format as sqlalchemy, sqlite:////absolute.db; relative paths would depend
+        # on the directory the hub runs from
+        path = url[len("sqlite:///") :] if url.startswith("sqlite:///") else ""
+        if not os.path.isabs(path):
+            raise ValueError("sqlite provisioning queue requires an absolute file path")
+        return ProvisioningQueue(path, **kwargs)
+    raise ValueError(f"Unsupported provisioning queue url {url}")
+
+
+_provisioning_queue: Optional[ProvisioningQueue] = None
+
+
+def get_provisioning_queue() -> ProvisioningQueue:
+    """
+    Returns the process-wide provisioning queue configured with the
+    PROVISIONING_QUEUE_URL env var.
+    """
+    global _provisioning_queue
+    if _provisioning_queue is None:
+        if not PROVISIONING_QUEUE_URL:
+            raise EnvironmentError("PROVISIONING_QUEUE_URL env-var is not set")
+        _provisioning_queue = create_provisioning_queue(PROVISIONING_QUEUE_URL)
+    return _provisioning_queue
+
+
+def set_provisioning_queue(queue: Optional[ProvisioningQueue]) -> None:
+    """
+    Replaces the process-wide provisioning queue, None creates a new queue with the next
+    call to get_provisioning_queue.
+    """
+    global _provisioning_queue
+    _provisioning_queue = queue
+
+
+def start_provisioning_queue() -> None:
+    """
+    Starts the workers of the process-wide provisioning queue when the queue is enabled,
+    to be called within the hub's event loop once the hub starts.
+    """
+    if PROVISIONING_QUEUE_ENABLED:
+        get_provisioning_queue().start()
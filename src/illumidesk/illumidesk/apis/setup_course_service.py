@@ -1,5 +1,7 @@
+import json
 import logging
 import os
+from typing import List
 
 from tornado.httpclient import AsyncHTTPClient
 from tornado.httpclient import HTTPError
@@ -45,6 +47,31 @@ async def create_assignment_source_dir(
         return False
 
 
+async def create_assignment_source_dirs(
+    org_name: str, course_id: str, assignment_names: List[str]
+) -> bool:
+    """
+    Calls the grader setup service to create the source directories of several
+    assignments with a single request
+
+    returns: True when the service response is 200
+    """
+    client = AsyncHTTPClient()
+    try:
+        response = await client.fetch(
+            f"{SERVICE_BASE_URL}/courses/{org_name}/{course_id}",
+            headers=SERVICE_COMMON_HEADERS,
+            body=json.dumps({"assignments": assignment_names}),
+            method="POST",
+        )
+        logger.debug(f"Grader-setup service response: {response.body}")
+        return True
+    except HTTPError as e:
+        # HTTPError is raised for non-200 responses
+        logger.error(f"Grader-setup service returned an error: {e}")
+        return False
+
+
 async def register_new_service(org_name: str, course_id: str) -> bool:
     """
     Helps to register (asynchronously) new course definition through the grader setup service
@@ -1,21 +1,41 @@
+import functools
 import logging
 import os
 from typing import Any
 from typing import Dict
+from typing import Tuple
 
 from jupyterhub.auth import Authenticator
 from oauthenticator.oauth2 import OAuthenticator
+from tornado.ioloop import IOLoop
 from tornado.web import HTTPError
 from tornado.web import RequestHandler
 from traitlets import Unicode
 
-from illumidesk.apis.jupyterhub_api import JupyterHubAPI
-from illumidesk.apis.nbgrader_service import NbGraderServiceHelper
+from illumidesk.apis.jupyterhub_api import get_jupyterhub_api
+from illumidesk.apis.nbgrader_service import AsyncNbGraderServiceHelper
+from illumidesk.apis.provisioning import GRADEBOOK_STEP
+from illumidesk.apis.provisioning import GRADER_SERVICE_STEP
+from illumidesk.apis.provisioning import GROUP_STEP
+from illumidesk.apis.provisioning import ProvisioningError
+from illumidesk.apis.provisioning import StepTiming
+from illumidesk.apis.provisioning import assignment_key
+from illumidesk.apis.provisioning import course_key
+from illumidesk.apis.provisioning import enrollment_key
+from illumidesk.apis.provisioning import get_provisioning_ledger
+from illumidesk.apis.provisioning import get_single_flight
+from illumidesk.apis.provisioning import run_provisioning_steps
+from illumidesk.apis.provisioning import step_key
+from illumidesk.apis.provisioning_queue import PROVISIONING_QUEUE_ENABLED
+from illumidesk.apis.provisioning_queue import get_provisioning_queue
+from illumidesk.apis.provisioning_queue import register_job_handler
+from illumidesk.apis.provisioning_queue import start_provisioning_queue
 from illumidesk.apis.setup_course_service import create_assignment_source_dir
 from illumidesk.apis.setup_course_service import register_new_service
+from illumidesk.authenticators.claims import LaunchClaims
 from illumidesk.authenticators.handlers import LTI13CallbackHandler
 from illumidesk.authenticators.handlers import LTI13LoginHandler
-from illumidesk.authenticators.utils import LTIUtils
+from illumidesk.authenticators.utils import normalize_string
 from illumidesk.authenticators.utils import user_is_a_student
 from illumidesk.authenticators.utils import user_is_an_instructor
 from illumidesk.authenticators.validator import LTI13LaunchValidator
@@ -56,45 +76,13 @@ async def setup_course_hook_lti11(
     Returns:
         authentication (Required): updated authentication object
     """
-    lti_utils = LTIUtils()
-    jupyterhub_api = JupyterHubAPI()
-
     # normalize the name and course_id strings in authentication dictionary
     username = authentication["name"]
     lms_user_id = authentication["auth_state"]["user_id"]
-    user_role = authentication["auth_state"]["roles"].split(",")[0]
-    course_id = lti_utils.normalize_string(
-        authentication["auth_state"]["context_label"]
-    )
-    nb_service = NbGraderServiceHelper(course_id, True)
+    user_role = authentication["auth_state"]["roles"]
+    course_id = normalize_string(authentication["auth_state"]["context_label"])
 
-    # register the user (it doesn't matter if it is a student or instructor) with her/his lms_user_id in nbgrader
-    nb_service.add_user_to_nbgrader_gradebook(username, lms_user_id)
-    # TODO: verify the logic to simplify groups creation and membership
-    if user_is_a_student(user_role):
-        try:
-            # assign the user to 'nbgrader-<course_id>' group in jupyterhub and gradebook
-            await jupyterhub_api.add_student_to_jupyterhub_group(course_id, username)
-        except AddJupyterHubUserException as e:
-            logger.error(
-                "An error when adding student username: %s to course_id: %s with exception %s",
-                (username, course_id, e),
-            )
-    elif user_is_an_instructor(user_role):
-        try:
-            # assign the user in 'formgrade-<course_id>' group
-            await jupyterhub_api.add_instructor_to_jupyterhub_group(course_id, username)
-        except AddJupyterHubUserException as e:
-            logger.error(
-                "An error when adding instructor username: %s to course_id: %s with exception %s",
-                (username, course_id, e),
-            )
-
-    # launch the new grader-notebook as a service
-    try:
-        _ = await register_new_service(org_name=ORG_NAME, course_id=course_id)
-    except Exception as e:
-        logger.error("Unable to launch the shared grader notebook with exception %s", e)
+    await provision_course(authentication, course_id, username, lms_user_id, user_role)
 
     return authentication
 
@@ -122,45 +110,197 @@ async def setup_course_hook(
     Returns:
         authentication (Required): updated authentication object
     """
-    lti_utils = LTIUtils()
-    jupyterhub_api = JupyterHubAPI()
-
     # normalize the name and course_id strings in authentication dictionary
-    course_id = lti_utils.normalize_string(authentication["auth_state"]["course_id"])
-    nb_service = NbGraderServiceHelper(course_id, True)
-    username = lti_utils.normalize_string(authentication["name"])
+    course_id = normalize_string(authentication["auth_state"]["course_id"])
+    username = normalize_string(authentication["name"])
     lms_user_id = authentication["auth_state"]["lms_user_id"]
     user_role = authentication["auth_state"]["user_role"]
 
+    await provision_course(authentication, course_id, username, lms_user_id, user_role)
+
+    return authentication
+
+
+def _setup_course_keys(
+    course_id: str, username: str, lms_user_id: str, user_role: str
+) -> Tuple[Tuple[str, str], ...]:
+    # ledger keys of the gradebook, group and grader service steps
+    enrollment = enrollment_key(course_id, username, user_role, lms_user_id)
+    return (
+        step_key(enrollment, GRADEBOOK_STEP.name),
+        step_key(enrollment, GROUP_STEP.name),
+        course_key(course_id),
+    )
+
+
+async def provision_course(
+    authentication: Dict[str, Any],
+    course_id: str,
+    username: str,
+    lms_user_id: str,
+    user_role: str,
+) -> None:
+    """
+    Sets up the course for the user. When the provisioning queue is enabled the setup is
+    enqueued and the job id is added to the auth_state, so the launch is not blocked and
+    the landing page can poll the provisioning status endpoint. Launches whose setup is
+    already complete do not enqueue a job.
+    """
+    if not PROVISIONING_QUEUE_ENABLED:
+        await setup_course(course_id, username, lms_user_id, user_role)
+        return
+    ledger = get_provisioning_ledger()
+    keys = _setup_course_keys(course_id, username, lms_user_id, user_role)
+    if all([await ledger.is_done(key) for key in keys]):
+        return
+    job_id = await get_provisioning_queue().enqueue(
+        "setup_course",
+        {
+            "course_id": course_id,
+            "username": username,
+            "lms_user_id": lms_user_id,
+            "user_role": user_role,
+        },
+        idempotency_key=keys[0][1],
+        course_id=course_id,
+        username=username,
+    )
+    authentication["auth_state"]["provisioning_job_id"] = job_id
+
+
+async def _run_setup_course_job(payload: Dict[str, Any]) -> bool:
+    # the job waits for the deferred and slow steps, so it is retried until they succeed
+    timings = await setup_course(**payload, wait_all=True)
+    return all(timing.status == "success" for timing in timings.values())
+
+
+async def _add_user_to_gradebook(
+    course_id: str, username: str, lms_user_id: str, key: Tuple[str, str]
+) -> bool:
+    nb_service = AsyncNbGraderServiceHelper(course_id)
+    await get_single_flight().run(
+        course_id, "gradebook_database", nb_service.create_database_if_not_exists
+    )
     # register the user (it doesn't matter if it is a student or instructor) with her/his lms_user_id in nbgrader
-    nb_service.add_user_to_nbgrader_gradebook(username, lms_user_id)
+    await nb_service.add_user_to_nbgrader_gradebook(username, lms_user_id)
+    await get_provisioning_ledger().mark_done(key)
+    return True
+
+
+async def _add_user_to_group(
+    course_id: str, username: str, user_role: str, key: Tuple[str, str]
+) -> bool:
+    jupyterhub_api = get_jupyterhub_api()
+    group_member = True
     # TODO: verify the logic to simplify groups creation and membership
     if user_is_a_student(user_role):
         try:
             # assign the user to 'nbgrader-<course_id>' group in jupyterhub and gradebook
-            await jupyterhub_api.add_student_to_jupyterhub_group(course_id, username)
+            group_member = await jupyterhub_api.add_student_to_jupyterhub_group(
+                course_id, username
+            )
         except AddJupyterHubUserException as e:
+            group_member = False
             logger.error(
                 "An error when adding student username: %s to course_id: %s with exception %s",
-                (username, course_id, e),
+                username,
+                course_id,
+                e,
             )
     elif user_is_an_instructor(user_role):
         try:
             # assign the user in 'formgrade-<course_id>' group
-            await jupyterhub_api.add_instructor_to_jupyterhub_group(course_id, username)
+            group_member = await jupyterhub_api.add_instructor_to_jupyterhub_group(
+                course_id, username
+            )
         except AddJupyterHubUserException as e:
+            group_member = False
             logger.error(
                 "An error when adding instructor username: %s to course_id: %s with exception %s",
-                (username, course_id, e),
+                username,
+                course_id,
+                e,
             )
+    if group_member is True:
+        await get_provisioning_ledger().mark_done(key)
+        return True
+    return False
+
 
+async def _register_grader_service(course_id: str, key: Tuple[str, str]) -> bool:
+    ledger = get_provisioning_ledger()
+    # the service may have been launched by the launch that held the lock
+    if await ledger.is_done(key):
+        return True
     # launch the new grader-notebook as a service
-    try:
-        _ = await register_new_service(org_name=ORG_NAME, course_id=course_id)
-    except Exception as e:
-        logger.error("Unable to launch the shared grader notebook with exception %s", e)
+    if await register_new_service(org_name=ORG_NAME, course_id=course_id):
+        await ledger.mark_done(key)
+        return True
+    return False
+
+
+async def _launch_grader_service(course_id: str, key: Tuple[str, str]) -> bool:
+    return await get_single_flight().run(
+        course_id,
+        GRADER_SERVICE_STEP.name,
+        functools.partial(_register_grader_service, course_id, key),
+    )
 
-    return authentication
+
+async def setup_course(
+    course_id: str,
+    username: str,
+    lms_user_id: str,
+    user_role: str,
+    wait_all: bool = False,
+) -> Dict[str, StepTiming]:
+    """
+    Registers the user in the course's gradebook and jupyterhub group and launches the
+    course's shared grader notebook. The steps are independent and run concurrently, each
+    one with its own deadline and failure policy. Steps completed by previous launches are
+    skipped, based on the provisioning ledger, so repeated launches do not call the gradebook
+    database, the JupyterHub API or the grader setup service.
+
+    Args:
+        course_id: the normalized course id
+        username: the normalized username
+        lms_user_id: the user's id in the LMS
+        user_role: the user's role or the comma separated LTI roles
+        wait_all: wait for every step to finish, regardless of its deadline and policy
+
+    Returns:
+        The StepTiming of each step that ran, indexed by step name
+
+    Raises:
+        HTTPError if a step with the block policy does not succeed
+    """
+    ledger = get_provisioning_ledger()
+    gradebook, group, course = _setup_course_keys(
+        course_id, username, lms_user_id, user_role
+    )
+    steps = {}
+    if not await ledger.is_done(gradebook):
+        steps[GRADEBOOK_STEP] = functools.partial(
+            _add_user_to_gradebook, course_id, username, lms_user_id, gradebook
+        )
+    if not await ledger.is_done(group):
+        steps[GROUP_STEP] = functools.partial(
+            _add_user_to_group, course_id, username, user_role, group
+        )
+    if not await ledger.is_done(course):
+        steps[GRADER_SERVICE_STEP] = functools.partial(
+            _launch_grader_service, course_id, course
+        )
+    if not steps:
+        return {}
+    try:
+        return await run_provisioning_steps(
+            steps,
+            description=f"course {course_id} for user {username}",
+            wait_all=wait_all,
+        )
+    except ProvisioningError as e:
+        raise HTTPError(503, str(e))
 
 
 class LTI13Authenticator(OAuthenticator):
@@ -199,7 +339,13 @@ class LTI13Authenticator(OAuthenticator):
         initial login request.""",
     ).tag(config=True)
 
-    async def authenticate(  # noqa: C901
+    def __init__(self, **kwargs: Any) -> None:
+        super().__init__(**kwargs)
+        # the hub creates the authenticator within its event loop, the queue workers run
+        # the jobs left pending by a restart without waiting for the next launch
+        IOLoop.current().add_callback(start_provisioning_queue)
+
+    async def authenticate(
         self, handler: LTI13LoginHandler, data: Dict[str, str] = None
     ) -> Dict[str, str]:
         """
@@ -212,130 +358,127 @@ class LTI13Authenticator(OAuthenticator):
         Returns:
           Authentication dictionary
         """
-        lti_utils = LTIUtils()
         validator = LTI13LaunchValidator()
 
         # get jwks endpoint and token to use as args to decode jwt. we could pass in
         # self.endpoint directly as arg to jwt_verify_and_decode() but logging the
         self.log.debug("JWKS platform endpoint is %s" % self.endpoint)
         id_token = handler.get_argument("id_token")
-        self.log.debug("ID token issued by platform is %s" % id_token)
+        self.log.debug("ID token issued by platform is %s", id_token)
 
         # extract claims from jwt (id_token) sent by the platform. as tool use the jwks (public key)
         # to verify the jwt's signature.
         jwt_decoded = await validator.jwt_verify_and_decode(
             id_token, self.endpoint, False, audience=self.client_id
         )
-        self.log.debug("Decoded JWT is %s" % jwt_decoded)
-
-        if validator.validate_launch_request(jwt_decoded):
-            course_id = jwt_decoded[
-                "https://purl.imsglobal.org/spec/lti/claim/context"
-            ]["label"]
-            course_id = lti_utils.normalize_string(course_id)
-            self.log.debug("Normalized course label is %s" % course_id)
-            username = ""
-            if "email" in jwt_decoded and jwt_decoded["email"]:
-                username = lti_utils.email_to_username(jwt_decoded["email"])
-            elif "name" in jwt_decoded and jwt_decoded["name"]:
-                username = jwt_decoded["name"]
-            elif "given_name" in jwt_decoded and jwt_decoded["given_name"]:
-                username = jwt_decoded["given_name"]
-            elif "family_name" in jwt_decoded and jwt_decoded["family_name"]:
-                username = jwt_decoded["family_name"]
-            elif (
-                "https://purl.imsglobal.org/spec/lti/claim/lis" in jwt_decoded
-                and "person_sourcedid"
-                in jwt_decoded["https://purl.imsglobal.org/spec/lti/claim/lis"]
-                and jwt_decoded["https://purl.imsglobal.org/spec/lti/claim/lis"][
-                    "person_sourcedid"
-                ]
-            ):
-                username = jwt_decoded["https://purl.imsglobal.org/spec/lti/claim/lis"][
-                    "person_sourcedid"
-                ].lower()
-            elif (
-                "lms_user_id"
-                in jwt_decoded["https://purl.imsglobal.org/spec/lti/claim/custom"]
-                and jwt_decoded["https://purl.imsglobal.org/spec/lti/claim/custom"][
-                    "lms_user_id"
-                ]
-            ):
-                username = str(
-                    jwt_decoded["https://purl.imsglobal.org/spec/lti/claim/custom"][
-                        "lms_user_id"
-                    ]
-                )
-
-            # set role to learner role (by default) if instructor or learner/student roles aren't
-            # sent with the request
-            user_role = "Learner"
-            for role in jwt_decoded["https://purl.imsglobal.org/spec/lti/claim/roles"]:
-                if role.find("Instructor") >= 1:
-                    user_role = "Instructor"
-                elif role.find("Learner") >= 1 or role.find("Student") >= 1:
-                    user_role = "Learner"
-            self.log.debug("user_role is %s" % user_role)
-
-            launch_return_url = ""
-            if (
-                "https://purl.imsglobal.org/spec/lti/claim/launch_presentation"
-                in jwt_decoded
-                and "return_url"
-                in jwt_decoded[
-                    "https://purl.imsglobal.org/spec/lti/claim/launch_presentation"
-                ]
-            ):
-                launch_return_url = jwt_decoded[
-                    "https://purl.imsglobal.org/spec/lti/claim/launch_presentation"
-                ]["return_url"]
-            # if there is a resource link request then process additional steps
-            if not validator.is_deep_link_launch(jwt_decoded):
-                await process_resource_link_lti_13(self.log, course_id, jwt_decoded)
-
-            lms_user_id = jwt_decoded["sub"] if "sub" in jwt_decoded else username
-
-            # ensure the username is normalized
-            self.log.debug("username is %s" % username)
-            if not username:
-                raise HTTPError(400, "Unable to set the username")
-
-            # ensure the user name is normalized
-            username_normalized = lti_utils.normalize_string(username)
-            self.log.debug("Assigned username is: %s" % username_normalized)
-
-            return {
-                "name": username_normalized,
-                "auth_state": {
-                    "course_id": course_id,
-                    "user_role": user_role,
-                    "lms_user_id": lms_user_id,
-                    "launch_return_url": launch_return_url,
-                },  # noqa: E231
-            }
+        self.log.debug("Decoded JWT is %s", jwt_decoded)
+
+        # validate the launch request and extract the values used below in a single pass
+        launch_claims = validator.parse_launch_request(jwt_decoded)
+        # reject replayed id_tokens and id_tokens not requested by the login of this
+        # browser, the callback handler checked the state cookie against the state argument
+        state = (
+            handler.get_state_cookie()
+            if isinstance(handler, LTI13CallbackHandler)
+            else None
+        )
+        await validator.validate_nonce(jwt_decoded, state=state)
+        course_id = normalize_string(launch_claims.context_label)
+        self.log.debug("Normalized course label is %s" % course_id)
+        username = launch_claims.username
+        user_role = launch_claims.user_role
+        self.log.debug("user_role is %s" % user_role)
+
+        # if there is a resource link request then process additional steps
+        if not launch_claims.is_deep_linking:
+            await process_resource_link_lti_13(self.log, course_id, launch_claims)
+
+        # ensure the username is normalized
+        self.log.debug("username is %s" % username)
+        if not username:
+            raise HTTPError(400, "Unable to set the username")
+
+        # ensure the user name is normalized
+        username_normalized = normalize_string(username)
+        self.log.debug("Assigned username is: %s" % username_normalized)
+
+        return {
+            "name": username_normalized,
+            "auth_state": {
+                "course_id": course_id,
+                "user_role": user_role,
+                "lms_user_id": launch_claims.lms_user_id,
+                "launch_return_url": launch_claims.launch_return_url,
+                "context_memberships_url": launch_claims.context_memberships_url,
+                "lineitems_url": launch_claims.lineitems_url,
+            },  # noqa: E231
+        }
 
 
 async def process_resource_link_lti_13(
     logger: Any,
     course_id: str,
-    jwt_body_decoded: Dict[str, Any],
+    launch_claims: LaunchClaims,
 ) -> None:
     """
     Executes additional processes with the claims that come only with LtiResourceLinkRequest
     """
     # Values for send-grades functionality
-    resource_link = jwt_body_decoded[
-        "https://purl.imsglobal.org/spec/lti/claim/resource_link"
-    ]
-    resource_link_title = resource_link["title"] or ""
-    nbgrader_service = NbGraderServiceHelper(course_id, True)
+    resource_link_title = launch_claims.resource_link_title
     if resource_link_title:
-        assignment_name = LTIUtils().normalize_string(resource_link_title)
+        assignment_name = normalize_string(resource_link_title)
+        if await get_provisioning_ledger().is_done(
+            assignment_key(course_id, assignment_name)
+        ):
+            return
         logger.debug(
             "Creating a new assignment from the Authentication flow with title %s"
             % assignment_name
         )
+        if PROVISIONING_QUEUE_ENABLED:
+            await get_provisioning_queue().enqueue(
+                "setup_assignment",
+                {"course_id": course_id, "assignment_name": assignment_name},
+                idempotency_key=assignment_key(course_id, assignment_name)[1],
+                course_id=course_id,
+            )
+        else:
+            await setup_assignment(course_id, assignment_name)
+
+
+async def setup_assignment(course_id: str, assignment_name: str) -> bool:
+    """
+    Registers the assignment in the course's gradebook and creates its source directory.
+    Concurrent calls for the same assignment run the setup once.
+
+    Returns:
+        True if the assignment source directory was created
+    """
+    ledger = get_provisioning_ledger()
+    key = assignment_key(course_id, assignment_name)
+
+    async def register_assignment() -> bool:
+        if await ledger.is_done(key):
+            return True
+        nbgrader_service = AsyncNbGraderServiceHelper(course_id)
+        # coalesced with the course setup of concurrent launches
+        await get_single_flight().run(
+            course_id,
+            "gradebook_database",
+            nbgrader_service.create_database_if_not_exists,
+        )
         # register the new assignment in nbgrader database
-        nbgrader_service.register_assignment(assignment_name)
+        await nbgrader_service.register_assignment(assignment_name)
         # create the assignment source directory by calling the grader-setup service
-        await create_assignment_source_dir(ORG_NAME, course_id, assignment_name)
+        if await create_assignment_source_dir(ORG_NAME, course_id, assignment_name):
+            await ledger.mark_done(key)
+            return True
+        return False
+
+    return await get_single_flight().run(
+        course_id, f"assignment:{assignment_name}", register_assignment
+    )
+
+
+register_job_handler("setup_course", _run_setup_course_job)
+register_job_handler("setup_assignment", lambda payload: setup_assignment(**payload))
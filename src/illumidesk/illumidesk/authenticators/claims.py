@@ -0,0 +1,245 @@
+from typing import Any
+from typing import Dict
+from typing import Mapping
+from typing import Tuple
+
+from tornado.web import HTTPError
+
+from illumidesk.authenticators.roles import LEARNER_ROLE
+from illumidesk.authenticators.roles import resolve_roles
+from illumidesk.authenticators.utils import email_to_username
+
+from .constants import ILLUMIDESK_LTI13_DEEP_LINKING_REQUIRED_CLAIMS
+from .constants import ILLUMIDESK_LTI13_RESOURCE_LINK_REQUIRED_CLAIMS
+from .constants import LTI13_DEEP_LINKING_REQUIRED_CLAIMS
+from .constants import LTI13_GENERAL_REQUIRED_CLAIMS
+from .constants import LTI13_RESOURCE_LINK_REQUIRED_CLAIMS
+
+AGS_ENDPOINT_CLAIM = "https://purl.imsglobal.org/spec/lti-ags/claim/endpoint"
+CONTEXT_CLAIM = "https://purl.imsglobal.org/spec/lti/claim/context"
+CUSTOM_CLAIM = "https://purl.imsglobal.org/spec/lti/claim/custom"
+LAUNCH_PRESENTATION_CLAIM = (
+    "https://purl.imsglobal.org/spec/lti/claim/launch_presentation"
+)
+LIS_CLAIM = "https://purl.imsglobal.org/spec/lti/claim/lis"
+NAMES_ROLES_CLAIM = "https://purl.imsglobal.org/spec/lti-nrps/claim/namesroleservice"
+MESSAGE_TYPE_CLAIM = "https://purl.imsglobal.org/spec/lti/claim/message_type"
+RESOURCE_LINK_CLAIM = "https://purl.imsglobal.org/spec/lti/claim/resource_link"
+ROLES_CLAIM = "https://purl.imsglobal.org/spec/lti/claim/roles"
+VERSION_CLAIM = "https://purl.imsglobal.org/spec/lti/claim/version"
+
+RESOURCE_LINK_MESSAGE_TYPE = LTI13_RESOURCE_LINK_REQUIRED_CLAIMS[MESSAGE_TYPE_CLAIM]
+DEEP_LINKING_MESSAGE_TYPE = LTI13_DEEP_LINKING_REQUIRED_CLAIMS[MESSAGE_TYPE_CLAIM]
+
+
+class LaunchClaims:
+    """
+    The values extracted from a validated LTI 1.3 launch request (decoded id_token).
+
+    Attributes:
+      claims: the decoded id_token
+      message_type: LtiResourceLinkRequest or LtiDeepLinkingRequest
+      context_label: the course label, not normalized
+      username: the username obtained from the user identity claims, not normalized
+      user_role: Instructor or Learner
+      roles: the role URIs sent by the platform
+      lms_user_id: the user's id in the platform (sub claim)
+      launch_return_url: the platform's return url
+      resource_link_id: the resource link id, with resource link launches
+      resource_link_title: the resource link title, with resource link launches
+      context_memberships_url: the course's names and role provisioning service url, if
+        the platform offers the service
+      lineitems_url: the course's assignment and grade services line items url, if the
+        platform offers the service
+    """
+
+    __slots__ = (
+        "claims",
+        "message_type",
+        "context_label",
+        "username",
+        "user_role",
+        "roles",
+        "lms_user_id",
+        "launch_return_url",
+        "resource_link_id",
+        "resource_link_title",
+        "context_memberships_url",
+        "lineitems_url",
+    )
+
+    def __init__(
+        self,
+        claims: Mapping[str, Any],
+        message_type: str,
+        context_label: str = None,
+        username: str = "",
+        user_role: str = "Learner",
+        roles: Tuple[str, ...] = (),
+        lms_user_id: str = "",
+        launch_return_url: str = "",
+        resource_link_id: str = None,
+        resource_link_title: str = "",
+        context_memberships_url: str = "",
+        lineitems_url: str = "",
+    ):
+        self.claims = claims
+        self.message_type = message_type
+        self.context_label = context_label
+        self.username = username
+        self.user_role = user_role
+        self.roles = roles
+        self.lms_user_id = lms_user_id
+        self.launch_return_url = launch_return_url
+        self.resource_link_id = resource_link_id
+        self.resource_link_title = resource_link_title
+        self.context_memberships_url = context_memberships_url
+        self.lineitems_url = lineitems_url
+
+    @property
+    def is_deep_linking(self) -> bool:
+        return self.message_type == DEEP_LINKING_MESSAGE_TYPE
+
+    def __repr__(self) -> str:
+        return (
+            f"LaunchClaims(message_type={self.message_type!r}, "
+            f"context_label={self.context_label!r}, username={self.username!r}, "
+            f"user_role={self.user_role!r})"
+        )
+
+
+class LaunchClaimsSchema:
+    """
+    Validates LTI 1.3 launch requests and extracts their values in a single pass over the
+    decoded id_token. The required claims are compiled from the dicts defined in the
+    constants module when the schema is created.
+
+    Attributes:
+      general_claims: claims required by every launch
+      resource_link_claims: additional claims required by resource link launches
+      deep_linking_claims: additional claims required by deep linking launches
+    """
+
+    def __init__(
+        self,
+        general_required_claims: Dict[str, Any] = LTI13_GENERAL_REQUIRED_CLAIMS,
+        resource_link_required_claims: Dict[
+            str, Any
+        ] = ILLUMIDESK_LTI13_RESOURCE_LINK_REQUIRED_CLAIMS,
+        deep_linking_required_claims: Dict[
+            str, Any
+        ] = ILLUMIDESK_LTI13_DEEP_LINKING_REQUIRED_CLAIMS,
+    ):
+        self.general_claims = tuple(general_required_claims)
+        self.resource_link_claims = tuple(
+            claim
+            for claim in resource_link_required_claims
+            if claim not in general_required_claims
+        )
+        self.deep_linking_claims = tuple(
+            claim
+            for claim in deep_linking_required_claims
+            if claim not in general_required_claims
+        )
+        self.message_types = {
+            RESOURCE_LINK_MESSAGE_TYPE: self.resource_link_claims,
+            DEEP_LINKING_MESSAGE_TYPE: self.deep_linking_claims,
+        }
+
+    def parse(self, jwt_decoded: Mapping[str, Any]) -> LaunchClaims:
+        """
+        Validates the decoded id_token and extracts the values used by the authenticator and
+        the post authentication hooks.
+
+        Args:
+          jwt_decoded: decoded JWT payload
+
+        Returns:
+          The LaunchClaims object
+
+        Raises:
+          HTTPError if a required claim is not included in the dictionary or if the
+          message_type, version, context label or resource link id claims do not have
+          a correct value.
+        """
+        for claim in self.general_claims:
+            if claim not in jwt_decoded:
+                raise HTTPError(
+                    400, "Required claim %s not included in request" % claim
+                )
+        lti_version = jwt_decoded[VERSION_CLAIM]
+        if lti_version != "1.3.0":
+            raise HTTPError(400, "Incorrect value %s for version claim" % lti_version)
+
+        context = jwt_decoded.get(CONTEXT_CLAIM) or {}
+        context_label = context.get("label")
+        if context_label == "":
+            raise HTTPError(
+                400,
+                "Missing course context label for claim %s" % CONTEXT_CLAIM,
+            )
+
+        message_type = jwt_decoded.get(MESSAGE_TYPE_CLAIM)
+        required_claims = self.message_types.get(message_type)
+        if required_claims is None:
+            raise HTTPError(
+                400, "Incorrect value %s for message_type claim" % message_type
+            )
+        for claim in required_claims:
+            if claim not in jwt_decoded:
+                raise HTTPError(
+                    400, "Required claim %s not included in request" % claim
+                )
+
+        launch_claims = LaunchClaims(
+            jwt_decoded, message_type, context_label=context_label
+        )
+        if message_type == RESOURCE_LINK_MESSAGE_TYPE:
+            resource_link = jwt_decoded[RESOURCE_LINK_CLAIM] or {}
+            resource_link_id = resource_link.get("id")
+            if resource_link_id == "":
+                raise HTTPError(
+                    400,
+                    "Incorrect value %s for id in resource_link claim"
+                    % resource_link_id,
+                )
+            launch_claims.resource_link_id = resource_link_id
+            launch_claims.resource_link_title = resource_link.get("title") or ""
+
+        roles = jwt_decoded[ROLES_CLAIM] or ()
+        if isinstance(roles, str):
+            roles = (roles,)
+        launch_claims.roles = tuple(roles)
+        # set role to learner role (by default) if instructor or learner/student roles aren't
+        # sent with the request
+        launch_claims.user_role = (
+            resolve_roles(launch_claims.roles).user_role or LEARNER_ROLE
+        )
+        launch_claims.username = self._get_username(jwt_decoded)
+        launch_claims.lms_user_id = jwt_decoded.get("sub") or launch_claims.username
+        launch_presentation = jwt_decoded.get(LAUNCH_PRESENTATION_CLAIM) or {}
+        launch_claims.launch_return_url = launch_presentation.get("return_url") or ""
+        names_roles = jwt_decoded.get(NAMES_ROLES_CLAIM) or {}
+        launch_claims.context_memberships_url = (
+            names_roles.get("context_memberships_url") or ""
+        )
+        ags_endpoint = jwt_decoded.get(AGS_ENDPOINT_CLAIM) or {}
+        launch_claims.lineitems_url = ags_endpoint.get("lineitems") or ""
+        return launch_claims
+
+    def _get_username(self, jwt_decoded: Mapping[str, Any]) -> str:
+        if jwt_decoded.get("email"):
+            return email_to_username(jwt_decoded["email"])
+        for claim in ("name", "given_name", "family_name"):
+            if jwt_decoded.get(claim):
+                return jwt_decoded[claim]
+        person_sourcedid = (jwt_decoded.get(LIS_CLAIM) or {}).get("person_sourcedid")
+        if person_sourcedid:
+            return person_sourcedid.lower()
+        lms_user_id = (jwt_decoded.get(CUSTOM_CLAIM) or {}).get("lms_user_id")
+        if lms_user_id:
+            return str(lms_user_id)
+        return ""
+
+
+LTI13_LAUNCH_CLAIMS_SCHEMA = LaunchClaimsSchema()
@@ -69,6 +69,12 @@ LTI11_LAUNCH_PARAMS_ALL = (
     + LTI11_LAUNCH_PARAMS_OTIONAL
 )
 
+# Seconds that the oauth_timestamp may differ from the current time
+LTI11_TIMESTAMP_WINDOW = 30
+
+# Maximum number of oauth nonces remembered within the timestamp window
+LTI11_NONCE_MAX_ENTRIES = 100000
+
 # LTI 1.3
 
 # Initial authentication request arguments
@@ -351,11 +357,3 @@ LTI13_ROLES = {
         "http://purl.imsglobal.org/vocab/lis/v2/institution/person#Instructor",
     },
 }
-
-# the list of roles that recognize a user as a Student
-DEFAULT_ROLE_NAMES_FOR_STUDENT = ["student", "learner", "Student", "Learner"]
-# the list of roles that recognize a user as an Instructor
-DEFAULT_ROLE_NAMES_FOR_INSTRUCTOR = [
-    "instructor",
-    "urn:lti:role:ims/lis/teachingassistant",
-]
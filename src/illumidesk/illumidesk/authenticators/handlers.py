@@ -1,4 +1,4 @@
-import hashlib
+import json
 import os
 import re
 import uuid
@@ -13,11 +13,18 @@ from oauthenticator.oauth2 import OAuthCallbackHandler
 from oauthenticator.oauth2 import OAuthLoginHandler
 from oauthenticator.oauth2 import _serialize_state
 from oauthenticator.oauth2 import guess_callback_uri
+from tornado import web
 from tornado.httputil import url_concat
 from tornado.web import HTTPError
 from tornado.web import RequestHandler
 
+from illumidesk.apis.provisioning_queue import DONE
+from illumidesk.apis.provisioning_queue import FAILED
+from illumidesk.apis.provisioning_queue import PROVISIONING_QUEUE_ENABLED
+from illumidesk.apis.provisioning_queue import get_provisioning_queue
+from illumidesk.authenticators.nonce import get_login_nonce
 from illumidesk.authenticators.utils import LTIUtils
+from illumidesk.authenticators.utils import normalize_string
 from illumidesk.authenticators.validator import LTI13LaunchValidator
 
 
@@ -163,10 +170,9 @@ class LTI13LoginHandler(OAuthLoginHandler):
             self.log.info("redirect_uri: %r", redirect_uri)
             state = self.get_state()
             self.set_state_cookie(state)
-            # TODO: validate that received nonces haven't been received before
-            # and that they are within the time-based tolerance window
-            nonce_raw = hashlib.sha256(state.encode())
-            nonce = nonce_raw.hexdigest()
+            # the nonce received with the id_token is checked against the state and the
+            # nonce store by the authenticator to reject forged and replayed launches
+            nonce = get_login_nonce(state)
             self.authorize_redirect(
                 client_id=client_id,
                 login_hint=login_hint,
@@ -193,3 +199,32 @@ class LTI13CallbackHandler(OAuthCallbackHandler):
             raise HTTPError(403, "User missing or null")
         self.redirect(self.get_next_url(user))
         self.log.debug("Redirecting user %s to %s" % (user.id, self.get_next_url(user)))
+
+
+class ProvisioningStatusHandler(BaseHandler):
+    """
+    Returns the status of the current user's course setup jobs, so the landing page can
+    show the setup progress instead of blocking the launch. Registered with:
+
+    c.JupyterHub.extra_handlers = [(r"/provisioning/status", ProvisioningStatusHandler)]
+    """
+
+    @web.authenticated
+    async def get(self) -> None:
+        user = self.current_user
+        auth_state = await user.get_auth_state() or {}
+        course_id = auth_state.get("course_id") or auth_state.get("context_label")
+        jobs = []
+        if PROVISIONING_QUEUE_ENABLED:
+            jobs = await get_provisioning_queue().get_user_jobs(
+                user.name, normalize_string(course_id) if course_id else None
+            )
+        self.set_header("Content-Type", "application/json")
+        self.write(
+            json.dumps(
+                {
+                    "ready": all(job["status"] in (DONE, FAILED) for job in jobs),
+                    "jobs": jobs,
+                }
+            )
+        )
@@ -0,0 +1,129 @@
+import json
+import time
+from types import MappingProxyType
+from typing import Any
+from typing import Dict
+from typing import Mapping
+from typing import NamedTuple
+
+import jwt
+from jwt.algorithms import get_default_algorithms
+from jwt.utils import base64url_decode
+
+# LTI 1.3 requires platforms to sign the id_token with RS256
+# http://www.imsglobal.org/spec/security/v1p0/#message-security-and-message-signing
+LTI13_ID_TOKEN_ALGORITHMS = ["RS256"]
+
+# seconds of tolerance when validating the exp, nbf and iat claims
+LTI13_ID_TOKEN_LEEWAY = 60
+
+_ALGORITHMS = get_default_algorithms()
+
+
+class CompactJWT(NamedTuple):
+    """
+    The segments of a compact serialized JWT, decoded once.
+    """
+
+    header: Dict[str, Any]
+    payload: bytes
+    signing_input: bytes
+    signature: bytes
+
+
+def parse_compact_jwt(token: str) -> CompactJWT:
+    """
+    Splits and decodes a compact serialized JWT (header.payload.signature) in a single pass.
+
+    Args:
+      token: the compact serialized JWT
+
+    Returns:
+      The decoded CompactJWT segments
+
+    Raises:
+      jwt.DecodeError if the token is malformed
+    """
+    if isinstance(token, str):
+        token = token.encode("utf-8")
+    try:
+        signing_input, crypto_segment = token.rsplit(b".", 1)
+        header_segment, payload_segment = signing_input.split(b".", 1)
+        header = json.loads(base64url_decode(header_segment))
+        payload = base64url_decode(payload_segment)
+        signature = base64url_decode(crypto_segment)
+    except (ValueError, TypeError) as e:
+        raise jwt.DecodeError("Invalid id_token: %s" % e)
+    if not isinstance(header, dict):
+        raise jwt.DecodeError("Invalid id_token header")
+    return CompactJWT(header, payload, signing_input, signature)
+
+
+def verify_signature(compact_jwt: CompactJWT, key: Any) -> None:
+    """
+    Verifies the JWT signature with the platform's public key object.
+
+    Raises:
+      jwt.InvalidAlgorithmError if the header's alg is not allowed
+      jwt.InvalidSignatureError if the signature does not match
+    """
+    alg = compact_jwt.header.get("alg")
+    if alg not in LTI13_ID_TOKEN_ALGORITHMS:
+        raise jwt.InvalidAlgorithmError("The specified alg value is not allowed")
+    if key is None or not _ALGORITHMS[alg].verify(
+        compact_jwt.signing_input, key, compact_jwt.signature
+    ):
+        raise jwt.InvalidSignatureError("Signature verification failed")
+
+
+def validate_claims(
+    claims: Mapping[str, Any],
+    audience: str = None,
+    leeway: int = LTI13_ID_TOKEN_LEEWAY,
+    now: float = None,
+) -> None:
+    """
+    Validates the registered claims (exp, nbf, iat and aud) with the same rules used by
+    jwt.decode.
+
+    Raises:
+      jwt.InvalidTokenError subclasses when a claim is not valid
+    """
+    now = now if now is not None else time.time()
+    for claim in ("exp", "nbf", "iat"):
+        if claim in claims and not isinstance(claims[claim], (int, float)):
+            raise jwt.DecodeError("%s claim must be a number" % claim)
+    if "exp" in claims and claims["exp"] < now - leeway:
+        raise jwt.ExpiredSignatureError("Signature has expired")
+    if "nbf" in claims and claims["nbf"] > now + leeway:
+        raise jwt.ImmatureSignatureError("The token is not yet valid (nbf)")
+    if "iat" in claims and claims["iat"] > now + leeway:
+        raise jwt.ImmatureSignatureError("The token is not yet valid (iat)")
+
+    if audience is None:
+        if "aud" in claims:
+            raise jwt.InvalidAudienceError("Invalid audience")
+        return
+    if "aud" not in claims:
+        raise jwt.MissingRequiredClaimError("aud")
+    token_audience = claims["aud"]
+    if isinstance(token_audience, str):
+        token_audience = [token_audience]
+    if audience not in token_audience:
+        raise jwt.InvalidAudienceError("Invalid audience")
+
+
+def decode_claims(compact_jwt: CompactJWT) -> Mapping[str, Any]:
+    """
+    Returns the JWT payload as a read-only mapping.
+
+    Raises:
+      jwt.DecodeError if the payload is not a JSON object
+    """
+    try:
+        claims = json.loads(compact_jwt.payload)
+    except ValueError as e:
+        raise jwt.DecodeError("Invalid payload string: %s" % e)
+    if not isinstance(claims, dict):
+        raise jwt.DecodeError("Invalid payload string: must be a json object")
+    return MappingProxyType(claims)
@@ -0,0 +1,231 @@
+import asyncio
+import json
+import logging
+import os
+import re
+import time
+from email.utils import parsedate_to_datetime
+from functools import partial
+from typing import Any
+from typing import Dict
+from typing import Optional
+
+import jwt
+from tornado.httpclient import AsyncHTTPClient
+from tornado.httputil import HTTPHeaders
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+# default time (in seconds) to keep a platform's jwks when the response
+# does not include caching headers
+LTI13_JWKS_CACHE_TTL = int(os.environ.get("LTI13_JWKS_CACHE_TTL") or 600)
+# upper bound (in seconds) for the ttl advertised by the platform
+LTI13_JWKS_CACHE_MAX_TTL = int(os.environ.get("LTI13_JWKS_CACHE_MAX_TTL") or 86400)
+# minimum time (in seconds) between fetches of a platform's jwks caused by unknown kids
+LTI13_JWKS_MIN_REFRESH_INTERVAL = float(
+    os.environ.get("LTI13_JWKS_MIN_REFRESH_INTERVAL") or 10
+)
+
+MAX_AGE_REGEX = re.compile(r"(?:^|,)\s*(?:s-maxage|max-age)\s*=\s*\"?(\d+)\"?", re.I)
+NO_CACHE_REGEX = re.compile(r"(?:^|,)\s*(?:no-store|no-cache)\s*(?:,|$)", re.I)
+
+
+def ttl_from_headers(
+    headers: HTTPHeaders, default_ttl: int, max_ttl: int, now: float = None
+) -> int:
+    """
+    Calculates how long a JWKS response may be cached based on the Cache-Control and
+    Expires response headers. The Cache-Control header takes precedence over the Expires
+    header, as described in RFC 7234.
+
+    Args:
+      headers: the response headers returned by the platform
+      default_ttl: ttl to use when the response does not include caching headers
+      max_ttl: upper bound for the ttl advertised by the platform
+      now: current unix timestamp, defaults to time.time()
+
+    Returns:
+      The number of seconds the response may be cached
+    """
+    now = now if now is not None else time.time()
+    cache_control = headers.get("Cache-Control", "") if headers else ""
+    if cache_control:
+        if NO_CACHE_REGEX.search(cache_control):
+            return 0
+        max_age = MAX_AGE_REGEX.search(cache_control)
+        if max_age:
+            return min(int(max_age.group(1)), max_ttl)
+    expires = headers.get("Expires") if headers else None
+    if expires:
+        try:
+            expires_at = parsedate_to_datetime(expires).timestamp()
+        except (TypeError, ValueError):
+            # an invalid Expires value means the response is already expired
+            return 0
+        return max(0, min(int(expires_at - now), max_ttl))
+    return default_ttl
+
+
+class PlatformJWKS:
+    """
+    The keys obtained from a platform's JWKS endpoint.
+
+    Attributes:
+      keys: public key objects indexed by kid
+      fetched_at: unix timestamp when the keys were fetched
+      expires_at: unix timestamp when the keys should be fetched again
+    """
+
+    __slots__ = ("keys", "fetched_at", "expires_at")
+
+    def __init__(self, keys: Dict[str, Any], fetched_at: float, expires_at: float):
+        self.keys = keys
+        self.fetched_at = fetched_at
+        self.expires_at = expires_at
+
+    def is_fresh(self, now: float) -> bool:
+        return now < self.expires_at
+
+
+class PlatformJWKSCache:
+    """
+    Process-wide cache with the public keys published by the platforms' JWKS endpoints.
+    Keys are stored as constructed public key objects keyed by (jwks_endpoint, kid), so
+    launches do not need to fetch and parse the platform's JWKS every time.
+
+    Entries honor the Cache-Control/Expires headers sent by the platform and fall back to
+    the default ttl. When a kid is not found the JWKS is fetched again once, which handles
+    key rotation, unless it was fetched less than min_refresh_interval seconds ago, so
+    launches with unknown kids do not send a request to the platform each. Concurrent
+    fetches for the same endpoint are coalesced.
+
+    Attributes:
+      default_ttl: seconds to cache a JWKS when the platform does not send caching headers
+      max_ttl: maximum seconds to cache a JWKS
+      min_refresh_interval: minimum seconds between fetches caused by unknown kids
+    """
+
+    def __init__(
+        self,
+        default_ttl: int = LTI13_JWKS_CACHE_TTL,
+        max_ttl: int = LTI13_JWKS_CACHE_MAX_TTL,
+        min_refresh_interval: float = LTI13_JWKS_MIN_REFRESH_INTERVAL,
+    ):
+        self.default_ttl = default_ttl
+        self.max_ttl = max_ttl
+        self.min_refresh_interval = min_refresh_interval
+        self._entries: Dict[str, PlatformJWKS] = {}
+        # running fetches indexed by endpoint, removed once they finish
+        self._refreshes: Dict[str, asyncio.Future] = {}
+
+    def clear(self, endpoint: str = None) -> None:
+        """
+        Removes the cached keys for an endpoint or all the cached keys if the endpoint
+        is not specified.
+        """
+        if endpoint is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(endpoint, None)
+
+    async def get_key(self, endpoint: str, kid: str, verify: bool = True) -> Any:
+        """
+        Gets the public key object that matches the kid from the platform's JWKS.
+
+        Args:
+          endpoint: platform jwks endpoint
+          kid: the kid received within the id_token header
+          verify: if true, validate certificate
+
+        Returns:
+          The public key object used to verify the JWT
+
+        Raises:
+          ValueError if the platform returns an empty jwks or there is not a matching key
+        """
+        now = time.time()
+        entry = self._entries.get(endpoint)
+        if (
+            entry
+            and entry.is_fresh(now)
+            and (
+                kid in entry.keys or now - entry.fetched_at < self.min_refresh_interval
+            )
+        ):
+            key = entry.keys.get(kid)
+        else:
+            # fetch the jwks when there is a cache miss, the entry expired or the kid is
+            # unknown (key rotation). only one refresh is done per miss.
+            entry = await self._refresh(endpoint, verify, requested_at=now)
+            key = entry.keys.get(kid)
+        if key is None:
+            error_msg = f"There is not a key matching in the platform jwks for the jwt received. kid: {kid}"
+            logger.debug(error_msg)
+            raise ValueError(error_msg)
+        return key
+
+    async def _refresh(
+        self, endpoint: str, verify: bool, requested_at: float
+    ) -> PlatformJWKS:
+        # another coroutine refreshed the jwks after the request
+        entry = self._entries.get(endpoint)
+        if entry and entry.fetched_at >= requested_at:
+            return entry
+        refresh = self._refreshes.get(endpoint)
+        if refresh is None:
+            refresh = asyncio.ensure_future(self._fetch_entry(endpoint, verify))
+            self._refreshes[endpoint] = refresh
+            refresh.add_done_callback(partial(self._refreshed, endpoint))
+        # a cancelled launch does not cancel the fetch shared with the other launches
+        return await asyncio.shield(refresh)
+
+    def _refreshed(self, endpoint: str, refresh: asyncio.Future) -> None:
+        if self._refreshes.get(endpoint) is refresh:
+            del self._refreshes[endpoint]
+        # the outcome is retrieved here in case all the launches stopped waiting
+        if not refresh.cancelled():
+            refresh.exception()
+
+    async def _fetch_entry(self, endpoint: str, verify: bool) -> PlatformJWKS:
+        entry = await self._fetch(endpoint, verify)
+        self._entries[endpoint] = entry
+        return entry
+
+    async def _fetch(self, endpoint: str, verify: bool) -> PlatformJWKS:
+        client = AsyncHTTPClient()
+        resp = await client.fetch(endpoint, validate_cert=verify)
+        platform_jwks = json.loads(resp.body)
+        logger.debug("Retrieved jwks from lms platform %s" % endpoint)
+        if not platform_jwks or "keys" not in platform_jwks:
+            raise ValueError("Platform endpoint returned an empty jwks")
+
+        keys = {}
+        for jwk in platform_jwks["keys"]:
+            if "kid" not in jwk:
+                continue
+            try:
+                keys[jwk["kid"]] = jwt.algorithms.RSAAlgorithm.from_jwk(json.dumps(jwk))
+            except (jwt.exceptions.InvalidKeyError, ValueError, KeyError) as e:
+                logger.debug("Ignoring jwk with kid %s: %s" % (jwk["kid"], e))
+
+        fetched_at = time.time()
+        ttl = ttl_from_headers(
+            resp.headers, self.default_ttl, self.max_ttl, now=fetched_at
+        )
+        logger.debug("Caching %s keys from %s for %ss" % (len(keys), endpoint, ttl))
+        return PlatformJWKS(keys, fetched_at, fetched_at + ttl)
+
+
+_platform_jwks_cache: Optional[PlatformJWKSCache] = None
+
+
+def get_platform_jwks_cache() -> PlatformJWKSCache:
+    """
+    Returns the process-wide platform JWKS cache.
+    """
+    global _platform_jwks_cache
+    if _platform_jwks_cache is None:
+        _platform_jwks_cache = PlatformJWKSCache()
+    return _platform_jwks_cache
@@ -0,0 +1,372 @@
+import asyncio
+import functools
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Optional
+from urllib.parse import urlparse
+
+from illumidesk.metrics import NONCE_EVICTIONS_TOTAL
+from illumidesk.metrics import NONCE_REJECTIONS_TOTAL
+from illumidesk.metrics import NONCES
+from illumidesk.metrics import NonceRejectionReason
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+# seconds a nonce is remembered, should be longer than the id_token lifetime
+LTI13_NONCE_TTL = int(os.environ.get("LTI13_NONCE_TTL") or 600)
+# backend used to share nonces, memory:// (default), sqlite:///<path> or redis://<host>:<port>/<db>
+LTI13_NONCE_STORE_URL = os.environ.get("LTI13_NONCE_STORE_URL") or "memory://"
+
+
+def get_login_nonce(state: str) -> str:
+    """
+    Returns the nonce sent with the LTI 1.3 login request, derived from the OAuth state so
+    the id_token can be bound to the login that requested it.
+    """
+    return hashlib.sha256(state.encode()).hexdigest()
+
+
+class NonceStore:
+    """
+    Base class for the stores used to detect replayed nonces. Nonces are remembered
+    for a time window (ttl) and forgotten afterwards, so the store's size is bounded by
+    the window and not by the total number of launches.
+
+    Attributes:
+      ttl: seconds that a nonce is remembered
+    """
+
+    def __init__(self, ttl: int = LTI13_NONCE_TTL):
+        if ttl <= 0:
+            raise ValueError("ttl must be greater than zero")
+        self.ttl = ttl
+
+    async def check_and_add(self, nonce: str, now: float = None) -> bool:
+        """
+        Atomically checks whether the nonce was used within the time window and
+        registers it.
+
+        Args:
+          nonce: the nonce to register
+          now: the unix timestamp of the request, defaults to time.time()
+
+        Returns:
+          True if the nonce is new, False if it was already used (replay)
+        """
+        raise NotImplementedError()
+
+    def clear(self) -> None:
+        """Removes all the nonces"""
+        raise NotImplementedError()
+
+
+class MemoryNonceStore(NonceStore):
+    """
+    In-process nonce store. Nonces are indexed in a dict for O(1) lookups and grouped
+    in a ring of time buckets. When a bucket is reused its nonces are dropped, so expired
+    nonces are removed without scanning the whole store.
+
+    Attributes:
+      ttl: seconds that a nonce is remembered
+      bucket_seconds: time span of each bucket in the ring
+    """
+
+    def __init__(self, ttl: int = LTI13_NONCE_TTL, bucket_seconds: int = 10):
+        super().__init__(ttl)
+        if bucket_seconds <= 0:
+            raise ValueError("bucket_seconds must be greater than zero")
+        self.bucket_seconds = bucket_seconds
+        # one extra bucket so the oldest bucket within the window is never reused
+        self._ring_size = -(-ttl // bucket_seconds) + 1
+        self._lock = threading.Lock()
+        self.clear()
+
+    def __len__(self) -> int:
+        return len(self._seen)
+
+    def clear(self) -> None:
+        self._seen: Dict[str, int] = {}
+        self._ring: List[Optional[set]] = [None] * self._ring_size
+        self._ring_ids: List[int] = [-1] * self._ring_size
+
+    async def check_and_add(self, nonce: str, now: float = None) -> bool:
+        now = now if now is not None else time.time()
+        bucket_id = int(now // self.bucket_seconds)
+        with self._lock:
+            seen_bucket_id = self._seen.get(nonce)
+            if (
+                seen_bucket_id is not None
+                and (bucket_id - seen_bucket_id) * self.bucket_seconds < self.ttl
+            ):
+                return False
+            bucket = self._get_bucket(bucket_id)
+            bucket.add(nonce)
+            self._seen[nonce] = bucket_id
+            return True
+
+    def _get_bucket(self, bucket_id: int) -> set:
+        slot = bucket_id % self._ring_size
+        if self._ring_ids[slot] != bucket_id:
+            # the slot holds an expired bucket, forget its nonces
+            expired = self._ring[slot]
+            if expired:
+                expired_id = self._ring_ids[slot]
+                for nonce in expired:
+                    if self._seen.get(nonce) == expired_id:
+                        del self._seen[nonce]
+            self._ring[slot] = set()
+            self._ring_ids[slot] = bucket_id
+        return self._ring[slot]
+
+
+class TimestampNonceRing:
+    """
+    Detects replayed (timestamp, nonce) pairs, such as the oauth_timestamp and oauth_nonce
+    sent with LTI 1.1 launches, within a tolerance window around the current time.
+
+    Nonces are grouped in a ring of per-second buckets indexed by their timestamp. Since a
+    nonce is only valid with its own timestamp, lookups check a single bucket and an expired
+    bucket is dropped in O(1) by replacing it when its slot is reused. The ring is thread-safe
+    and has a hard cap on the number of remembered nonces: launches above the cap are rejected
+    instead of letting the memory grow.
+
+    Attributes:
+      window: seconds that a timestamp may differ from the current time
+      max_entries: maximum number of nonces remembered
+      name: name used to label the metrics
+    """
+
+    def __init__(self, window: int = 30, max_entries: int = 100000, name: str = ""):
+        if window <= 0:
+            raise ValueError("window must be greater than zero")
+        if max_entries <= 0:
+            raise ValueError("max_entries must be greater than zero")
+        self.window = window
+        self.max_entries = max_entries
+        self.name = name
+        # timestamps within [now - window, now + window] are valid, plus one extra slot so a
+        # bucket is never reused while its timestamp is still valid
+        self._ring_size = 2 * window + 2
+        self._lock = threading.Lock()
+        self.size = 0
+        self.evictions = 0
+        self.rejections = {str(reason): 0 for reason in NonceRejectionReason}
+        self.clear()
+
+    def __len__(self) -> int:
+        return self.size
+
+    def clear(self) -> None:
+        with self._lock:
+            self._ring: List[Optional[set]] = [None] * self._ring_size
+            self._ring_ids: List[int] = [-1] * self._ring_size
+            self.size = 0
+            NONCES.labels(store=self.name).set(0)
+
+    def check_and_add(self, nonce: str, timestamp: int) -> bool:
+        """
+        Atomically checks whether the nonce was used with the same timestamp and registers it.
+        The timestamp should be validated against the current time beforehand.
+
+        Args:
+          nonce: the nonce to register
+          timestamp: the timestamp (in seconds) sent with the nonce
+
+        Returns:
+          True if the nonce is new, False if it was already used, if its bucket expired or if
+          the ring is full
+        """
+        timestamp = int(timestamp)
+        slot = timestamp % self._ring_size
+        with self._lock:
+            bucket_id = self._ring_ids[slot]
+            if bucket_id > timestamp:
+                # the slot was reused by a newer timestamp, the nonce is too old
+                return self._reject(NonceRejectionReason.expired)
+            if bucket_id != timestamp:
+                self._evict(slot)
+                self._ring[slot] = set()
+                self._ring_ids[slot] = timestamp
+            bucket = self._ring[slot]
+            if nonce in bucket:
+                return self._reject(NonceRejectionReason.replay)
+            if self.size >= self.max_entries:
+                self._evict_expired(timestamp)
+                if self.size >= self.max_entries:
+                    return self._reject(NonceRejectionReason.capacity)
+            bucket.add(nonce)
+            self.size += 1
+            NONCES.labels(store=self.name).inc()
+            return True
+
+    def _evict(self, slot: int) -> None:
+        expired = self._ring[slot]
+        if expired:
+            self.size -= len(expired)
+            self.evictions += len(expired)
+            NONCES.labels(store=self.name).dec(len(expired))
+            NONCE_EVICTIONS_TOTAL.labels(store=self.name).inc(len(expired))
+        self._ring[slot] = None
+        self._ring_ids[slot] = -1
+
+    def _evict_expired(self, timestamp: int) -> None:
+        # buckets are evicted lazily when their slot is reused, evict every bucket
+        # outside the window before rejecting a launch because the ring is full
+        for slot, bucket_id in enumerate(self._ring_ids):
+            if bucket_id != -1 and timestamp - bucket_id > 2 * self.window:
+                self._evict(slot)
+
+    def _reject(self, reason: NonceRejectionReason) -> bool:
+        if reason is NonceRejectionReason.capacity:
+            logger.warning(
+                "Nonce ring %s is full with %s nonces" % (self.name, self.max_entries)
+            )
+        self.rejections[str(reason)] += 1
+        NONCE_REJECTIONS_TOTAL.labels(store=self.name, reason=reason).inc()
+        return False
+
+
+class SQLiteNonceStore(NonceStore):
+    """
+    Nonce store backed by a SQLite file, which can be shared by hub replicas
+    running on the same host or sharing a volume. The SQLite queries run in a single
+    dedicated thread, so a locked database does not block the event loop.
+
+    Attributes:
+      ttl: seconds that a nonce is remembered
+      path: the sqlite database file
+    """
+
+    # expired rows are deleted at most once per interval (in seconds)
+    purge_interval = 10
+
+    def __init__(self, path: str, ttl: int = LTI13_NONCE_TTL):
+        super().__init__(ttl)
+        self.path = path
+        self._lock = threading.Lock()
+        self._last_purge = 0.0
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="nonce-store"
+        )
+        self._conn = sqlite3.connect(path, timeout=5, check_same_thread=False)
+        with self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS lti_nonces "
+                "(nonce TEXT PRIMARY KEY, expires_at REAL NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS lti_nonces_expires_at "
+                "ON lti_nonces (expires_at)"
+            )
+
+    def clear(self) -> None:
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM lti_nonces")
+
+    async def _run_in_executor(self, func: Callable[..., Any], *args, **kwargs) -> Any:
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, functools.partial(func, *args, **kwargs)
+        )
+
+    async def check_and_add(self, nonce: str, now: float = None) -> bool:
+        return await self._run_in_executor(self._check_and_add, nonce, now)
+
+    def _check_and_add(self, nonce: str, now: float = None) -> bool:
+        now = now if now is not None else time.time()
+        with self._lock, self._conn:
+            if now - self._last_purge >= self.purge_interval:
+                self._conn.execute(
+                    "DELETE FROM lti_nonces WHERE expires_at <= ?", (now,)
+                )
+                self._last_purge = now
+            # replace the nonce only if the previous one expired
+            cursor = self._conn.execute(
+                "INSERT INTO lti_nonces (nonce, expires_at) VALUES (?, ?) "
+                "ON CONFLICT(nonce) DO UPDATE SET expires_at = excluded.expires_at "
+                "WHERE lti_nonces.expires_at <= ?",
+                (nonce, now + self.ttl, now),
+            )
+            return cursor.rowcount == 1
+
+
+class RedisNonceStore(NonceStore):
+    """
+    Nonce store for servers that speak the Redis protocol (Redis, KeyDB, Valkey, etc.),
+    which can be shared by hub replicas. Nonces expire with the server's key ttl.
+
+    Requires the redis package.
+
+    Attributes:
+      ttl: seconds that a nonce is remembered
+      url: the redis server url
+    """
+
+    key_prefix = "illumidesk:lti13:nonce:"
+
+    def __init__(self, url: str, ttl: int = LTI13_NONCE_TTL):
+        super().__init__(ttl)
+        try:
+            import redis
+        except ImportError:
+            raise EnvironmentError(
+                "The redis package is required to use the redis nonce store"
+            )
+        self.url = url
+        self._client = redis.Redis.from_url(url)
+
+    def clear(self) -> None:
+        keys = list(self._client.scan_iter(match=f"{self.key_prefix}*"))
+        if keys:
+            self._client.delete(*keys)
+
+    async def check_and_add(self, nonce: str, now: float = None) -> bool:
+        # SET NX is atomic, it only sets the key when it does not exist
+        return bool(
+            self._client.set(f"{self.key_prefix}{nonce}", 1, nx=True, ex=self.ttl)
+        )
+
+
+def create_nonce_store(url: str, ttl: int = LTI13_NONCE_TTL) -> NonceStore:
+    """
+    Creates a nonce store from a url with the format memory://, sqlite:///<path>
+    or redis://<host>:<port>/<db>.
+    """
+    scheme = urlparse(url).scheme
+    if scheme in ("", "memory"):
+        return MemoryNonceStore(ttl)
+    if scheme == "sqlite":
+        # same format as sqlalchemy, sqlite:///relative.db or sqlite:////absolute.db
+        path = url[len("sqlite:///") :] if url.startswith("sqlite:///") else ""
+        if not path:
+            raise ValueError("sqlite nonce store requires a file path")
+        return SQLiteNonceStore(path, ttl)
+    if scheme in ("redis", "rediss", "unix"):
+        return RedisNonceStore(url, ttl)
+    raise ValueError(f"Unsupported nonce store url {url}")
+
+
+_nonce_store: Optional[NonceStore] = None
+
+
+def get_nonce_store() -> NonceStore:
+    """
+    Returns the process-wide nonce store configured with the LTI13_NONCE_STORE_URL
+    env var.
+    """
+    global _nonce_store
+    if _nonce_store is None:
+        _nonce_store = create_nonce_store(LTI13_NONCE_STORE_URL)
+        logger.debug("Using nonce store %s" % type(_nonce_store).__name__)
+    return _nonce_store
@@ -0,0 +1,167 @@
+from functools import lru_cache
+from typing import Dict
+from typing import FrozenSet
+from typing import Iterable
+from typing import NamedTuple
+from typing import Tuple
+from typing import Union
+
+from illumidesk.authenticators.constants import LTI13_ROLE_VOCABULARIES
+from illumidesk.authenticators.constants import LTI13_ROLES
+
+# role scopes, as defined by the LIS vocabularies
+CONTEXT_SCOPE = "context"
+INSTITUTION_SCOPE = "institution"
+SYSTEM_SCOPE = "system"
+
+INSTRUCTOR_ROLE = "Instructor"
+LEARNER_ROLE = "Learner"
+
+# context sub-roles use the membership/<Role>#<SubRole> form
+LTI13_ROLE_PREFIXES = {
+    "http://purl.imsglobal.org/vocab/lis/v2/membership#": CONTEXT_SCOPE,
+    "http://purl.imsglobal.org/vocab/lis/v2/membership/": CONTEXT_SCOPE,
+    "http://purl.imsglobal.org/vocab/lis/v2/institution/person#": INSTITUTION_SCOPE,
+    "http://purl.imsglobal.org/vocab/lis/v2/system/person#": SYSTEM_SCOPE,
+}
+
+LTI11_ROLE_PREFIXES = {
+    "urn:lti:role:ims/lis/": CONTEXT_SCOPE,
+    "urn:lti:instrole:ims/lis/": INSTITUTION_SCOPE,
+    "urn:lti:sysrole:ims/lis/": SYSTEM_SCOPE,
+}
+
+# context roles (and sub-roles) that give access to the course's grader, teaching
+# assistants and content developers are treated as instructors
+CONTEXT_INSTRUCTOR_ROLES = frozenset(
+    {"instructor", "teachingassistant", "contentdeveloper"}
+)
+CONTEXT_LEARNER_ROLES = frozenset({"learner", "student"})
+# institution roles used when the platform does not send context roles
+INSTITUTION_INSTRUCTOR_ROLES = frozenset({"instructor", "faculty"})
+INSTITUTION_LEARNER_ROLES = frozenset({"learner", "student", "prospectivestudent"})
+
+
+class ParsedRole(NamedTuple):
+    """
+    A role URI or name split into its scope, principal role and sub-role, lowercased.
+    """
+
+    scope: str
+    name: str
+    sub_role: str
+
+
+class LTIRoleSet(NamedTuple):
+    """
+    The normalized roles of a user, built from the roles sent with LTI 1.1 or LTI 1.3
+    launch requests.
+
+    Attributes:
+      context: context (membership) roles, including sub-roles
+      institution: institution roles
+      system: system roles
+      user_role: Instructor, Learner or an empty string if the roles do not map to either
+    """
+
+    context: FrozenSet[str]
+    institution: FrozenSet[str]
+    system: FrozenSet[str]
+    user_role: str
+
+    @property
+    def is_instructor(self) -> bool:
+        return self.user_role == INSTRUCTOR_ROLE
+
+    @property
+    def is_student(self) -> bool:
+        return self.user_role == LEARNER_ROLE
+
+
+def _split_role(role: str) -> ParsedRole:
+    role = role.strip()
+    for prefixes in (LTI13_ROLE_PREFIXES, LTI11_ROLE_PREFIXES):
+        for prefix, scope in prefixes.items():
+            if role.startswith(prefix):
+                # lti 1.3 sub-roles use #, lti 1.1 sub-roles use /
+                name, _, sub_role = role[len(prefix) :].replace("/", "#").partition("#")
+                return ParsedRole(scope, name.lower(), sub_role.lower())
+    # simple names (Instructor, Learner, etc.) are context roles
+    return ParsedRole(CONTEXT_SCOPE, role.lower(), "")
+
+
+def _build_role_index() -> Dict[str, ParsedRole]:
+    role_uris = set()
+    for vocabulary in LTI13_ROLE_VOCABULARIES.values():
+        for uris in vocabulary.values():
+            role_uris.update(uris)
+    for uris in LTI13_ROLES.values():
+        role_uris.update(uris)
+    return {uri.lower(): _split_role(uri) for uri in role_uris}
+
+
+# role URIs from the LIS vocabularies, parsed once at import time
+LTI13_ROLE_INDEX: Dict[str, ParsedRole] = _build_role_index()
+
+
+def parse_role(role: str) -> ParsedRole:
+    """
+    Parses an LTI 1.3 role URI, an LTI 1.1 role URN or a simple role name.
+    """
+    parsed = LTI13_ROLE_INDEX.get(role.lower())
+    return parsed if parsed is not None else _split_role(role)
+
+
+def _get_user_role(context: Iterable[ParsedRole], institution: FrozenSet[str]) -> str:
+    # context roles take precedence over institution roles, and instructor roles take
+    # precedence over learner roles within the same scope
+    context_roles = set()
+    for role in context:
+        context_roles.add(role.name)
+        context_roles.add(role.sub_role)
+    if context_roles & CONTEXT_INSTRUCTOR_ROLES:
+        return INSTRUCTOR_ROLE
+    if context_roles & CONTEXT_LEARNER_ROLES:
+        return LEARNER_ROLE
+    if institution & INSTITUTION_INSTRUCTOR_ROLES:
+        return INSTRUCTOR_ROLE
+    if institution & INSTITUTION_LEARNER_ROLES:
+        return LEARNER_ROLE
+    return ""
+
+
+@lru_cache(maxsize=1024)
+def _resolve_roles(roles: Tuple[str, ...]) -> LTIRoleSet:
+    scopes = {CONTEXT_SCOPE: [], INSTITUTION_SCOPE: [], SYSTEM_SCOPE: []}
+    for role in roles:
+        if role and role.strip():
+            parsed = parse_role(role)
+            scopes[parsed.scope].append(parsed)
+    context = frozenset(
+        f"{role.name}#{role.sub_role}" if role.sub_role else role.name
+        for role in scopes[CONTEXT_SCOPE]
+    )
+    institution = frozenset(role.name for role in scopes[INSTITUTION_SCOPE])
+    system = frozenset(role.name for role in scopes[SYSTEM_SCOPE])
+    return LTIRoleSet(
+        context,
+        institution,
+        system,
+        _get_user_role(scopes[CONTEXT_SCOPE], institution),
+    )
+
+
+def resolve_roles(roles: Union[str, Iterable[str]]) -> LTIRoleSet:
+    """
+    Normalizes the roles sent with a launch request. The result is memoized, since
+    platforms send the same few role combinations over and over.
+
+    Args:
+      roles: a comma separated string of roles (LTI 1.1) or a list of role URIs (LTI 1.3)
+
+    Returns:
+      The LTIRoleSet with the user's context, institution and system roles
+    """
+    if isinstance(roles, str):
+        roles = roles.split(",")
+    return _resolve_roles(tuple(roles))
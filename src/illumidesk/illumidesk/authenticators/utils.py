@@ -1,78 +1,134 @@
 import re
+from functools import lru_cache
 from typing import Any
 from typing import Dict
+from typing import Iterable
 from typing import List
 
 from sqlalchemy.sql.sqltypes import Boolean
 from tornado.web import RequestHandler
 from traitlets.config import LoggingConfigurable
 
-from illumidesk.authenticators.constants import DEFAULT_ROLE_NAMES_FOR_INSTRUCTOR
-from illumidesk.authenticators.constants import DEFAULT_ROLE_NAMES_FOR_STUDENT
+from illumidesk.authenticators.roles import resolve_roles
+
+# regexes used to normalize course labels, usernames and emails
+SPECIAL_CHARACTERS_REGEX = re.compile(r"[^\w-]+")
+EMAIL_COMMENT_REGEX = re.compile(r"\([^)]*\)")
+
+# number of normalized strings remembered, course labels and usernames repeat with
+# every launch
+NORMALIZE_CACHE_SIZE = 4096
+
+
+def _normalize_string(name: str) -> str:
+    # truncate name after 30th character
+    name = (name[:25] + "") if len(name) > 30 else name
+    # remove special characters
+    name = SPECIAL_CHARACTERS_REGEX.sub("", name)
+    # if the first character is any of _.- remove it, convert to lower case and
+    # limit course_id to 25 characters, since its used for o/s username
+    # in jupyter/docker-stacks compatible grader notebook (NB_USER)
+    return name.lstrip("_.-").lower()[0:25]
+
+
+@lru_cache(maxsize=NORMALIZE_CACHE_SIZE)
+def normalize_string(name: str) -> str:
+    """
+    Function used to strip special characters and convert strings
+    to docker container compatible names. This function is used mostly
+    with course labels, as they are used for the shared grader notebook
+    container names.
+
+    Args:
+      name: The string to normalize for docker container and volume
+        names (e.g. Dev-IllumiDesk)
+
+    Returns:
+      normalized_name: The normalized string
+
+    Raises:
+      ValueError if name is empty
+    """
+    if not name:
+        raise ValueError("Name is empty")
+    return _normalize_string(name)
+
+
+@lru_cache(maxsize=NORMALIZE_CACHE_SIZE)
+def email_to_username(email: str) -> str:
+    """
+    Normalizes an email to get a username. This function
+    calculates the username by getting the string before the
+    @ symbol, removing special characters, removing comments,
+    converting string to lowercase, and adds 1 if the username
+    has an integer value already in the string.
+
+    Args:
+      email: A valid email address
+
+    Returns:
+      username: A username string
+
+    Raises:
+      ValueError if email is empty
+    """
+    if not email:
+        raise ValueError("email is missing")
+    username = email.split("@")[0]
+    username = username.split("+")[0]
+    username = EMAIL_COMMENT_REGEX.sub("", username)
+    username = SPECIAL_CHARACTERS_REGEX.sub("", username)
+    return username.lower()
+
+
+def normalize_many(names: Iterable[str]) -> List[str]:
+    """
+    Normalizes a batch of strings, such as the usernames of a course roster, with the
+    same rules used by normalize_string. Each distinct string is normalized once and
+    the batch does not go through (nor evict entries from) the LRU cache.
+
+    Args:
+      names: the strings to normalize
+
+    Returns:
+      The normalized strings, in the same order
+
+    Raises:
+      ValueError if a name is empty
+    """
+    normalized: Dict[str, str] = {}
+    result = []
+    for name in names:
+        value = normalized.get(name)
+        if value is None:
+            if not name:
+                raise ValueError("Name is empty")
+            value = normalized[name] = _normalize_string(name)
+        result.append(value)
+    return result
 
 
 class LTIUtils(LoggingConfigurable):
     """
     A class which contains various utility functions
     which work in conjunction with LTI requests.
+
+    The normalize_string and email_to_username methods are kept for compatibility and
+    call the module level functions.
     """
 
     def normalize_string(self, name: str) -> str:
         """
         Function used to strip special characters and convert strings
-        to docker container compatible names. This function is used mostly
-        with course labels, as they are used for the shared grader notebook
-        container names.
-
-        Args:
-          name: The string to normalize for docker container and volume
-            names (e.g. Dev-IllumiDesk)
-
-        Returns:
-          normalized_name: The normalized string
+        to docker container compatible names. See normalize_string.
         """
-        if not name:
-            raise ValueError("Name is empty")
-        # truncate name after 30th character
-        name = (name[:25] + "") if len(name) > 30 else name
-        # remove special characters
-        name = re.sub(r"[^\w-]+", "", name)
-        # if the first character is any of _.- remove it
-        name = name.lstrip("_.-")
-        # convert to lower case
-        name = name.lower()
-        # limit course_id to 25 characters, since its used for o/s username
-        # in jupyter/docker-stacks compatible grader notebook (NB_USER)
-        normalized_name = name[0:25]
-        self.log.debug("String normalized to %s" % normalized_name)
-        return normalized_name
+        return normalize_string(name)
 
     def email_to_username(self, email: str) -> str:
         """
-        Normalizes an email to get a username. This function
-        calculates the username by getting the string before the
-        @ symbol, removing special characters, removing comments,
-        converting string to lowercase, and adds 1 if the username
-        has an integer value already in the string.
-
-        Args:
-          email: A valid email address
-
-        Returns:
-          username: A username string
-
-        Raises:
-          ValueError if email is empty
+        Normalizes an email to get a username. See email_to_username.
         """
-        if not email:
-            raise ValueError("email is missing")
-        username = email.split("@")[0]
-        username = username.split("+")[0]
-        username = re.sub(r"\([^)]*\)", "", username)
-        username = re.sub(r"[^\w-]+", "", username)
-        username = username.lower()
-        self.log.debug("Username normalized to %s" % username)
-        return username
+        return email_to_username(email)
 
     def get_client_protocol(self, handler: RequestHandler) -> Dict[str, str]:
         """
@@ -121,7 +177,7 @@ def user_is_a_student(user_role: str) -> Boolean:
     """Checks whether or not a given user role corresponds to a Student/Learner role.
 
     Args:
-        user_role (str): the user role to check against
+        user_role (str): the user role or a comma separated list of LTI roles
 
     Raises:
         ValueError: if the user rule is empty or None
@@ -131,14 +187,14 @@ def user_is_a_student(user_role: str) -> Boolean:
     """
     if not user_role:
         raise ValueError("user_role must have a value")
-    return user_role.lower() in DEFAULT_ROLE_NAMES_FOR_STUDENT
+    return resolve_roles(user_role).is_student
 
 
 def user_is_an_instructor(user_role: str) -> Boolean:
     """Checks whether or not a given user role corresponds to a Instructor role.
 
     Args:
-        user_role (str): the user role to check against
+        user_role (str): the user role or a comma separated list of LTI roles
 
     Raises:
         ValueError: if the user rule is empty or None
@@ -148,4 +204,4 @@ def user_is_an_instructor(user_role: str) -> Boolean:
     """
     if not user_role:
         raise ValueError("user_role must have a value")
-    return user_role.lower() in DEFAULT_ROLE_NAMES_FOR_INSTRUCTOR
+    return resolve_roles(user_role).is_instructor
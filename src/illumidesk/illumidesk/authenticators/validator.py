@@ -1,25 +1,28 @@
-import json
+import hmac
 import time
-from collections import OrderedDict
 from typing import Any
 from typing import Dict
+from typing import Mapping
 
-import jwt
-from josepy.jws import JWS
-from josepy.jws import Header
 from oauthlib.oauth1.rfc5849 import signature
-from tornado.httpclient import AsyncHTTPClient
 from tornado.web import HTTPError
 from traitlets.config import LoggingConfigurable
 
-from .constants import ILLUMIDESK_LTI13_DEEP_LINKING_REQUIRED_CLAIMS
-from .constants import ILLUMIDESK_LTI13_RESOURCE_LINK_REQUIRED_CLAIMS
+from .claims import LTI13_LAUNCH_CLAIMS_SCHEMA
+from .claims import LaunchClaims
 from .constants import LTI11_LAUNCH_PARAMS_REQUIRED
+from .constants import LTI11_NONCE_MAX_ENTRIES
 from .constants import LTI11_OAUTH_ARGS
-from .constants import LTI13_DEEP_LINKING_REQUIRED_CLAIMS
-from .constants import LTI13_GENERAL_REQUIRED_CLAIMS
+from .constants import LTI11_TIMESTAMP_WINDOW
 from .constants import LTI13_LOGIN_REQUEST_ARGS
-from .constants import LTI13_RESOURCE_LINK_REQUIRED_CLAIMS
+from .id_token import decode_claims
+from .id_token import parse_compact_jwt
+from .id_token import validate_claims
+from .id_token import verify_signature
+from .jwks import get_platform_jwks_cache
+from .nonce import TimestampNonceRing
+from .nonce import get_login_nonce
+from .nonce import get_nonce_store
 
 
 class LTI11LaunchValidator(LoggingConfigurable):
@@ -39,9 +42,11 @@ class LTI11LaunchValidator(LoggingConfigurable):
       consumers: consumer key and shared secret key/value pair(s)
     """
 
-    # Keep a class-wide, global list of nonces so we can detect & reject
-    # replay attacks. This possibly makes this non-threadsafe, however.
-    nonces = OrderedDict()
+    # Keep a class-wide, global ring of nonces so we can detect & reject replay attacks.
+    # Only the nonces within the timestamp window are remembered.
+    nonces = TimestampNonceRing(
+        window=LTI11_TIMESTAMP_WINDOW, max_entries=LTI11_NONCE_MAX_ENTRIES, name="lti11"
+    )
 
     def __init__(self, consumers):
         self.consumers = consumers
@@ -106,18 +111,14 @@ class LTI11LaunchValidator(LoggingConfigurable):
             raise HTTPError(401, "Timestamp must be an integer")
         else:
             # Reject timestamps that are older than 30 seconds
-            if abs(time.time() - ts) > 30:
+            if abs(time.time() - ts) > LTI11_TIMESTAMP_WINDOW:
                 raise HTTPError(
                     401,
                     "Timestamp given is invalid, differ from "
                     "allowed by over %s seconds." % str(int(time.time() - ts)),
                 )
-            if (
-                ts in LTI11LaunchValidator.nonces
-                and args["oauth_nonce"] in LTI11LaunchValidator.nonces[ts]
-            ):
+            if not LTI11LaunchValidator.nonces.check_and_add(args["oauth_nonce"], ts):
                 raise HTTPError(401, "oauth_nonce + oauth_timestamp already used")
-            LTI11LaunchValidator.nonces.setdefault(ts, set()).add(args["oauth_nonce"])
 
         # convert arguments dict back to a list of tuples for signature
         args_list = [(k, v) for k, v in args.items()]
@@ -151,32 +152,17 @@ class LTI13LaunchValidator(LoggingConfigurable):
     ) -> Any:
         """
         Retrieves the matching cryptographic key from the platform as a
-        JSON Web Key (JWK).
+        JSON Web Key (JWK). Keys are obtained from the process-wide platform jwks
+        cache, which only calls the platform's endpoint when the keys expired or
+        the kid is unknown.
 
         Args:
           endpoint: platform jwks endpoint
           header_kid: the kid received within the id_token
           verify: if true, validate certificate
         """
-        client = AsyncHTTPClient()
-        resp = await client.fetch(endpoint, validate_cert=verify)
-        platform_jwks = json.loads(resp.body)
-        self.log.debug("Retrieved jwks from lms platform %s" % platform_jwks)
-
-        if not platform_jwks or "keys" not in platform_jwks:
-            raise ValueError("Platform endpoint returned an empty jwks")
-
-        key = None
-        for jwk in platform_jwks["keys"]:
-            if jwk["kid"] != header_kid:
-                continue
-            key = jwt.algorithms.RSAAlgorithm.from_jwk(json.dumps(jwk))
-            self.log.debug("Get keys from jwks dict  %s" % key)
-        if key is None:
-            error_msg = f"There is not a key matching in the platform jwks for the jwt received. kid: {header_kid}"
-            self.log.debug(error_msg)
-            raise ValueError(error_msg)
-
+        key = await get_platform_jwks_cache().get_key(endpoint, header_kid, verify)
+        self.log.debug("Get keys from jwks dict  %s", key)
         return key
 
     async def jwt_verify_and_decode(
@@ -185,12 +171,16 @@ class LTI13LaunchValidator(LoggingConfigurable):
         jwks_endpoint: str,
         verify: bool = True,
         audience: str = None,
-    ) -> Dict[str, str]:
+    ) -> Mapping[str, Any]:
         """
         Decodes the JSON Web Token (JWT) sent from the platform. The JWT should contain claims
         that represent properties associated with the request. This method implicitly verifies the JWT's
         signature using the platform's public key.
 
+        The token is parsed once: the header is read to obtain the kid, the signature is verified
+        once with the matching key from the platform jwks cache and the claims are returned as a
+        read-only mapping.
+
         Args:
           id_token: JWT token issued by the platform
           jwks_endpoint: JSON web key (publick key) endpoint
@@ -198,28 +188,22 @@ class LTI13LaunchValidator(LoggingConfigurable):
           audience: the platform's OAuth2 Audience (aud). This value usually coincides with the
             token endpoint for the platform (LMS) such as https://my.lms.domain/login/oauth2/token
         """
+        compact_jwt = parse_compact_jwt(id_token)
         if verify is False:
-            self.log.debug(
-                "JWK verification is off, returning token %s"
-                % jwt.decode(id_token, verify=False)
-            )
-            return jwt.decode(id_token, verify=False)
-
-        jws = JWS.from_compact(id_token)
-        self.log.debug("Retrieving matching jws %s" % jws)
-        json_header = jws.signature.protected
-        header = Header.json_loads(json_header)
-        self.log.debug("Header from decoded jwt %s" % header)
+            claims = decode_claims(compact_jwt)
+            self.log.debug("JWK verification is off, returning token %s", claims)
+            return claims
 
+        self.log.debug("Header from decoded jwt %s", compact_jwt.header)
         key_from_jwks = await self._retrieve_matching_jwk(
-            jwks_endpoint, verify, header.kid
-        )
-        self.log.debug(
-            "Returning decoded jwt with token %s key %s and verify %s"
-            % (id_token, key_from_jwks, verify)
+            jwks_endpoint, compact_jwt.header.get("kid"), verify
         )
+        verify_signature(compact_jwt, key_from_jwks)
+        claims = decode_claims(compact_jwt)
+        validate_claims(claims, audience=audience)
+        self.log.debug("Returning decoded jwt with key %s", key_from_jwks)
 
-        return jwt.decode(id_token, key=key_from_jwks, verify=False, audience=audience)
+        return claims
 
     def is_deep_link_launch(
         self,
@@ -259,88 +243,58 @@ class LTI13LaunchValidator(LoggingConfigurable):
           HTTPError if a required claim is not included in the dictionary or if the message_type and/or
           version claims do not have the correct value.
         """
-        # first validate global required keys
-        if self._validate_global_required_keys(jwt_decoded):
-            # get the message type for additional validations
-            is_deep_linking = self.is_deep_link_launch(jwt_decoded)
-            required_claims_by_message_type = (
-                ILLUMIDESK_LTI13_DEEP_LINKING_REQUIRED_CLAIMS
-                if is_deep_linking
-                else ILLUMIDESK_LTI13_RESOURCE_LINK_REQUIRED_CLAIMS
-            )
+        return self.parse_launch_request(jwt_decoded) is not None
 
-            for claim, v in required_claims_by_message_type.items():
-                if claim not in jwt_decoded:
-                    raise HTTPError(
-                        400, "Required claim %s not included in request" % claim
-                    )
-            if not is_deep_linking:
-                # custom validations with resource launch
-                if (
-                    jwt_decoded.get(
-                        "https://purl.imsglobal.org/spec/lti/claim/resource_link"
-                    ).get("id")
-                    == ""
-                ):
-                    raise HTTPError(
-                        400,
-                        "Incorrect value %s for id in resource_link claim"
-                        % jwt_decoded.get(
-                            "https://purl.imsglobal.org/spec/lti/claim/resource_link"
-                        ).get("id"),
-                    )
+    def parse_launch_request(
+        self,
+        jwt_decoded: Mapping[str, Any],
+    ) -> LaunchClaims:
+        """
+        Validates a given LTI 1.3 launch request and extracts the values used to authenticate
+        the user in the same pass over the claims. Uses the same rules as validate_launch_request.
 
-        return True
+        Args:
+          jwt_decoded: decode JWT payload
+
+        Returns:
+          The LaunchClaims object with the values extracted from the request
+
+        Raises:
+          HTTPError if a required claim is not included in the dictionary or if the message_type and/or
+          version claims do not have the correct value.
+        """
+        return LTI13_LAUNCH_CLAIMS_SCHEMA.parse(jwt_decoded)
 
-    def _validate_global_required_keys(
+    async def validate_nonce(
         self,
-        jwt_decoded: Dict[str, Any],
+        jwt_decoded: Mapping[str, Any],
+        state: str = None,
     ) -> bool:
-        # does all the required keys exist?
-        for claim, v in LTI13_GENERAL_REQUIRED_CLAIMS.items():
-            if claim not in jwt_decoded:
-                raise HTTPError(
-                    400, "Required claim %s not included in request" % claim
-                )
-        # some fixed values
-        lti_version = jwt_decoded.get(
-            "https://purl.imsglobal.org/spec/lti/claim/version"
-        )
-        if lti_version != "1.3.0":
-            raise HTTPError(400, "Incorrect value %s for version claim" % lti_version)
+        """
+        Validates that the nonce claim sent by the platform is the nonce sent with the login
+        request and that it was not used before within the nonce store's time window, to
+        protect the tool against forged and replayed launches.
 
-        # validate context label
-        context_claim = jwt_decoded.get(
-            "https://purl.imsglobal.org/spec/lti/claim/context", None
-        )
-        context_label = (
-            jwt_decoded.get("https://purl.imsglobal.org/spec/lti/claim/context").get(
-                "label"
-            )
-            if context_claim
-            else None
-        )
-        if context_label == "":
-            raise HTTPError(
-                400,
-                "Missing course context label for claim https://purl.imsglobal.org/spec/lti/claim/context",
-            )
-        # validate message type value
-        message_type = jwt_decoded.get(
-            "https://purl.imsglobal.org/spec/lti/claim/message_type", None
-        )
-        if (
-            message_type
-            != LTI13_RESOURCE_LINK_REQUIRED_CLAIMS[
-                "https://purl.imsglobal.org/spec/lti/claim/message_type"
-            ]
-            and message_type
-            != LTI13_DEEP_LINKING_REQUIRED_CLAIMS[
-                "https://purl.imsglobal.org/spec/lti/claim/message_type"
-            ]
-        ):
-            raise HTTPError(400, "Incorrect value %s for version claim" % message_type)
+        Args:
+          jwt_decoded: decode JWT payload
+          state: the OAuth state of the login request, checked by the callback handler
 
+        Returns:
+          True if the validation passes
+
+        Raises:
+          HTTPError if the nonce claim is missing, does not match the login request or if
+          the nonce was already used.
+        """
+        nonce = jwt_decoded.get("nonce")
+        if not nonce:
+            raise HTTPError(400, "Required claim nonce not included in request")
+        if state is not None and not hmac.compare_digest(
+            str(nonce), get_login_nonce(state)
+        ):
+            raise HTTPError(401, "nonce does not match the login request")
+        if not await get_nonce_store().check_and_add(str(nonce)):
+            raise HTTPError(401, "nonce already used")
         return True
 
     def validate_login_request(self, args: Dict[str, Any]) -> bool:
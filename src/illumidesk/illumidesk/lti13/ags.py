@@ -0,0 +1,279 @@
+"""
+LTI 1.3 Assignment and Grade Services (AGS) line items client, used to set up the
+assignments of a course before the students launch them for the first time.
+
+Usage (with the env vars used by the hub, PROVISIONING_LEDGER_URL must be a sqlite ledger):
+    python3 -m illumidesk.lti13.ags <course_id> <lineitems_url>
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+from typing import Any
+from typing import AsyncIterator
+from typing import Dict
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from urllib.parse import parse_qsl
+from urllib.parse import urlencode
+from urllib.parse import urlparse
+
+from tornado.httpclient import AsyncHTTPClient
+
+from illumidesk.apis.nbgrader_service import AsyncNbGraderServiceHelper
+from illumidesk.apis.nbgrader_service import org_name
+from illumidesk.apis.provisioning import SQLiteProvisioningLedger
+from illumidesk.apis.provisioning import assignment_key
+from illumidesk.apis.provisioning import get_provisioning_ledger
+from illumidesk.apis.provisioning_queue import register_job_handler
+from illumidesk.apis.setup_course_service import create_assignment_source_dirs
+from illumidesk.authenticators.utils import normalize_string
+from illumidesk.lti13.auth import get_lms_access_token
+from illumidesk.lti13.nrps import get_next_link
+from illumidesk.metrics import UpsertOutcome
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+AGS_LINEITEM_SCOPE = "https://purl.imsglobal.org/spec/lti-ags/scope/lineitem.readonly"
+AGS_LINEITEM_CONTAINER_MEDIA_TYPE = "application/vnd.ims.lis.v2.lineitemcontainer+json"
+
+# line items requested per page of the line items container
+LTI13_AGS_PAGE_SIZE = int(os.environ.get("LTI13_AGS_PAGE_SIZE") or 100)
+# assignments written to the gradebook and the grader setup service at a time
+LTI13_AGS_BATCH_SIZE = int(os.environ.get("LTI13_AGS_BATCH_SIZE") or 100)
+
+
+class CourseAssignment(NamedTuple):
+    """
+    A line item with the values used by the assignment setup, the name normalized as it
+    is when the assignment's resource link is launched.
+    """
+
+    name: str
+    duedate: Optional[str] = None
+
+
+def get_course_assignment(line_item: Dict[str, Any]) -> Optional[CourseAssignment]:
+    """
+    Returns the CourseAssignment of a line item, or None if the line item has no label.
+    The label is the title of the line item's resource link.
+    """
+    if not line_item.get("label"):
+        return None
+    return CourseAssignment(
+        normalize_string(line_item["label"]), line_item.get("endDateTime") or None
+    )
+
+
+class AssignmentGradeServicesClient:
+    """
+    Client of the platform's assignment and grade services. The line items container is
+    requested one page at a time, following the Link headers.
+
+    Attributes:
+      token_endpoint: the platform's token endpoint
+      private_key_path: path of the tool's private key (pem)
+      client_id: the tool's client id
+      page_size: line items requested per page
+    """
+
+    def __init__(
+        self,
+        token_endpoint: str = None,
+        private_key_path: str = None,
+        client_id: str = None,
+        page_size: int = LTI13_AGS_PAGE_SIZE,
+    ):
+        self.token_endpoint = token_endpoint or os.environ.get("LTI13_TOKEN_URL")
+        if not self.token_endpoint:
+            raise EnvironmentError("LTI13_TOKEN_URL env-var is not set")
+        self.private_key_path = private_key_path or os.environ.get("LTI13_PRIVATE_KEY")
+        if not self.private_key_path:
+            raise EnvironmentError("LTI13_PRIVATE_KEY env-var is not set")
+        self.client_id = client_id or os.environ.get("LTI13_CLIENT_ID")
+        if not self.client_id:
+            raise EnvironmentError("LTI13_CLIENT_ID env-var is not set")
+        self.page_size = page_size
+
+    async def get_access_token(self) -> str:
+        """Gets an access token with the line items scope"""
+        token = await get_lms_access_token(
+            self.token_endpoint,
+            self.private_key_path,
+            self.client_id,
+            scope=AGS_LINEITEM_SCOPE,
+        )
+        return token["access_token"]
+
+    async def iter_line_items(self, lineitems_url: str) -> AsyncIterator[Dict]:
+        """
+        Iterates over the line items of the course, one page at a time.
+
+        Args:
+          lineitems_url: the course's line items container url, sent with the launch
+            requests in the assignment and grade services claim
+
+        Returns:
+          An async iterator of the line items as returned by the platform
+        """
+        access_token = await self.get_access_token()
+        client = AsyncHTTPClient()
+        parsed = urlparse(lineitems_url)
+        query = dict(parse_qsl(parsed.query))
+        query.setdefault("limit", str(self.page_size))
+        url = parsed._replace(query=urlencode(query)).geturl()
+        pages = 0
+        while url:
+            resp = await client.fetch(
+                url,
+                headers={
+                    "Authorization": f"Bearer {access_token}",
+                    "Accept": AGS_LINEITEM_CONTAINER_MEDIA_TYPE,
+                },
+            )
+            pages += 1
+            for line_item in json.loads(resp.body) or []:
+                yield line_item
+            url = get_next_link(resp.headers.get_list("Link"))
+        logger.debug("Read %s pages from %s" % (pages, lineitems_url))
+
+
+class AssignmentSyncResult(NamedTuple):
+    """
+    The number of assignments set up, skipped (without label, repeated or already set up)
+    and failed.
+    """
+
+    synced: int
+    skipped: int
+    failed: int
+
+
+async def _sync_batch(course_id: str, batch: List[CourseAssignment]) -> int:
+    ledger = get_provisioning_ledger()
+    nb_service = AsyncNbGraderServiceHelper(course_id)
+    results = await nb_service.bulk_upsert_assignments(
+        [
+            (
+                {"name": assignment.name, "duedate": assignment.duedate}
+                if assignment.duedate
+                else {"name": assignment.name}
+            )
+            for assignment in batch
+        ]
+    )
+    registered = [
+        result.key
+        for result in results
+        if result.outcome in (UpsertOutcome.inserted, UpsertOutcome.updated)
+    ]
+    if not registered:
+        return 0
+    # the grader setup service creates the source directories with a single request
+    if not await create_assignment_source_dirs(org_name, course_id, registered):
+        return 0
+    # the synced assignments are the course's assignment registry, they do not expire
+    for name in registered:
+        await ledger.mark_done(assignment_key(course_id, name), expires=False)
+    return len(registered)
+
+
+async def sync_assignments(
+    course_id: str,
+    line_items: AsyncIterator[Dict],
+    batch_size: int = LTI13_AGS_BATCH_SIZE,
+) -> AssignmentSyncResult:
+    """
+    Registers the line items of a course as assignments of the course's gradebook and
+    creates their source directories in batches, and registers them in the provisioning
+    ledger without expiration, so the launches of their resource links skip the assignment
+    setup. The hub only sees the registered assignments if it uses the same ledger.
+
+    Args:
+      course_id: the normalized course id
+      line_items: the line items returned by the assignment and grade services
+      batch_size: assignments written at a time
+
+    Returns:
+      The AssignmentSyncResult
+    """
+    ledger = get_provisioning_ledger()
+    await AsyncNbGraderServiceHelper(course_id).create_database_if_not_exists()
+    synced = skipped = failed = 0
+    seen = set()
+    batch: List[CourseAssignment] = []
+
+    async def flush() -> None:
+        nonlocal synced, failed
+        done = await _sync_batch(course_id, batch)
+        synced += done
+        failed += len(batch) - done
+        batch.clear()
+
+    async for line_item in line_items:
+        assignment = get_course_assignment(line_item)
+        # line items of the same resource link (several scores) share the label
+        if (
+            assignment is None
+            or assignment.name in seen
+            or await ledger.is_done(assignment_key(course_id, assignment.name))
+        ):
+            skipped += 1
+            continue
+        seen.add(assignment.name)
+        batch.append(assignment)
+        if len(batch) >= batch_size:
+            await flush()
+    if batch:
+        await flush()
+    result = AssignmentSyncResult(synced, skipped, failed)
+    logger.info("Synced assignments of course %s: %s" % (course_id, result))
+    return result
+
+
+async def sync_course_assignments(
+    course_id: str, lineitems_url: str
+) -> AssignmentSyncResult:
+    """
+    Sets up the assignments of a course read from the platform's assignment and grade
+    services.
+    """
+    client = AssignmentGradeServicesClient()
+    return await sync_assignments(
+        normalize_string(course_id), client.iter_line_items(lineitems_url)
+    )
+
+
+async def _run_sync_assignments_job(payload: Dict[str, Any]) -> bool:
+    result = await sync_course_assignments(**payload)
+    return result.failed == 0
+
+
+register_job_handler("sync_assignments", _run_sync_assignments_job)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Sets up the assignments of a course with the LTI 1.3 assignment and "
+        "grade services line items"
+    )
+    parser.add_argument("course_id", help="the course id (context label)")
+    parser.add_argument("lineitems_url", help="the course's line items container url")
+    args = parser.parse_args()
+    # an in-process ledger would be lost with the command, the hub must see the assignments
+    if not isinstance(get_provisioning_ledger(), SQLiteProvisioningLedger):
+        parser.error(
+            "PROVISIONING_LEDGER_URL must be the sqlite ledger used by the hub"
+        )
+    logging.basicConfig(level=logging.INFO)
+    result = asyncio.run(sync_course_assignments(args.course_id, args.lineitems_url))
+    print(json.dumps(result._asdict()))
+
+
+if __name__ == "__main__":
+    main()
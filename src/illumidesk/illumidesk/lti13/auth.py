@@ -1,31 +1,85 @@
+import asyncio
+import hashlib
 import json
 import logging
 import os
 import time
 import urllib
 import uuid
+from functools import partial
+from typing import Any
+from typing import Dict
+from typing import FrozenSet
+from typing import List
+from typing import Optional
+from typing import Tuple
 
 import jwt
 import pem
-from Crypto.PublicKey import RSA
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
 from jwcrypto.jwk import JWK
 from tornado.httpclient import AsyncHTTPClient
 from tornado.httpclient import HTTPClientError
 
+from illumidesk.metrics import LTI13_ACCESS_TOKEN_REQUESTS_TOTAL
+from illumidesk.metrics import AccessTokenResult
+
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
 
+# seconds before an access token expires when it is refreshed in the background
+LTI13_ACCESS_TOKEN_REFRESH_MARGIN = int(
+    os.environ.get("LTI13_ACCESS_TOKEN_REFRESH_MARGIN") or 60
+)
+# lifetime (in seconds) of the access tokens returned without expires_in
+LTI13_ACCESS_TOKEN_DEFAULT_TTL = int(
+    os.environ.get("LTI13_ACCESS_TOKEN_DEFAULT_TTL") or 3600
+)
+
+DEFAULT_SCOPE = " ".join(
+    [
+        "https://purl.imsglobal.org/spec/lti-ags/scope/score",
+        "https://purl.imsglobal.org/spec/lti-ags/scope/lineitem",
+        "https://purl.imsglobal.org/spec/lti-ags/scope/result.readonly",
+        "https://purl.imsglobal.org/spec/lti-ags/scope/lineitem.readonly",
+    ]
+)
+
+
 async def get_lms_access_token(
     token_endpoint: str, private_key_path: str, client_id: str, scope=None
-) -> str:
+) -> Dict[str, Any]:
+    """
+    Gets an access token from the LMS Token endpoint by using the private key (pem format) and client id.
+    The token is reused from the access token cache until shortly before it expires.
+
+    Args:
+        token_endpoint: The url that will be used to make the request
+        private_key_path: specify where the pem is
+        client_id: For LTI 1.3 the Client ID that was obtained with the tool setup
+        scope: space separated scopes, defaults to the assignment and grade services scopes
+
+    Returns:
+        A json with the token value
+    """
+    return await get_access_token_cache().get_token(
+        token_endpoint, private_key_path, client_id, scope=scope
+    )
+
+
+async def fetch_lms_access_token(
+    token_endpoint: str, private_key_path: str, client_id: str, scope=None
+) -> Dict[str, Any]:
     """
-    Gets an access token from the LMS Token endpoint by using the private key (pem format) and client id
+    Requests a new access token from the LMS Token endpoint, without the access token cache.
 
     Args:
         token_endpoint: The url that will be used to make the request
         private_key_path: specify where the pem is
         client_id: For LTI 1.3 the Client ID that was obtained with the tool setup
+        scope: space separated scopes, defaults to the assignment and grade services scopes
 
     Returns:
         A json with the token value
@@ -39,26 +93,15 @@ async def get_lms_access_token(
         "jti": str(uuid.uuid4()),
     }
     logger.debug("Getting lms access token with parameters %s" % token_params)
-    # get the pem-encoded content
-    private_key = get_pem_text_from_file(private_key_path)
-
-    headers = get_headers_to_jwt_encode(private_key)
-
-    token = jwt.encode(token_params, private_key, algorithm="RS256", headers=headers)
+    # sign with the tool's key, parsed once and reloaded when the pem file changes
+    token = get_key_store(private_key_path).sign(token_params)
     logger.debug("Obtaining token %s" % token)
-    scope = scope or " ".join(
-        [
-            "https://purl.imsglobal.org/spec/lti-ags/scope/score",
-            "https://purl.imsglobal.org/spec/lti-ags/scope/lineitem",
-            "https://purl.imsglobal.org/spec/lti-ags/scope/result.readonly",
-            "https://purl.imsglobal.org/spec/lti-ags/scope/lineitem.readonly",
-        ]
-    )
+    scope = scope or DEFAULT_SCOPE
     logger.debug("Scope is %s" % scope)
     params = {
         "grant_type": "client_credentials",
         "client_assertion_type": "urn:ietf:params:oauth:client-assertion-type:jwt-bearer",
-        "client_assertion": token.decode(),
+        "client_assertion": token,
         "scope": scope,
     }
     logger.debug("OAuth parameters are %s" % params)
@@ -85,26 +128,16 @@ def get_jwk(public_key):
     return public_jwk
 
 
-def get_headers_to_jwt_encode(private_key_text: str) -> dict:
+def get_pem_text_from_file(private_key_path: str) -> str:
     """
-    Helper method that gets the dict headers to use in jwt.encode method
-
-    Args:
-        private_key_text: The PEM-Encoded content as text
-    Returns: A dict if the publickey can be exported or None otherwise
+    Parses the pem file to get its value as unicode text
     """
-    public_key = RSA.importKey(private_key_text).publickey().exportKey()
-    headers = None
-    if public_key:
-        jwk = get_jwk(public_key)
-        headers = {"kid": jwk.get("kid")} if jwk else None
+    return get_pem_texts_from_file(private_key_path)[0]
 
-    return headers
 
-
-def get_pem_text_from_file(private_key_path: str) -> str:
+def get_pem_texts_from_file(private_key_path: str) -> List[str]:
     """
-    Parses the pem file to get its value as unicode text
+    Parses the pem file to get the values of all the pem objects it contains as unicode text
     """
     # check the pem permission
     if not os.access(private_key_path, os.R_OK):
@@ -114,4 +147,304 @@ def get_pem_text_from_file(private_key_path: str) -> str:
     if not certs:
         raise Exception("Invalid pem file.")
 
-    return certs[0].as_text()
+    return [cert.as_text() for cert in certs]
+
+
+class ToolKey:
+    """
+    A private key of the tool, parsed once.
+
+    Attributes:
+      kid: the key id, the JWK thumbprint of the public key
+      private_key: the key object used to sign jwts
+      jwk: the public key as a JWK
+    """
+
+    __slots__ = ("kid", "private_key", "jwk")
+
+    def __init__(self, private_key_text: str):
+        self.private_key = serialization.load_pem_private_key(
+            private_key_text.encode(), password=None, backend=default_backend()
+        )
+        public_key = self.private_key.public_key().public_bytes(
+            serialization.Encoding.PEM, serialization.PublicFormat.SubjectPublicKeyInfo
+        )
+        self.jwk = get_jwk(public_key)
+        self.kid = self.jwk.get("kid")
+
+
+class KeyStore:
+    """
+    The tool's private keys read from the LTI13_PRIVATE_KEY pem file. Keys are parsed once,
+    with their JWK and kid, and parsed again when the file is modified.
+
+    The file may contain several private keys to rotate them without downtime: all the keys
+    are published with the JWKS and the first one signs the jwts. To rotate, append the new
+    key to the file, move it to the top once the platforms fetched the JWKS again and then
+    remove the old key.
+
+    Attributes:
+      path: the pem file's path
+      check_interval: minimum seconds between checks for file modifications
+    """
+
+    def __init__(self, path: str, check_interval: float = 1.0):
+        self.path = path
+        self.check_interval = check_interval
+        self._keys: List[ToolKey] = []
+        self._jwks: Dict[str, List[Dict[str, Any]]] = {"keys": []}
+        self._jwks_json = b""
+        self._version = ""
+        self._file_id: Optional[Tuple[int, int, int]] = None
+        self._checked_at = 0.0
+        # error of the last failed reload, logged once until the keys are loaded again
+        self._reload_error: Optional[str] = None
+
+    @property
+    def keys(self) -> List[ToolKey]:
+        """The active keys, the first one is the signing key"""
+        self._check()
+        return self._keys
+
+    @property
+    def signing_key(self) -> ToolKey:
+        return self.keys[0]
+
+    @property
+    def jwks(self) -> Dict[str, List[Dict[str, Any]]]:
+        """The JWKS with the public keys of the active keys"""
+        self._check()
+        return self._jwks
+
+    def get_jwks_json(self) -> Tuple[bytes, str]:
+        """
+        Returns the JWKS serialized as json and its version, a digest of the json that
+        changes when the keys are rotated.
+        """
+        self._check()
+        return self._jwks_json, self._version
+
+    def sign(self, payload: Dict[str, Any]) -> str:
+        """
+        Encodes and signs a jwt with the signing key, its kid is sent in the jwt header.
+        """
+        key = self.signing_key
+        return jwt.encode(
+            payload, key.private_key, algorithm="RS256", headers={"kid": key.kid}
+        ).decode()
+
+    def _check(self) -> None:
+        now = time.monotonic()
+        if self._keys and now - self._checked_at < self.check_interval:
+            return
+        self._checked_at = now
+        try:
+            stat = os.stat(self.path)
+            file_id = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        except OSError:
+            file_id = None
+        if self._keys and file_id is not None and file_id == self._file_id:
+            return
+        try:
+            keys = [ToolKey(text) for text in get_pem_texts_from_file(self.path)]
+        except Exception as e:
+            if not self._keys:
+                logger.error(f"The pem file {self.path} cannot be load")
+                raise
+            # the file may be replaced while we read it, the current keys stay active
+            error = f"{type(e).__name__}: {e}"
+            if error != self._reload_error:
+                self._reload_error = error
+                logger.warning(
+                    "Keeping the current keys, error reloading %s: %s"
+                    % (self.path, error)
+                )
+            return
+        self._reload_error = None
+        self._keys = keys
+        self._jwks = {"keys": [key.jwk for key in keys]}
+        self._jwks_json = json.dumps(self._jwks).encode()
+        self._version = hashlib.sha256(self._jwks_json).hexdigest()
+        self._file_id = file_id
+        logger.debug("Loaded keys %s from %s" % ([key.kid for key in keys], self.path))
+
+
+_key_stores: Dict[str, KeyStore] = {}
+
+
+def get_key_store(private_key_path: str = None) -> KeyStore:
+    """
+    Returns the process-wide key store of a pem file, by default the LTI13_PRIVATE_KEY file.
+    """
+    path = private_key_path or os.environ.get("LTI13_PRIVATE_KEY")
+    if not path:
+        raise EnvironmentError("LTI13_PRIVATE_KEY environment variable not set")
+    key_store = _key_stores.get(path)
+    if key_store is None:
+        key_store = _key_stores[path] = KeyStore(path)
+    return key_store
+
+
+class LMSAccessToken:
+    """
+    An access token obtained from the LMS Token endpoint.
+
+    Attributes:
+      token: the token endpoint response, with the access_token value
+      expires_at: unix timestamp when the token expires
+      refresh_at: unix timestamp when the token should be refreshed
+    """
+
+    __slots__ = ("token", "expires_at", "refresh_at")
+
+    def __init__(self, token: Dict[str, Any], expires_at: float, refresh_at: float):
+        self.token = token
+        self.expires_at = expires_at
+        self.refresh_at = refresh_at
+
+
+class LMSAccessTokenCache:
+    """
+    Process-wide cache with the access tokens obtained from the LMS Token endpoints, keyed
+    by (token_endpoint, client_id, scopes), so grade passback and roster requests share a
+    token instead of requesting a new one with every call.
+
+    Tokens are reused until refresh_margin seconds before they expire (or half of their
+    lifetime for short lived tokens). After that the cached token is still returned while
+    a new token is requested in the background. Concurrent requests of the same token are
+    coalesced.
+
+    Attributes:
+      refresh_margin: seconds before the expiry when a token is refreshed
+      default_ttl: lifetime of the tokens returned without expires_in
+    """
+
+    def __init__(
+        self,
+        refresh_margin: int = LTI13_ACCESS_TOKEN_REFRESH_MARGIN,
+        default_ttl: int = LTI13_ACCESS_TOKEN_DEFAULT_TTL,
+    ):
+        self.refresh_margin = refresh_margin
+        self.default_ttl = default_ttl
+        self._entries: Dict[Tuple[str, str, FrozenSet[str]], LMSAccessToken] = {}
+        self._refreshes: Dict[Tuple[str, str, FrozenSet[str]], asyncio.Future] = {}
+
+    @staticmethod
+    def cache_key(
+        token_endpoint: str, client_id: str, scope: str = None
+    ) -> Tuple[str, str, FrozenSet[str]]:
+        """Returns the key of a token, the scopes are compared as a set"""
+        return (token_endpoint, client_id, frozenset((scope or DEFAULT_SCOPE).split()))
+
+    def clear(self) -> None:
+        """Removes all the cached tokens"""
+        self._entries.clear()
+        self._refreshes.clear()
+
+    def invalidate(
+        self, token_endpoint: str, client_id: str, scope: str = None
+    ) -> None:
+        """
+        Removes a cached token, such as a token rejected by the platform before it
+        expired, so the next call requests a new one.
+        """
+        self._entries.pop(self.cache_key(token_endpoint, client_id, scope), None)
+
+    async def get_token(
+        self, token_endpoint: str, private_key_path: str, client_id: str, scope=None
+    ) -> Dict[str, Any]:
+        """
+        Gets the cached token or requests a new one when there is no token or the token
+        expired.
+
+        Returns:
+          The token endpoint response, with the access_token value
+        """
+        key = self.cache_key(token_endpoint, client_id, scope)
+        now = time.time()
+        entry = self._entries.get(key)
+        if entry is not None and now < entry.expires_at:
+            if now >= entry.refresh_at:
+                LTI13_ACCESS_TOKEN_REQUESTS_TOTAL.labels(
+                    result=AccessTokenResult.refresh
+                ).inc()
+                self._refresh(key, token_endpoint, private_key_path, client_id, scope)
+            else:
+                LTI13_ACCESS_TOKEN_REQUESTS_TOTAL.labels(
+                    result=AccessTokenResult.hit
+                ).inc()
+            return entry.token
+        LTI13_ACCESS_TOKEN_REQUESTS_TOTAL.labels(result=AccessTokenResult.miss).inc()
+        # a cancelled caller does not cancel the request shared with the other callers
+        entry = await asyncio.shield(
+            self._refresh(key, token_endpoint, private_key_path, client_id, scope)
+        )
+        return entry.token
+
+    def _refresh(
+        self,
+        key: Tuple[str, str, FrozenSet[str]],
+        token_endpoint: str,
+        private_key_path: str,
+        client_id: str,
+        scope: str,
+    ) -> asyncio.Future:
+        refresh = self._refreshes.get(key)
+        if refresh is None:
+            refresh = asyncio.ensure_future(
+                self._fetch(key, token_endpoint, private_key_path, client_id, scope)
+            )
+            self._refreshes[key] = refresh
+            refresh.add_done_callback(partial(self._refreshed, key))
+        return refresh
+
+    def _refreshed(
+        self, key: Tuple[str, str, FrozenSet[str]], refresh: asyncio.Future
+    ) -> None:
+        if self._refreshes.get(key) is refresh:
+            del self._refreshes[key]
+        if not refresh.cancelled() and refresh.exception() is not None:
+            # the callers waiting for the token get the error, a background refresh
+            # keeps the cached token until it expires
+            logger.warning(
+                "Error requesting an access token from %s: %s"
+                % (key[0], refresh.exception())
+            )
+
+    async def _fetch(
+        self,
+        key: Tuple[str, str, FrozenSet[str]],
+        token_endpoint: str,
+        private_key_path: str,
+        client_id: str,
+        scope: str,
+    ) -> LMSAccessToken:
+        requested_at = time.time()
+        token = await fetch_lms_access_token(
+            token_endpoint, private_key_path, client_id, scope=scope
+        )
+        try:
+            ttl = int(token.get("expires_in") or self.default_ttl)
+        except (TypeError, ValueError):
+            ttl = self.default_ttl
+        # the lifetime counts from the request, the response may take a while
+        expires_at = requested_at + ttl
+        entry = LMSAccessToken(
+            token, expires_at, expires_at - min(self.refresh_margin, ttl / 2)
+        )
+        self._entries[key] = entry
+        logger.debug("Caching access token from %s for %ss" % (token_endpoint, ttl))
+        return entry
+
+
+_access_token_cache: Optional[LMSAccessTokenCache] = None
+
+
+def get_access_token_cache() -> LMSAccessTokenCache:
+    """
+    Returns the process-wide LMS access token cache.
+    """
+    global _access_token_cache
+    if _access_token_cache is None:
+        _access_token_cache = LMSAccessTokenCache()
+    return _access_token_cache
@@ -1,19 +1,139 @@
+import hashlib
 import json
 import os
+from functools import lru_cache
 from pathlib import Path
+from typing import Any
+from typing import Dict
+from typing import NamedTuple
 from urllib.parse import quote
 from urllib.parse import urlencode
+from urllib.parse import urlparse
 
-import pem
-from Crypto.PublicKey import RSA
 from jupyterhub.handlers import BaseHandler
+from jupyterhub.utils import admin_only
 from tornado import web
 
+from illumidesk.apis.provisioning_queue import PROVISIONING_QUEUE_ENABLED
+from illumidesk.apis.provisioning_queue import get_provisioning_queue
 from illumidesk.authenticators.utils import LTIUtils
-from illumidesk.lti13.auth import get_jwk
+from illumidesk.authenticators.utils import normalize_string
+from illumidesk.lti13.ags import sync_course_assignments
+from illumidesk.lti13.auth import get_key_store
+from illumidesk.lti13.nrps import provision_course_roster
 
+# seconds the platforms may cache the tool's JWKS, new keys are picked up after this time
+LTI13_JWKS_MAX_AGE = int(os.environ.get("LTI13_JWKS_MAX_AGE") or 300)
+# seconds the platforms may cache the tool's JSON config
+LTI13_CONFIG_MAX_AGE = int(os.environ.get("LTI13_CONFIG_MAX_AGE") or 3600)
 
-class LTI13ConfigHandler(BaseHandler):
+# JWKS responses indexed by key set version
+_jwks_responses: Dict[str, "CachedJSONResponse"] = {}
+
+
+class CachedJSONResponse(NamedTuple):
+    """
+    A json response serialized once, with its strong ETag.
+    """
+
+    body: bytes
+    etag: str
+
+    @classmethod
+    def from_json(cls, body: bytes, version: str = None) -> "CachedJSONResponse":
+        return cls(body, '"%s"' % (version or hashlib.sha256(body).hexdigest()))
+
+
+def get_lti13_config(target_link_url: str) -> Dict[str, Any]:
+    """
+    Returns the JSON config which is used by LTI platforms to install the external tool.
+
+    Args:
+      target_link_url: the tool's url, with the protocol and host used by the platform
+    """
+    return {
+        "title": "IllumiDesk",
+        "scopes": [
+            "https://purl.imsglobal.org/spec/lti-ags/scope/lineitem",
+            "https://purl.imsglobal.org/spec/lti-ags/scope/lineitem.readonly",
+            "https://purl.imsglobal.org/spec/lti-ags/scope/result.readonly",
+            "https://purl.imsglobal.org/spec/lti-ags/scope/score",
+            "https://purl.imsglobal.org/spec/lti-nrps/scope/contextmembership.readonly",
+            "https://canvas.instructure.com/lti/public_jwk/scope/update",
+            "https://canvas.instructure.com/lti/data_services/scope/create",
+            "https://canvas.instructure.com/lti/data_services/scope/show",
+            "https://canvas.instructure.com/lti/data_services/scope/update",
+            "https://canvas.instructure.com/lti/data_services/scope/list",
+            "https://canvas.instructure.com/lti/data_services/scope/destroy",
+            "https://canvas.instructure.com/lti/data_services/scope/list_event_types",
+            "https://canvas.instructure.com/lti/feature_flags/scope/show",
+            "https://canvas.instructure.com/lti/account_lookup/scope/show",
+        ],
+        "extensions": [
+            {
+                "platform": "canvas.instructure.com",
+                "settings": {
+                    "platform": "canvas.instructure.com",
+                    "placements": [
+                        {
+                            "placement": "course_navigation",
+                            "message_type": "LtiResourceLinkRequest",
+                            "windowTarget": "_blank",
+                            "target_link_uri": target_link_url,
+                            "custom_fields": {
+                                "email": "$Person.email.primary",
+                                "lms_user_id": "$User.id",
+                            },  # noqa: E231
+                        },
+                        {
+                            "placement": "assignment_selection",
+                            "message_type": "LtiResourceLinkRequest",
+                            "target_link_uri": target_link_url,
+                        },
+                    ],
+                },
+                "privacy_level": "public",
+            }
+        ],
+        "description": "IllumiDesk Learning Tools Interoperability (LTI) v1.3 tool.",
+        "custom_fields": {
+            "email": "$Person.email.primary",
+            "lms_user_id": "$User.id",
+        },  # noqa: E231
+        "public_jwk_url": f"{target_link_url}hub/lti13/jwks",
+        "target_link_uri": target_link_url,
+        "oidc_initiation_url": f"{target_link_url}hub/oauth_login",
+    }
+
+
+@lru_cache(maxsize=64)
+def get_lti13_config_response(target_link_url: str) -> CachedJSONResponse:
+    """
+    Returns the serialized JSON config for a target link url. The config only varies by
+    protocol and host, so the response is serialized once per url.
+    """
+    return CachedJSONResponse.from_json(
+        json.dumps(get_lti13_config(target_link_url)).encode()
+    )
+
+
+class CachedJSONResponseMixin:
+    """
+    Writes cached json responses with their ETag and Cache-Control headers, and replies
+    with 304 Not Modified when the request's If-None-Match header matches the ETag.
+    """
+
+    def write_cached_response(self, response: CachedJSONResponse, max_age: int) -> None:
+        self.set_header("Content-Type", "application/json")
+        self.set_header("Cache-Control", f"public, max-age={max_age}")
+        self.set_header("Etag", response.etag)
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+        self.write(response.body)
+
+
+class LTI13ConfigHandler(CachedJSONResponseMixin, BaseHandler):
     """
     Handles JSON configuration file for LTI 1.3
     """
@@ -33,7 +153,6 @@ class LTI13ConfigHandler(BaseHandler):
         anonumized user data when requests are sent with private installation settings.
         """
         lti_utils = LTIUtils()
-        self.set_header("Content-Type", "application/json")
 
         # get the origin protocol
         protocol = lti_utils.get_client_protocol(self)
@@ -41,63 +160,12 @@ class LTI13ConfigHandler(BaseHandler):
         # build the full target link url value required for the jwks endpoint
         target_link_url = f"{protocol}://{self.request.host}/"
         self.log.debug("Target link url is: %s" % target_link_url)
-        keys = {
-            "title": "IllumiDesk",
-            "scopes": [
-                "https://purl.imsglobal.org/spec/lti-ags/scope/lineitem",
-                "https://purl.imsglobal.org/spec/lti-ags/scope/lineitem.readonly",
-                "https://purl.imsglobal.org/spec/lti-ags/scope/result.readonly",
-                "https://purl.imsglobal.org/spec/lti-ags/scope/score",
-                "https://purl.imsglobal.org/spec/lti-nrps/scope/contextmembership.readonly",
-                "https://canvas.instructure.com/lti/public_jwk/scope/update",
-                "https://canvas.instructure.com/lti/data_services/scope/create",
-                "https://canvas.instructure.com/lti/data_services/scope/show",
-                "https://canvas.instructure.com/lti/data_services/scope/update",
-                "https://canvas.instructure.com/lti/data_services/scope/list",
-                "https://canvas.instructure.com/lti/data_services/scope/destroy",
-                "https://canvas.instructure.com/lti/data_services/scope/list_event_types",
-                "https://canvas.instructure.com/lti/feature_flags/scope/show",
-                "https://canvas.instructure.com/lti/account_lookup/scope/show",
-            ],
-            "extensions": [
-                {
-                    "platform": "canvas.instructure.com",
-                    "settings": {
-                        "platform": "canvas.instructure.com",
-                        "placements": [
-                            {
-                                "placement": "course_navigation",
-                                "message_type": "LtiResourceLinkRequest",
-                                "windowTarget": "_blank",
-                                "target_link_uri": target_link_url,
-                                "custom_fields": {
-                                    "email": "$Person.email.primary",
-                                    "lms_user_id": "$User.id",
-                                },  # noqa: E231
-                            },
-                            {
-                                "placement": "assignment_selection",
-                                "message_type": "LtiResourceLinkRequest",
-                                "target_link_uri": target_link_url,
-                            },
-                        ],
-                    },
-                    "privacy_level": "public",
-                }
-            ],
-            "description": "IllumiDesk Learning Tools Interoperability (LTI) v1.3 tool.",
-            "custom_fields": {
-                "email": "$Person.email.primary",
-                "lms_user_id": "$User.id",
-            },  # noqa: E231
-            "public_jwk_url": f"{target_link_url}hub/lti13/jwks",
-            "target_link_uri": target_link_url,
-            "oidc_initiation_url": f"{target_link_url}hub/oauth_login",
-        }
-        self.write(json.dumps(keys))
+        self.write_cached_response(
+            get_lti13_config_response(target_link_url), LTI13_CONFIG_MAX_AGE
+        )
 
 
-class LTI13JWKSHandler(BaseHandler):
+class LTI13JWKSHandler(CachedJSONResponseMixin, BaseHandler):
     """
     Handler to serve our JWKS
     """
@@ -106,25 +174,144 @@ class LTI13JWKSHandler(BaseHandler):
         """
         - This method requires that the LTI13_PRIVATE_KEY environment variable
         is set with the full path to the RSA private key in PEM format.
+        - The JWKS is serialized once per key set, its ETag changes when the keys rotate.
         """
-        if not os.environ.get("LTI13_PRIVATE_KEY"):
-            raise EnvironmentError("LTI13_PRIVATE_KEY environment variable not set")
-        key_path = os.environ.get("LTI13_PRIVATE_KEY")
-        # check the pem permission
-        if not os.access(key_path, os.R_OK):
-            self.log.error(f"The pem file {key_path} cannot be load")
-            raise PermissionError()
-        private_key = pem.parse_file(key_path)
-        public_key = RSA.import_key(private_key[0].as_text()).publickey().exportKey()
-        self.log.debug("public_key is %s" % public_key)
-
-        jwk = get_jwk(public_key)
-        self.log.debug("the jwks is %s" % jwk)
-        keys_obj = {"keys": []}
-        keys_obj["keys"].append(jwk)
-        # we do not need to use json.dumps because tornado is converting our dict automatically and adding the content-type as json
-        # https://www.tornadoweb.org/en/stable/web.html#tornado.web.RequestHandler.write
-        self.write(keys_obj)
+        # the keys are parsed once and reloaded when the pem file changes
+        jwks_json, version = get_key_store().get_jwks_json()
+        response = _jwks_responses.get(version)
+        if response is None:
+            _jwks_responses.clear()
+            response = _jwks_responses[version] = CachedJSONResponse.from_json(
+                jwks_json, version
+            )
+        self.write_cached_response(response, LTI13_JWKS_MAX_AGE)
+
+
+def get_platform_service_url(
+    name: str, body: Dict[str, Any], auth_state: Dict[str, Any]
+) -> str:
+    """
+    Returns the url of a platform service (names and role provisioning, assignment and grade
+    services) sent in the JSON body, or the url of the admin's last launch. The platform's
+    access token is sent to the url, so the urls of the body must use the host of the
+    launch's url or of the platform's token endpoint (LTI13_TOKEN_URL).
+
+    Args:
+      name: the url's key in the body and in the auth_state
+      body: the request's JSON body
+      auth_state: the admin's auth_state, with the values of the last launch
+
+    Raises:
+      HTTPError if the url of the body uses another host
+    """
+    launch_url = auth_state.get(name)
+    url = body.get(name)
+    if not url:
+        return launch_url
+    platform_hosts = {
+        urlparse(platform_url).netloc
+        for platform_url in (launch_url, os.environ.get("LTI13_TOKEN_URL"))
+        if platform_url
+    }
+    parsed_url = urlparse(url)
+    if parsed_url.scheme not in ("http", "https") or (
+        parsed_url.netloc not in platform_hosts
+    ):
+        raise web.HTTPError(400, f"{name} must use the platform's host")
+    return url
+
+
+class LTI13RosterHandler(BaseHandler):
+    """
+    Provisions the roster of a course with the LTI 1.3 names and role provisioning service,
+    so the students are in the gradebook and the course groups before the class starts.
+    Only admins can use it. Registered with:
+
+    c.JupyterHub.extra_handlers = [(r"/lti13/roster", LTI13RosterHandler)]
+    """
+
+    @web.authenticated
+    @admin_only
+    async def post(self) -> None:
+        """
+        Provisions the roster of the course_id in the JSON body, with its
+        context_memberships_url. Both default to the values of the admin's last launch, the
+        context_memberships_url must use the platform's host. The roster is provisioned by the provisioning queue when it is enabled, the
+        response includes the job id.
+        """
+        try:
+            body = json.loads(self.request.body or b"{}")
+        except ValueError:
+            raise web.HTTPError(400, "Invalid JSON body")
+        auth_state = await self.current_user.get_auth_state() or {}
+        course_id = body.get("course_id") or auth_state.get("course_id")
+        context_memberships_url = get_platform_service_url(
+            "context_memberships_url", body, auth_state
+        )
+        if not course_id or not context_memberships_url:
+            raise web.HTTPError(
+                400, "course_id and context_memberships_url are required"
+            )
+        course_id = normalize_string(course_id)
+        self.set_header("Content-Type", "application/json")
+        if PROVISIONING_QUEUE_ENABLED:
+            job_id = await get_provisioning_queue().enqueue(
+                "provision_roster",
+                {
+                    "course_id": course_id,
+                    "context_memberships_url": context_memberships_url,
+                },
+                idempotency_key=f"roster:{course_id}",
+                course_id=course_id,
+            )
+            self.set_status(202)
+            self.write(json.dumps({"job_id": job_id}))
+        else:
+            result = await provision_course_roster(course_id, context_memberships_url)
+            self.write(json.dumps(result._asdict()))
+
+
+class LTI13AssignmentsSyncHandler(BaseHandler):
+    """
+    Sets up the assignments of a course with the LTI 1.3 assignment and grade services line
+    items, so the first launch of each assignment does not register it. Only admins can use
+    it. Registered with:
+
+    c.JupyterHub.extra_handlers = [(r"/lti13/assignments", LTI13AssignmentsSyncHandler)]
+    """
+
+    @web.authenticated
+    @admin_only
+    async def post(self) -> None:
+        """
+        Sets up the assignments of the course_id in the JSON body, with its lineitems_url.
+        Both default to the values of the admin's last launch, the lineitems_url must use
+        the platform's host. The assignments are set up by the provisioning queue when it
+        is enabled, the response includes the job id.
+        """
+        try:
+            body = json.loads(self.request.body or b"{}")
+        except ValueError:
+            raise web.HTTPError(400, "Invalid JSON body")
+        auth_state = await self.current_user.get_auth_state() or {}
+        course_id = body.get("course_id") or auth_state.get("course_id")
+        lineitems_url = get_platform_service_url("lineitems_url", body, auth_state)
+        if not course_id or not lineitems_url:
+            raise web.HTTPError(400, "course_id and lineitems_url are required")
+        course_id = normalize_string(course_id)
+        self.set_header("Content-Type", "application/json")
+        if PROVISIONING_QUEUE_ENABLED:
+            job_id = await get_provisioning_queue().enqueue(
+                "sync_assignments",
+                {"course_id": course_id, "lineitems_url": lineitems_url},
+                idempotency_key=f"assignments:{course_id}",
+                course_id=course_id,
+            )
+            self.set_status(202)
+            self.write(json.dumps({"job_id": job_id}))
+        else:
+            result = await sync_course_assignments(course_id, lineitems_url)
+            self.write(json.dumps(result._asdict()))
 
 
 class FileSelectHandler(BaseHandler):
@@ -0,0 +1,325 @@
+"""
+LTI 1.3 Names and Role Provisioning Services (NRPS) client, used to provision the roster
+of a course before the students launch the tool for the first time.
+
+Usage (with the env vars used by the hub):
+    python3 -m illumidesk.lti13.nrps <course_id> <context_memberships_url>
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import re
+from typing import Any
+from typing import AsyncIterator
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from urllib.parse import parse_qsl
+from urllib.parse import urlencode
+from urllib.parse import urlparse
+
+from tornado.httpclient import AsyncHTTPClient
+
+from illumidesk.apis.jupyterhub_api import get_jupyterhub_api
+from illumidesk.apis.nbgrader_service import AsyncNbGraderServiceHelper
+from illumidesk.apis.provisioning import GRADEBOOK_STEP
+from illumidesk.apis.provisioning import GROUP_STEP
+from illumidesk.apis.provisioning import enrollment_key
+from illumidesk.apis.provisioning import get_provisioning_ledger
+from illumidesk.apis.provisioning import step_key
+from illumidesk.apis.provisioning_queue import register_job_handler
+from illumidesk.authenticators.roles import LEARNER_ROLE
+from illumidesk.authenticators.roles import resolve_roles
+from illumidesk.authenticators.utils import email_to_username
+from illumidesk.authenticators.utils import normalize_string
+from illumidesk.lti13.auth import get_lms_access_token
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+
+
+NRPS_SCOPE = "https://purl.imsglobal.org/spec/lti-nrps/scope/contextmembership.readonly"
+NRPS_MEDIA_TYPE = "application/vnd.ims.lti-nrps.v2.membershipcontainer+json"
+
+# members requested per page of the membership container
+LTI13_NRPS_PAGE_SIZE = int(os.environ.get("LTI13_NRPS_PAGE_SIZE") or 500)
+# members written to the gradebook and the jupyterhub groups at a time
+LTI13_NRPS_BATCH_SIZE = int(os.environ.get("LTI13_NRPS_BATCH_SIZE") or 100)
+
+LINK_NEXT_REGEX = re.compile(r'<([^>]+)>\s*;[^,]*rel="?next"?')
+
+
+def get_next_link(link_headers: Iterable[str]) -> Optional[str]:
+    """
+    Returns the url of the next page from the Link headers of a membership container
+    response, or None with the last page.
+    """
+    for header in link_headers:
+        match = LINK_NEXT_REGEX.search(header)
+        if match:
+            return match.group(1)
+    return None
+
+
+class RosterMember(NamedTuple):
+    """
+    A course member with the values used by the course setup, normalized as they are
+    when the member launches the tool.
+    """
+
+    username: str
+    lms_user_id: str
+    user_role: str
+
+
+def get_roster_member(member: Dict[str, Any]) -> Optional[RosterMember]:
+    """
+    Returns the RosterMember of a member of the membership container, or None if the member
+    is not active or has no user identity. The username follows the same precedence as the
+    LTI 1.3 launch claims: email, name, given name, family name and sourced id.
+    """
+    if (member.get("status") or "Active") != "Active":
+        return None
+    if member.get("email"):
+        username = email_to_username(member["email"])
+    else:
+        username = (
+            member.get("name")
+            or member.get("given_name")
+            or member.get("family_name")
+            or (member.get("lis_person_sourcedid") or "").lower()
+            or str(member.get("user_id") or "")
+        )
+    username = normalize_string(username) if username else ""
+    lms_user_id = str(member.get("user_id") or "")
+    if not username or not lms_user_id:
+        return None
+    user_role = resolve_roles(member.get("roles") or ()).user_role or LEARNER_ROLE
+    return RosterMember(username, lms_user_id, user_role)
+
+
+class NamesRolesServiceClient:
+    """
+    Client of the platform's names and role provisioning service. The membership container
+    is requested one page at a time, following the Link headers, so the roster is never
+    held in memory as a whole.
+
+    Attributes:
+      token_endpoint: the platform's token endpoint
+      private_key_path: path of the tool's private key (pem)
+      client_id: the tool's client id
+      page_size: members requested per page
+    """
+
+    def __init__(
+        self,
+        token_endpoint: str = None,
+        private_key_path: str = None,
+        client_id: str = None,
+        page_size: int = LTI13_NRPS_PAGE_SIZE,
+    ):
+        self.token_endpoint = token_endpoint or os.environ.get("LTI13_TOKEN_URL")
+        if not self.token_endpoint:
+            raise EnvironmentError("LTI13_TOKEN_URL env-var is not set")
+        self.private_key_path = private_key_path or os.environ.get("LTI13_PRIVATE_KEY")
+        if not self.private_key_path:
+            raise EnvironmentError("LTI13_PRIVATE_KEY env-var is not set")
+        self.client_id = client_id or os.environ.get("LTI13_CLIENT_ID")
+        if not self.client_id:
+            raise EnvironmentError("LTI13_CLIENT_ID env-var is not set")
+        self.page_size = page_size
+
+    async def get_access_token(self) -> str:
+        """Gets an access token with the membership scope"""
+        token = await get_lms_access_token(
+            self.token_endpoint, self.private_key_path, self.client_id, scope=NRPS_SCOPE
+        )
+        return token["access_token"]
+
+    async def iter_members(self, context_memberships_url: str) -> AsyncIterator[Dict]:
+        """
+        Iterates over the members of the course, one page at a time.
+
+        Args:
+          context_memberships_url: the course's membership container url, sent with the
+            launch requests in the names and role provisioning service claim
+
+        Returns:
+          An async iterator of the members as returned by the platform
+        """
+        access_token = await self.get_access_token()
+        client = AsyncHTTPClient()
+        parsed = urlparse(context_memberships_url)
+        query = dict(parse_qsl(parsed.query))
+        query.setdefault("limit", str(self.page_size))
+        url = parsed._replace(query=urlencode(query)).geturl()
+        pages = 0
+        while url:
+            resp = await client.fetch(
+                url,
+                headers={
+                    "Authorization": f"Bearer {access_token}",
+                    "Accept": NRPS_MEDIA_TYPE,
+                },
+            )
+            pages += 1
+            for member in json.loads(resp.body).get("members") or []:
+                yield member
+            url = get_next_link(resp.headers.get_list("Link"))
+        logger.debug("Read %s pages from %s" % (pages, context_memberships_url))
+
+
+class RosterProvisioningResult(NamedTuple):
+    """
+    The number of members provisioned, skipped (inactive, without identity or already
+    provisioned) and failed.
+    """
+
+    provisioned: int
+    skipped: int
+    failed: int
+
+
+async def _provision_batch(course_id: str, batch: List[RosterMember]) -> int:
+    ledger = get_provisioning_ledger()
+    nb_service = AsyncNbGraderServiceHelper(course_id)
+    added = set(
+        await nb_service.add_users_to_nbgrader_gradebook(
+            (member.username, member.lms_user_id) for member in batch
+        )
+    )
+    jupyterhub_api = get_jupyterhub_api()
+
+    async def add_to_group(member: RosterMember) -> bool:
+        if resolve_roles(member.user_role).is_instructor:
+            return await jupyterhub_api.add_instructor_to_jupyterhub_group(
+                course_id, member.username
+            )
+        return await jupyterhub_api.add_student_to_jupyterhub_group(
+            course_id, member.username
+        )
+
+    # the group batcher writes the members of the batch with one request per group
+    results = await asyncio.gather(
+        *[add_to_group(member) for member in batch], return_exceptions=True
+    )
+    provisioned = 0
+    for member, group_member in zip(batch, results):
+        enrollment = enrollment_key(
+            course_id, member.username, member.user_role, member.lms_user_id
+        )
+        if member.username in added:
+            await ledger.mark_done(step_key(enrollment, GRADEBOOK_STEP.name))
+        if group_member is True:
+            await ledger.mark_done(step_key(enrollment, GROUP_STEP.name))
+        else:
+            logger.error(
+                "Error adding %s to the groups of course %s: %s"
+                % (member.username, course_id, group_member)
+            )
+        if member.username in added and group_member is True:
+            provisioned += 1
+    return provisioned
+
+
+async def provision_roster(
+    course_id: str,
+    members: AsyncIterator[Dict],
+    batch_size: int = LTI13_NRPS_BATCH_SIZE,
+) -> RosterProvisioningResult:
+    """
+    Adds the members of a course to the course's gradebook and jupyterhub groups in
+    batches, and registers them in the provisioning ledger, so the first launch of each
+    member skips the course setup.
+
+    Args:
+      course_id: the normalized course id
+      members: the members returned by the names and role provisioning service
+      batch_size: members written at a time
+
+    Returns:
+      The RosterProvisioningResult
+    """
+    ledger = get_provisioning_ledger()
+    await AsyncNbGraderServiceHelper(course_id).create_database_if_not_exists()
+    provisioned = skipped = failed = 0
+    batch: List[RosterMember] = []
+
+    async def flush() -> None:
+        nonlocal provisioned, failed
+        done = await _provision_batch(course_id, batch)
+        provisioned += done
+        failed += len(batch) - done
+        batch.clear()
+
+    async for member in members:
+        roster_member = get_roster_member(member)
+        if roster_member is None:
+            skipped += 1
+            continue
+        enrollment = enrollment_key(
+            course_id,
+            roster_member.username,
+            roster_member.user_role,
+            roster_member.lms_user_id,
+        )
+        if await ledger.is_done(
+            step_key(enrollment, GRADEBOOK_STEP.name)
+        ) and await ledger.is_done(step_key(enrollment, GROUP_STEP.name)):
+            skipped += 1
+            continue
+        batch.append(roster_member)
+        if len(batch) >= batch_size:
+            await flush()
+    if batch:
+        await flush()
+    result = RosterProvisioningResult(provisioned, skipped, failed)
+    logger.info("Provisioned roster of course %s: %s" % (course_id, result))
+    return result
+
+
+async def provision_course_roster(
+    course_id: str, context_memberships_url: str
+) -> RosterProvisioningResult:
+    """
+    Provisions the roster of a course read from the platform's names and role
+    provisioning service.
+    """
+    client = NamesRolesServiceClient()
+    return await provision_roster(
+        normalize_string(course_id), client.iter_members(context_memberships_url)
+    )
+
+
+async def _run_provision_roster_job(payload: Dict[str, Any]) -> bool:
+    result = await provision_course_roster(**payload)
+    return result.failed == 0
+
+
+register_job_handler("provision_roster", _run_provision_roster_job)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Provisions the roster of a course with the LTI 1.3 names and role "
+        "provisioning service"
+    )
+    parser.add_argument("course_id", help="the course id (context label)")
+    parser.add_argument(
+        "context_memberships_url", help="the course's membership container url"
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    result = asyncio.run(
+        provision_course_roster(args.course_id, args.context_memberships_url)
+    )
+    print(json.dumps(result._asdict()))
+
+
+if __name__ == "__main__":
+    main()
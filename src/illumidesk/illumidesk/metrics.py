@@ -0,0 +1,246 @@
+"""
+Prometheus metrics exported by the IllumiDesk JupyterHub extensions.
+
+Metrics are registered with the default prometheus_client registry, which is the
+registry served by JupyterHub's /hub/metrics endpoint. We follow JupyterHub's naming
+convention: `illumidesk_<noun>_<verb>_<type_suffix>`.
+"""
+
+from enum import Enum
+
+from prometheus_client import Counter
+from prometheus_client import Gauge
+from prometheus_client import Histogram
+
+NONCES = Gauge(
+    "illumidesk_nonces",
+    "number of nonces remembered to detect replayed launches",
+    ["store"],
+)
+
+NONCE_EVICTIONS_TOTAL = Counter(
+    "illumidesk_nonce_evictions_total",
+    "number of nonces forgotten because their time bucket expired",
+    ["store"],
+)
+
+NONCE_REJECTIONS_TOTAL = Counter(
+    "illumidesk_nonce_rejections_total",
+    "number of launches rejected by a nonce store",
+    ["store", "reason"],
+)
+
+GRADEBOOK_TASKS = Gauge(
+    "illumidesk_gradebook_tasks",
+    "number of gradebook operations waiting for their course or running in the thread pool",
+    ["state"],
+)
+
+GRADEBOOK_TASK_DURATION_SECONDS = Histogram(
+    "illumidesk_gradebook_task_duration_seconds",
+    "time taken by gradebook operations in the thread pool",
+    ["operation", "status"],
+)
+
+PROVISIONING_STEP_DURATION_SECONDS = Histogram(
+    "illumidesk_provisioning_step_duration_seconds",
+    "time taken by the course provisioning steps run with each launch",
+    ["step", "status"],
+)
+
+PROVISIONING_SINGLE_FLIGHT_CALLS_TOTAL = Counter(
+    "illumidesk_provisioning_single_flight_calls_total",
+    "number of provisioning operations run (leader) or awaited (follower) per course and step",
+    ["step", "role"],
+)
+
+JUPYTERHUB_API_RETRIES_TOTAL = Counter(
+    "illumidesk_jupyterhub_api_retries_total",
+    "number of failed requests to the hub api retried or given up due to the retry budget",
+    ["outcome"],
+)
+
+JUPYTERHUB_GROUP_BATCH_USERS = Histogram(
+    "illumidesk_jupyterhub_group_batch_users",
+    "number of users added to a JupyterHub group with a single request",
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200),
+)
+
+LTI13_ACCESS_TOKEN_REQUESTS_TOTAL = Counter(
+    "illumidesk_lti13_access_token_requests_total",
+    "number of LMS access tokens requested by result of the access token cache",
+    ["result"],
+)
+
+NBGRADER_DB_ENGINE_REQUESTS_TOTAL = Counter(
+    "illumidesk_nbgrader_db_engine_requests_total",
+    "number of gradebook sessions opened by result of the course engine lookup",
+    ["result"],
+)
+
+NBGRADER_DB_ENGINE_EVICTIONS_TOTAL = Counter(
+    "illumidesk_nbgrader_db_engine_evictions_total",
+    "number of course engines disposed by the gradebook engine registry",
+    ["reason"],
+)
+
+NBGRADER_DB_ENGINES = Gauge(
+    "illumidesk_nbgrader_db_engines",
+    "number of course engines kept by the gradebook engine registry",
+)
+
+NBGRADER_DB_CONNECTIONS = Gauge(
+    "illumidesk_nbgrader_db_connections",
+    "number of connections open to the course gradebook databases",
+    ["state"],
+)
+
+NBGRADER_DB_UPSERT_ROWS_TOTAL = Counter(
+    "illumidesk_nbgrader_db_upsert_rows_total",
+    "number of rows written to the gradebooks by the bulk upserts by table and outcome",
+    ["table", "outcome"],
+)
+
+
+class NonceRejectionReason(Enum):
+    """
+    Possible values for 'reason' label of NONCE_REJECTIONS_TOTAL
+    """
+
+    replay = "replay"
+    expired = "expired"
+    capacity = "capacity"
+
+    def __str__(self):
+        return self.value
+
+
+class GradebookTaskState(Enum):
+    """
+    Possible values for 'state' label of GRADEBOOK_TASKS
+    """
+
+    queued = "queued"
+    running = "running"
+
+    def __str__(self):
+        return self.value
+
+
+class SingleFlightRole(Enum):
+    """
+    Possible values for 'role' label of PROVISIONING_SINGLE_FLIGHT_CALLS_TOTAL
+    """
+
+    leader = "leader"
+    follower = "follower"
+
+    def __str__(self):
+        return self.value
+
+
+class RetryOutcome(Enum):
+    """
+    Possible values for 'outcome' label of JUPYTERHUB_API_RETRIES_TOTAL
+    """
+
+    retried = "retried"
+    budget_exhausted = "budget_exhausted"
+
+    def __str__(self):
+        return self.value
+
+
+class AccessTokenResult(Enum):
+    """
+    Possible values for 'result' label of LTI13_ACCESS_TOKEN_REQUESTS_TOTAL
+    """
+
+    hit = "hit"
+    refresh = "refresh"
+    miss = "miss"
+
+    def __str__(self):
+        return self.value
+
+
+class EngineRequestResult(Enum):
+    """
+    Possible values for 'result' label of NBGRADER_DB_ENGINE_REQUESTS_TOTAL
+    """
+
+    hit = "hit"
+    miss = "miss"
+
+    def __str__(self):
+        return self.value
+
+
+class EngineEvictionReason(Enum):
+    """
+    Possible values for 'reason' label of NBGRADER_DB_ENGINE_EVICTIONS_TOTAL
+    """
+
+    capacity = "capacity"
+    idle = "idle"
+
+    def __str__(self):
+        return self.value
+
+
+class ConnectionState(Enum):
+    """
+    Possible values for 'state' label of NBGRADER_DB_CONNECTIONS
+    """
+
+    idle = "idle"
+    in_use = "in_use"
+
+    def __str__(self):
+        return self.value
+
+
+class UpsertOutcome(Enum):
+    """
+    Possible values for 'outcome' label of NBGRADER_DB_UPSERT_ROWS_TOTAL
+
+    inserted: the row did not exist
+    updated: the row existed and its columns were updated
+    invalid: the row misses its key and was not written
+    failed: the transaction writing the row failed
+    """
+
+    inserted = "inserted"
+    updated = "updated"
+    invalid = "invalid"
+    failed = "failed"
+
+    def __str__(self):
+        return self.value
+
+
+for store in ("lti11",):
+    for reason in NonceRejectionReason:
+        NONCE_REJECTIONS_TOTAL.labels(store=store, reason=reason)
+
+for state in GradebookTaskState:
+    GRADEBOOK_TASKS.labels(state=state)
+
+for outcome in RetryOutcome:
+    JUPYTERHUB_API_RETRIES_TOTAL.labels(outcome=outcome)
+
+for result in AccessTokenResult:
+    LTI13_ACCESS_TOKEN_REQUESTS_TOTAL.labels(result=result)
+
+for result in EngineRequestResult:
+    NBGRADER_DB_ENGINE_REQUESTS_TOTAL.labels(result=result)
+
+for reason in EngineEvictionReason:
+    NBGRADER_DB_ENGINE_EVICTIONS_TOTAL.labels(reason=reason)
+
+for state in ConnectionState:
+    NBGRADER_DB_CONNECTIONS.labels(state=state)
+
+for table in ("student", "assignment"):
+    for outcome in UpsertOutcome:
+        NBGRADER_DB_UPSERT_ROWS_TOTAL.labels(table=table, outcome=outcome)
@@ -0,0 +1,113 @@
+from unittest.mock import Mock
+from unittest.mock import patch
+
+import pytest
+from nbgrader.api import Gradebook
+from sqlalchemy import create_engine
+
+from illumidesk.apis.gradebook_migration import copy_gradebook
+from illumidesk.apis.gradebook_migration import list_course_databases
+from illumidesk.apis.gradebook_migration import migrate_course
+from illumidesk.apis.nbgrader_service import GradebookDatabaseCatalog
+from illumidesk.apis.nbgrader_service import get_database_schema_version
+
+
+def test_copy_gradebook_copies_the_tables_and_the_schema_version(tmp_path):
+    """
+    Are the rows and the schema version of the course database copied to the target?
+    """
+    source_url = f"sqlite:///{tmp_path}/course1.db"
+    with Gradebook(source_url, course_id="course1") as gb:
+        gb.update_or_create_student("student1", lms_user_id="user-1")
+        gb.update_or_create_student("student2", lms_user_id="user-2")
+        gb.update_or_create_assignment("lab1")
+    source = create_engine(source_url)
+    target = create_engine(f"sqlite:///{tmp_path}/target.db")
+
+    rows = copy_gradebook(source, target)
+
+    assert rows["student"] == 2
+    assert rows["assignment"] == 1
+    assert rows["course"] == 1
+    assert get_database_schema_version(target) == get_database_schema_version(source)
+    with Gradebook(f"sqlite:///{tmp_path}/target.db", course_id="course1") as gb:
+        assert [s.id for s in gb.students] == ["student1", "student2"]
+        assert gb.find_student("student1").lms_user_id == "user-1"
+
+
+def test_copy_gradebook_fails_when_the_target_has_the_tables(tmp_path):
+    """
+    Is a target with a gradebook left as is?
+    """
+    source_url = f"sqlite:///{tmp_path}/course1.db"
+    with Gradebook(source_url, course_id="course1") as gb:
+        gb.update_or_create_student("student1")
+    target_url = f"sqlite:///{tmp_path}/target.db"
+    with Gradebook(target_url, course_id="course1") as gb:
+        gb.update_or_create_student("student2")
+
+    with pytest.raises(Exception):
+        copy_gradebook(create_engine(source_url), create_engine(target_url))
+
+    with Gradebook(target_url, course_id="course1") as gb:
+        assert [s.id for s in gb.students] == ["student2"]
+
+
+def test_list_course_databases_excludes_the_shared_and_template_databases(
+    monkeypatch,
+):
+    """
+    Are only the course databases of the organization listed?
+    """
+    monkeypatch.setattr("illumidesk.apis.gradebook_migration.org_name", "org")
+    monkeypatch.setattr(
+        "illumidesk.apis.gradebook_migration.NBGRADER_DB_SHARED_DATABASE",
+        "org_nbgrader",
+    )
+    monkeypatch.setattr(
+        "illumidesk.apis.gradebook_migration.NBGRADER_DB_TEMPLATE", "org_template"
+    )
+    with patch.object(
+        GradebookDatabaseCatalog,
+        "_list_databases",
+        return_value=[
+            "postgres",
+            "org_nbgrader",
+            "org_template",
+            "org_intro101",
+            "org_bio201",
+            "other_intro101",
+        ],
+    ):
+        assert list_course_databases() == ["bio201", "intro101"]
+
+
+def test_migrate_course_reports_the_error_when_the_database_cannot_be_dropped(
+    tmp_path,
+):
+    """
+    Is a failed drop of a copied course reported in its result instead of raised?
+    """
+    schema_catalog = Mock(database="shared")
+    schema_catalog.exists.return_value = False
+    module = "illumidesk.apis.gradebook_migration"
+    with patch(
+        f"{module}.nbgrader_format_database_url",
+        return_value=f"sqlite:///{tmp_path}/source.db",
+    ), patch(
+        f"{module}.nbgrader_format_schema_url",
+        return_value=f"sqlite:///{tmp_path}/target.db",
+    ), patch(
+        f"{module}.get_database_schema_version", return_value="v1"
+    ), patch(
+        f"{module}.get_schema_version", return_value="v1"
+    ), patch(
+        f"{module}.copy_gradebook", return_value={"student": 2}
+    ), patch(
+        f"{module}.drop_course_database",
+        side_effect=RuntimeError("database is being accessed by other users"),
+    ):
+        result = migrate_course("intro101", schema_catalog, drop=True)
+
+    assert result.rows == {"student": 2}
+    assert result.error == "RuntimeError: database is being accessed by other users"
@@ -1,10 +1,19 @@
+import asyncio
 import json
 import os
+from unittest.mock import AsyncMock
+from unittest.mock import Mock
 from unittest.mock import patch
+from urllib.parse import parse_qsl
 
 import pytest
+from tornado.httpclient import AsyncHTTPClient
+from tornado.httpclient import HTTPClientError
 
+from illumidesk.apis.jupyterhub_api import GroupMembershipCache
 from illumidesk.apis.jupyterhub_api import JupyterHubAPI
+from illumidesk.apis.jupyterhub_api import RetryBudget
+from illumidesk.apis.jupyterhub_api import get_jupyterhub_api
 
 
 def test_initializer_raises_error_with_jupyterhub_api_token_env_as_missing(
@@ -268,3 +277,465 @@ async def test_add_group_member_uses_request_helper_method_with_correct_values(
     mock_request.assert_called_with(
         "groups/to_group/users", method="POST", body=json.dumps(body_usernames)
     )
+
+
+def test_get_jupyterhub_api_returns_a_shared_client(jupyterhub_api_environ):
+    """
+    Do the callers share the same client and retry budget?
+    """
+    assert get_jupyterhub_api() is get_jupyterhub_api()
+
+
+@pytest.mark.asyncio
+async def test_client_is_reused_by_requests(jupyterhub_api_environ):
+    """
+    Is the http client (and its connection pool) created once per event loop?
+    """
+    sut = JupyterHubAPI(max_clients=5)
+
+    assert sut.client is sut.client
+    assert sut.client.max_clients == 5
+
+
+def test_retry_budget_limits_retries_to_a_fraction_of_the_requests():
+    """
+    Does the budget allow a retry for every 1/ratio requests once it is exhausted?
+    """
+    budget = RetryBudget(ratio=0.5, capacity=1)
+
+    assert budget.withdraw() is True
+    assert budget.withdraw() is False
+    budget.deposit()
+    assert budget.withdraw() is False
+    budget.deposit()
+    assert budget.withdraw() is True
+
+
+@pytest.mark.asyncio
+async def test_request_retries_server_errors(jupyterhub_api_environ):
+    """
+    Are the requests that fail with a 503 retried?
+    """
+    sut = JupyterHubAPI(max_retries=3)
+    sut.backoff_base = 0
+    with patch.object(
+        AsyncHTTPClient,
+        "fetch",
+        new_callable=AsyncMock,
+        side_effect=[HTTPClientError(503), HTTPClientError(502), "response"],
+    ) as mock_fetch:
+        assert await sut._request("groups/intro101") == "response"
+
+    assert mock_fetch.call_count == 3
+
+
+@pytest.mark.asyncio
+async def test_request_retries_post_requests_only_when_they_were_not_sent(
+    jupyterhub_api_environ,
+):
+    """
+    Are the POST requests retried after a refused connection but not after a 503?
+    """
+    sut = JupyterHubAPI(max_retries=3)
+    sut.backoff_base = 0
+    with patch.object(
+        AsyncHTTPClient,
+        "fetch",
+        new_callable=AsyncMock,
+        side_effect=[ConnectionRefusedError(), "response"],
+    ) as mock_fetch:
+        assert await sut._request("groups/intro101", method="POST") == "response"
+    assert mock_fetch.call_count == 2
+
+    with patch.object(
+        AsyncHTTPClient,
+        "fetch",
+        new_callable=AsyncMock,
+        side_effect=[HTTPClientError(503), "response"],
+    ) as mock_fetch:
+        with pytest.raises(HTTPClientError):
+            await sut._request("groups/intro101", method="POST")
+    assert mock_fetch.call_count == 1
+
+
+@pytest.mark.asyncio
+async def test_client_of_a_previous_event_loop_is_closed(jupyterhub_api_environ):
+    """
+    Is the client bound to another event loop closed when a new client is created?
+    """
+    sut = JupyterHubAPI()
+    previous = Mock(io_loop=object())
+    sut._client = previous
+
+    assert sut.client is not previous
+    assert previous.close.called
+
+
+@pytest.mark.asyncio
+async def test_request_does_not_retry_client_errors(jupyterhub_api_environ):
+    """
+    Are the 4xx errors other than 429 raised without retrying?
+    """
+    sut = JupyterHubAPI(max_retries=3)
+    with patch.object(
+        AsyncHTTPClient,
+        "fetch",
+        new_callable=AsyncMock,
+        side_effect=HTTPClientError(404),
+    ) as mock_fetch:
+        with pytest.raises(HTTPClientError):
+            await sut._request("groups/intro101")
+
+    assert mock_fetch.call_count == 1
+
+
+@pytest.mark.asyncio
+async def test_request_stops_retrying_when_the_retry_budget_is_exhausted(
+    jupyterhub_api_environ,
+):
+    """
+    Is the error raised when the retry budget does not allow another retry?
+    """
+    sut = JupyterHubAPI(max_retries=5, retry_budget=RetryBudget(ratio=0, capacity=1))
+    sut.backoff_base = 0
+    with patch.object(
+        AsyncHTTPClient,
+        "fetch",
+        new_callable=AsyncMock,
+        side_effect=HTTPClientError(429),
+    ) as mock_fetch:
+        with pytest.raises(HTTPClientError):
+            await sut._request("groups/intro101")
+
+    assert mock_fetch.call_count == 2
+
+
+def make_group_response(*users):
+    return Mock(body=json.dumps({"name": "nbgrader-intro101", "users": list(users)}))
+
+
+def test_group_membership_cache_expires_groups_after_the_ttl():
+    """
+    Are the members of a group fresh until the ttl and kept after it?
+    """
+    cache = GroupMembershipCache(ttl=60)
+    cache.set_members("nbgrader-intro101", ["student1"], now=1000)
+
+    assert cache.is_fresh("nbgrader-intro101", now=1059) is True
+    assert cache.is_fresh("nbgrader-intro101", now=1060) is False
+    assert cache.is_member("nbgrader-intro101", "student1") is True
+    assert cache.is_member("nbgrader-intro101", "student2") is False
+    assert cache.is_fresh("formgrade-intro101", now=1000) is False
+
+
+@pytest.mark.asyncio
+async def test_add_user_to_group_loads_the_group_once(jupyterhub_api_environ):
+    """
+    Is the group fetched with the first launch only, with one write per new member?
+    """
+    sut = JupyterHubAPI(group_cache=GroupMembershipCache(ttl=60))
+    sut.group_batcher.window = 0
+    with patch.object(
+        sut, "get_group", return_value=make_group_response("student1")
+    ) as mock_get_group:
+        with patch.object(sut, "add_group_members") as mock_add_group_members:
+            with patch.object(sut, "create_users") as mock_create_users:
+                assert await sut._add_user_to_jupyterhub_group(
+                    "student1", "nbgrader-intro101"
+                )
+                assert await sut._add_user_to_jupyterhub_group(
+                    "student2", "nbgrader-intro101"
+                )
+                assert await sut._add_user_to_jupyterhub_group(
+                    "student2", "nbgrader-intro101"
+                )
+
+    assert mock_get_group.call_count == 1
+    mock_add_group_members.assert_called_once_with("nbgrader-intro101", "student2")
+    assert not mock_create_users.called
+
+
+@pytest.mark.asyncio
+async def test_group_batcher_adds_concurrent_members_with_one_request(
+    jupyterhub_api_environ,
+):
+    """
+    Are the users added to a group within the window written with a single request?
+    """
+    sut = JupyterHubAPI(group_cache=GroupMembershipCache(ttl=60))
+    sut.group_cache.set_members("nbgrader-intro101", [])
+    with patch.object(sut, "add_group_members") as mock_add_group_members:
+        results = await asyncio.gather(
+            *[
+                sut._add_user_to_jupyterhub_group(f"student{i}", "nbgrader-intro101")
+                for i in range(5)
+            ]
+        )
+
+    assert results == [True] * 5
+    mock_add_group_members.assert_called_once_with(
+        "nbgrader-intro101", *[f"student{i}" for i in range(5)]
+    )
+    assert sut.group_cache.is_member("nbgrader-intro101", "student4")
+
+
+@pytest.mark.asyncio
+async def test_group_batcher_flushes_full_batches_before_the_window_ends(
+    jupyterhub_api_environ,
+):
+    """
+    Is a group written as soon as it has max_batch pending users?
+    """
+    sut = JupyterHubAPI()
+    sut.group_batcher.window = 60
+    sut.group_batcher.max_batch = 2
+    with patch.object(sut, "add_group_members") as mock_add_group_members:
+        await asyncio.wait_for(
+            asyncio.gather(
+                sut.group_batcher.add("nbgrader-intro101", "student1"),
+                sut.group_batcher.add("nbgrader-intro101", "student2"),
+            ),
+            1,
+        )
+
+    assert mock_add_group_members.call_count == 1
+
+
+@pytest.mark.asyncio
+async def test_add_user_to_group_creates_users_unknown_to_the_hub(
+    jupyterhub_api_environ,
+):
+    """
+    Are the users created in bulk when the hub rejects the new members with a 400?
+    """
+    sut = JupyterHubAPI(group_cache=GroupMembershipCache(ttl=60))
+    sut.group_cache.set_members("nbgrader-intro101", [])
+    with patch.object(
+        sut,
+        "add_group_members",
+        new_callable=AsyncMock,
+        side_effect=[HTTPClientError(400), None],
+    ) as mock_add_group_members:
+        with patch.object(sut, "create_users") as mock_create_users:
+            assert await sut._add_user_to_jupyterhub_group(
+                "student1", "nbgrader-intro101"
+            )
+
+    mock_create_users.assert_called_once_with("student1")
+    assert mock_add_group_members.call_count == 2
+    assert sut.group_cache.is_member("nbgrader-intro101", "student1")
+
+
+@pytest.mark.asyncio
+async def test_group_batcher_fans_failures_back_to_each_user(jupyterhub_api_environ):
+    """
+    Does a user rejected by the hub fail alone, and does a server error fail every user
+    in the batch?
+    """
+    sut = JupyterHubAPI()
+
+    async def add_group_members(group_name, *usernames):
+        if "bad user" in usernames:
+            raise HTTPClientError(400)
+
+    with patch.object(sut, "add_group_members", side_effect=add_group_members):
+        with patch.object(sut, "create_users"):
+            results = await asyncio.gather(
+                sut.group_batcher.add("nbgrader-intro101", "student1"),
+                sut.group_batcher.add("nbgrader-intro101", "bad user"),
+                return_exceptions=True,
+            )
+
+    assert results[0] is None
+    assert isinstance(results[1], HTTPClientError)
+
+    with patch.object(
+        sut, "add_group_members", side_effect=HTTPClientError(503)
+    ) as mock_add_group_members:
+        results = await asyncio.gather(
+            sut.group_batcher.add("nbgrader-intro101", "student1"),
+            sut.group_batcher.add("nbgrader-intro101", "student2"),
+            return_exceptions=True,
+        )
+
+    assert all(isinstance(result, HTTPClientError) for result in results)
+    assert mock_add_group_members.call_count == 1
+
+
+@pytest.mark.asyncio
+async def test_add_user_to_group_refreshes_stale_groups_in_the_background(
+    jupyterhub_api_environ,
+):
+    """
+    Does a member of a stale group get an answer without waiting for the hub?
+    """
+    sut = JupyterHubAPI(group_cache=GroupMembershipCache(ttl=60))
+    sut.group_cache.set_members("nbgrader-intro101", ["student1"], now=0)
+    with patch.object(
+        sut, "get_group", return_value=make_group_response("student1", "student2")
+    ) as mock_get_group:
+        assert await sut._add_user_to_jupyterhub_group("student1", "nbgrader-intro101")
+        assert not mock_get_group.called
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+
+    assert mock_get_group.call_count == 1
+    assert sut.group_cache.is_member("nbgrader-intro101", "student2")
+    assert sut.group_cache.is_fresh("nbgrader-intro101")
+
+
+@pytest.mark.asyncio
+async def test_concurrent_group_loads_send_a_single_request(jupyterhub_api_environ):
+    """
+    Do concurrent launches fetch the group members once, without the provisioning locks?
+    """
+    sut = JupyterHubAPI(group_cache=GroupMembershipCache(ttl=60))
+
+    async def get_group(group_name):
+        await asyncio.sleep(0.01)
+        return make_group_response("student1")
+
+    with patch.object(sut, "get_group", side_effect=get_group) as mock_get_group:
+        with patch(
+            "illumidesk.apis.provisioning.SingleFlight.run"
+        ) as mock_single_flight:
+            await asyncio.gather(
+                *[sut._load_group_members("nbgrader-intro101") for _ in range(5)]
+            )
+
+    assert mock_get_group.call_count == 1
+    assert not mock_single_flight.called
+    assert sut.group_cache.is_member("nbgrader-intro101", "student1")
+    assert sut._group_requests == {}
+
+
+@pytest.mark.asyncio
+async def test_add_student_to_group_skips_groups_in_the_cache(jupyterhub_api_environ):
+    """
+    Is the student group created once and seeded with the members returned by the hub?
+    """
+    sut = JupyterHubAPI(group_cache=GroupMembershipCache(ttl=60))
+    with patch.object(
+        sut, "create_group", return_value=make_group_response("student1")
+    ) as mock_create_group:
+        with patch.object(sut, "get_group") as mock_get_group:
+            assert await sut.add_student_to_jupyterhub_group("intro101", "student1")
+            assert await sut.add_student_to_jupyterhub_group("intro101", "student1")
+
+    assert mock_create_group.call_count == 1
+    assert not mock_get_group.called
+
+
+def make_paginated_request(users, max_limit=None, with_total=True):
+    requests = []
+
+    async def _request(endpoint, **kwargs):
+        requests.append((endpoint, kwargs.get("headers")))
+        path, _, query = endpoint.partition("?")
+        params = dict(parse_qsl(query))
+        offset = int(params["offset"])
+        limit = min(int(params["limit"]), max_limit or int(params["limit"]))
+        items = users[offset : offset + limit]
+        next_page = None
+        if offset + limit < len(users):
+            next_page = {"offset": offset + limit, "limit": limit}
+        pagination = {"offset": offset, "limit": limit, "next": next_page}
+        if with_total:
+            pagination["total"] = len(users)
+        return Mock(body=json.dumps({"items": items, "_pagination": pagination}))
+
+    return _request, requests
+
+
+@pytest.mark.asyncio
+async def test_iter_users_follows_the_hub_pagination(jupyterhub_api_environ):
+    """
+    Are all the users yielded in order, requesting one page at a time with the
+    pagination accept header?
+    """
+    sut = JupyterHubAPI()
+    users = [{"name": f"student{i}"} for i in range(25)]
+    _request, requests = make_paginated_request(users)
+
+    with patch.object(sut, "_request", side_effect=_request):
+        result = [user async for user in sut.iter_users(page_size=10, concurrency=2)]
+
+    assert result == users
+    assert [endpoint for endpoint, _ in requests] == [
+        "users?offset=0&limit=10",
+        "users?offset=10&limit=10",
+        "users?offset=20&limit=10",
+    ]
+    assert requests[0][1] == {"Accept": "application/jupyterhub-pagination+json"}
+
+
+@pytest.mark.asyncio
+async def test_iter_users_uses_the_page_size_capped_by_the_hub(jupyterhub_api_environ):
+    """
+    Are the offsets based on the limit returned by the hub, and are the next links
+    followed when the hub does not return the total?
+    """
+    sut = JupyterHubAPI()
+    users = [{"name": f"student{i}"} for i in range(7)]
+
+    for with_total in (True, False):
+        _request, requests = make_paginated_request(
+            users, max_limit=3, with_total=with_total
+        )
+        with patch.object(sut, "_request", side_effect=_request):
+            result = [user async for user in sut.iter_users(page_size=100)]
+
+        assert result == users
+        assert len(requests) == 3
+
+
+@pytest.mark.asyncio
+async def test_iter_users_stops_requesting_pages_when_the_consumer_stops(
+    jupyterhub_api_environ,
+):
+    """
+    Are at most concurrency pages requested ahead of the consumer?
+    """
+    sut = JupyterHubAPI()
+    users = [{"name": f"student{i}"} for i in range(100)]
+    _request, requests = make_paginated_request(users)
+
+    with patch.object(sut, "_request", side_effect=_request):
+        async for user in sut.iter_users(state="active", page_size=10, concurrency=2):
+            break
+        await asyncio.sleep(0)
+
+    assert len(requests) <= 3
+    assert requests[0][0] == "users?state=active&offset=0&limit=10"
+
+
+@pytest.mark.asyncio
+async def test_iter_groups_with_hubs_without_pagination(jupyterhub_api_environ):
+    """
+    Are the groups returned as a plain list by hubs older than 2.0 yielded?
+    """
+    sut = JupyterHubAPI()
+    groups = [{"name": "nbgrader-intro101", "users": []}]
+
+    with patch.object(
+        sut, "_request", return_value=Mock(body=json.dumps(groups))
+    ) as mock_request:
+        result = [group async for group in sut.iter_groups()]
+
+    assert result == groups
+    assert mock_request.call_count == 1
+
+
+@pytest.mark.asyncio
+async def test_iter_group_members_yields_usernames(jupyterhub_api_environ):
+    """
+    Are the members of the group yielded?
+    """
+    sut = JupyterHubAPI()
+
+    with patch.object(
+        sut, "get_group", return_value=make_group_response("student1", "student2")
+    ):
+        result = [user async for user in sut.iter_group_members("nbgrader-intro101")]
+
+    assert result == ["student1", "student2"]
@@ -0,0 +1,189 @@
+import asyncio
+from unittest.mock import patch
+
+import pytest
+
+from illumidesk.apis.provisioning_queue import DONE
+from illumidesk.apis.provisioning_queue import FAILED
+from illumidesk.apis.provisioning_queue import PENDING
+from illumidesk.apis.provisioning_queue import ProvisioningQueue
+from illumidesk.apis.provisioning_queue import create_provisioning_queue
+from illumidesk.apis.provisioning_queue import register_job_handler
+
+
+@pytest.fixture
+def queue():
+    queue = create_provisioning_queue("memory://", workers=0, max_attempts=2)
+    yield queue
+    queue.close()
+
+
+@pytest.fixture
+def job_calls():
+    calls = []
+
+    async def handler(payload):
+        calls.append(payload)
+        return payload.get("result", True)
+
+    register_job_handler("test", handler)
+    return calls
+
+
+@pytest.mark.asyncio()
+async def test_enqueue_returns_the_pending_job_with_the_same_idempotency_key(queue):
+    """
+    Is a job enqueued only once while it is pending?
+    """
+    first = await queue.enqueue("test", {"a": 1}, idempotency_key="key", username="foo")
+    second = await queue.enqueue(
+        "test", {"a": 1}, idempotency_key="key", username="foo"
+    )
+
+    assert first == second
+    assert (await queue.get(first))["status"] == PENDING
+    assert len(await queue.get_user_jobs("foo")) == 1
+
+
+@pytest.mark.asyncio()
+async def test_run_pending_runs_the_jobs_and_marks_them_as_done(queue, job_calls):
+    """
+    Are the jobs run with their payload and marked as done?
+    """
+    job_id = await queue.enqueue("test", {"a": 1}, idempotency_key="key")
+
+    assert await queue.run_pending() == 1
+    assert job_calls == [{"a": 1}]
+    assert (await queue.get(job_id))["status"] == DONE
+    assert await queue.run_pending() == 0
+
+
+@pytest.mark.asyncio()
+async def test_failed_jobs_are_retried_with_backoff_until_max_attempts(
+    queue, job_calls
+):
+    """
+    Are failed jobs retried after the backoff and marked as failed after max attempts?
+    """
+    with patch("illumidesk.apis.provisioning_queue.time.time", return_value=1000):
+        job_id = await queue.enqueue("test", {"result": False}, idempotency_key="key")
+        await queue.run_pending()
+        assert (await queue.get(job_id))["status"] == PENDING
+        assert (await queue.get(job_id))["attempts"] == 1
+    # the job waits for the backoff before running again
+    with patch("illumidesk.apis.provisioning_queue.time.time", return_value=1001):
+        assert await queue.run_pending() == 0
+    with patch("illumidesk.apis.provisioning_queue.time.time", return_value=1002):
+        assert await queue.run_pending() == 1
+
+    job = await queue.get(job_id)
+    assert job["status"] == FAILED
+    assert job["attempts"] == 2
+    assert job["last_error"] == "job did not succeed"
+
+
+@pytest.mark.asyncio()
+async def test_finished_jobs_are_enqueued_again(queue, job_calls):
+    """
+    Does a new launch run a job with the same idempotency key after it finished?
+    """
+    job_id = await queue.enqueue("test", {"a": 1}, idempotency_key="key")
+    await queue.run_pending()
+
+    assert await queue.enqueue("test", {"a": 2}, idempotency_key="key") == job_id
+    await queue.run_pending()
+    assert job_calls == [{"a": 1}, {"a": 2}]
+
+
+@pytest.mark.asyncio()
+async def test_running_jobs_are_pending_again_after_a_restart(tmp_path):
+    """
+    Do the jobs interrupted by a restart run again?
+    """
+    path = str(tmp_path / "queue.db")
+    queue = ProvisioningQueue(path, workers=0)
+    job_id = await queue.enqueue("test", {}, idempotency_key="key")
+    assert queue._claim()["id"] == job_id
+    queue.close()
+
+    queue = ProvisioningQueue(path, workers=0)
+    assert (await queue.get(job_id))["status"] == PENDING
+    queue.close()
+
+
+@pytest.mark.asyncio()
+async def test_workers_drain_the_queue_in_the_background(job_calls):
+    """
+    Do the workers run the enqueued jobs without blocking the caller?
+    """
+    queue = create_provisioning_queue("memory://", workers=2)
+    job_ids = [await queue.enqueue("test", {"a": 0}, idempotency_key="key0")]
+    # enqueue returns before the job runs
+    assert job_calls == []
+    job_ids += [
+        await queue.enqueue("test", {"a": i}, idempotency_key=f"key{i}")
+        for i in range(1, 3)
+    ]
+
+    for _ in range(50):
+        await asyncio.sleep(0.01)
+        jobs = [await queue.get(job_id) for job_id in job_ids]
+        if all(job["status"] == DONE for job in jobs):
+            break
+    await queue.stop()
+    queue.close()
+
+    assert sorted(call["a"] for call in job_calls) == [0, 1, 2]
+
+
+def test_sqlite_queue_requires_an_absolute_path(tmp_path):
+    """
+    Are relative sqlite paths, which depend on the directory the hub runs from, rejected?
+    """
+    with pytest.raises(ValueError):
+        create_provisioning_queue("sqlite:///illumidesk_provisioning.sqlite")
+
+    queue = create_provisioning_queue(f"sqlite:///{tmp_path}/queue.sqlite", workers=0)
+    assert queue.path == f"{tmp_path}/queue.sqlite"
+    queue.close()
+
+
+@pytest.mark.asyncio()
+async def test_start_runs_the_jobs_interrupted_by_a_restart(tmp_path, job_calls):
+    """
+    Do the workers started with the hub run the pending jobs without a new enqueue?
+    """
+    path = str(tmp_path / "queue.db")
+    queue = ProvisioningQueue(path, workers=0)
+    job_id = await queue.enqueue("test", {"a": 1}, idempotency_key="key")
+    assert queue._claim()["id"] == job_id
+    queue.close()
+
+    queue = ProvisioningQueue(path, workers=1, poll_interval=0.01)
+    queue.start()
+    for _ in range(50):
+        await asyncio.sleep(0.01)
+        if (await queue.get(job_id))["status"] == DONE:
+            break
+    await queue.stop()
+    queue.close()
+
+    assert job_calls == [{"a": 1}]
+
+
+@pytest.mark.asyncio()
+async def test_purge_removes_the_jobs_finished_before_the_retention_window(job_calls):
+    """
+    Are only the finished jobs older than the retention window removed?
+    """
+    queue = create_provisioning_queue("memory://", workers=0, retention=60)
+    with patch("illumidesk.apis.provisioning_queue.time.time", return_value=1000):
+        done_id = await queue.enqueue("test", {}, idempotency_key="done")
+        await queue.run_pending()
+        pending_id = await queue.enqueue("test", {}, idempotency_key="pending")
+
+    assert queue.purge(now=1060) == 0
+    assert queue.purge(now=1061) == 1
+    assert await queue.get(done_id) is None
+    assert (await queue.get(pending_id))["status"] == PENDING
+    queue.close()
@@ -0,0 +1,94 @@
+import pytest
+from tornado.web import HTTPError
+
+from illumidesk.authenticators.claims import LTI13_LAUNCH_CLAIMS_SCHEMA
+from illumidesk.authenticators.claims import LaunchClaims
+
+
+def test_parse_returns_launch_claims_with_resource_link_request(
+    make_lti13_resource_link_request,
+):
+    """
+    Does the schema extract the launch values from a resource link request?
+    """
+    result = LTI13_LAUNCH_CLAIMS_SCHEMA.parse(make_lti13_resource_link_request)
+
+    assert isinstance(result, LaunchClaims)
+    assert result.is_deep_linking is False
+    assert result.context_label == "intro101"
+    assert result.username == "foo"
+    assert result.user_role == "Learner"
+    assert result.lms_user_id == "8171934b-f5e2-4f4e-bdbd-6d798615b93e"
+    assert result.resource_link_id == "b81accac78543cb7cd239f3792bcfdc7c6efeadb"
+    assert result.launch_return_url.endswith("external_tool_redirect")
+
+
+def test_parse_returns_launch_claims_with_deep_linking_request(
+    make_lti13_resource_link_request,
+):
+    """
+    Does the schema accept a deep linking request without the resource link claim?
+    """
+    jws = make_lti13_resource_link_request
+    jws[
+        "https://purl.imsglobal.org/spec/lti/claim/message_type"
+    ] = "LtiDeepLinkingRequest"
+    del jws["https://purl.imsglobal.org/spec/lti/claim/resource_link"]
+
+    result = LTI13_LAUNCH_CLAIMS_SCHEMA.parse(jws)
+
+    assert result.is_deep_linking is True
+    assert result.resource_link_id is None
+
+
+def test_parse_extracts_username_from_custom_lms_user_id_with_privacy_enabled(
+    make_lti13_resource_link_request_privacy_enabled,
+):
+    """
+    Is the username obtained from the custom lms_user_id claim when privacy is enabled?
+    """
+    jws = make_lti13_resource_link_request_privacy_enabled
+    jws["name"] = ""
+
+    result = LTI13_LAUNCH_CLAIMS_SCHEMA.parse(jws)
+
+    assert result.username == "4"
+
+
+def test_parse_accepts_a_single_role_as_string(make_lti13_resource_link_request):
+    """
+    Is a roles claim sent as a string handled as a single role?
+    """
+    jws = make_lti13_resource_link_request
+    jws[
+        "https://purl.imsglobal.org/spec/lti/claim/roles"
+    ] = "http://purl.imsglobal.org/vocab/lis/v2/membership#Instructor"
+
+    result = LTI13_LAUNCH_CLAIMS_SCHEMA.parse(jws)
+
+    assert result.roles == (
+        "http://purl.imsglobal.org/vocab/lis/v2/membership#Instructor",
+    )
+    assert result.user_role == "Instructor"
+
+
+def test_parse_raises_an_error_with_missing_resource_link_claim(
+    make_lti13_resource_link_request,
+):
+    """
+    Is a resource link request without the resource link claim rejected?
+    """
+    jws = make_lti13_resource_link_request
+    del jws["https://purl.imsglobal.org/spec/lti/claim/resource_link"]
+
+    with pytest.raises(HTTPError):
+        LTI13_LAUNCH_CLAIMS_SCHEMA.parse(jws)
+
+
+def test_launch_claims_uses_slots():
+    """
+    Does the LaunchClaims object reject attributes that are not declared?
+    """
+    launch_claims = LaunchClaims({}, "LtiResourceLinkRequest")
+    with pytest.raises(AttributeError):
+        launch_claims.foo = "bar"
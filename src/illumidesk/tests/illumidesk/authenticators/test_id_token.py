@@ -0,0 +1,65 @@
+import jwt
+import pytest
+
+from illumidesk.authenticators.id_token import decode_claims
+from illumidesk.authenticators.id_token import parse_compact_jwt
+from illumidesk.authenticators.id_token import validate_claims
+from illumidesk.authenticators.id_token import verify_signature
+
+
+def test_parse_compact_jwt_returns_header_and_payload(
+    make_lti13_resource_link_request, build_lti13_rs256_jwt_id_token
+):
+    """
+    Does parse_compact_jwt decode the header and the claims?
+    """
+    id_token, _ = build_lti13_rs256_jwt_id_token(make_lti13_resource_link_request)
+    compact_jwt = parse_compact_jwt(id_token)
+
+    assert compact_jwt.header["kid"] == "test-kid"
+    assert compact_jwt.header["alg"] == "RS256"
+    assert decode_claims(compact_jwt)["sub"] == make_lti13_resource_link_request["sub"]
+
+
+def test_parse_compact_jwt_raises_an_error_with_malformed_token():
+    """
+    Does parse_compact_jwt raise a DecodeError when the token is malformed?
+    """
+    with pytest.raises(jwt.DecodeError):
+        parse_compact_jwt("not-a-jwt")
+
+
+def test_verify_signature_rejects_not_allowed_algorithms(
+    make_lti13_resource_link_request, build_lti13_jwt_id_token
+):
+    """
+    Does verify_signature reject tokens that are not signed with RS256?
+    """
+    compact_jwt = parse_compact_jwt(
+        build_lti13_jwt_id_token(make_lti13_resource_link_request)
+    )
+    with pytest.raises(jwt.InvalidAlgorithmError):
+        verify_signature(compact_jwt, "secret")
+
+
+def test_validate_claims_raises_an_error_with_expired_token():
+    """
+    Does validate_claims raise an error when the token expired?
+    """
+    with pytest.raises(jwt.ExpiredSignatureError):
+        validate_claims({"exp": 1000}, now=2000)
+
+
+def test_validate_claims_raises_an_error_with_invalid_audience():
+    """
+    Does validate_claims raise an error when the audience does not match?
+    """
+    with pytest.raises(jwt.InvalidAudienceError):
+        validate_claims({"aud": ["client1"]}, audience="client2", now=0)
+
+
+def test_validate_claims_accepts_audience_in_list():
+    """
+    Is the audience accepted when it is included in the aud list?
+    """
+    validate_claims({"aud": ["client1", "client2"]}, audience="client2", now=0)
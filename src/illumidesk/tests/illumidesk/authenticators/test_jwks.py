@@ -0,0 +1,150 @@
+import json
+from io import StringIO
+from unittest.mock import AsyncMock
+from unittest.mock import patch
+
+import pytest
+from tornado.httpclient import AsyncHTTPClient
+from tornado.httpclient import HTTPRequest
+from tornado.httpclient import HTTPResponse
+from tornado.httputil import HTTPHeaders
+
+from illumidesk.authenticators.jwks import PlatformJWKSCache
+from illumidesk.authenticators.jwks import ttl_from_headers
+
+JWKS_ENDPOINT = "https://my.platform.domain/api/lti/security/jwks"
+
+
+def _make_jwks_response(jwks, headers=None):
+    return HTTPResponse(
+        request=HTTPRequest(JWKS_ENDPOINT),
+        code=200,
+        headers=HTTPHeaders(headers or {}),
+        buffer=StringIO(json.dumps(jwks)),
+    )
+
+
+def test_ttl_from_headers_uses_default_ttl_without_caching_headers():
+    """
+    Is the default ttl used when the platform does not send caching headers?
+    """
+    assert ttl_from_headers(HTTPHeaders({}), 600, 3600) == 600
+
+
+def test_ttl_from_headers_uses_cache_control_max_age():
+    """
+    Is the max-age directive used as the ttl?
+    """
+    headers = HTTPHeaders({"Cache-Control": "public, max-age=120"})
+    assert ttl_from_headers(headers, 600, 3600) == 120
+
+
+def test_ttl_from_headers_caps_max_age_with_max_ttl():
+    """
+    Is the ttl advertised by the platform capped to the max ttl?
+    """
+    headers = HTTPHeaders({"Cache-Control": "max-age=999999"})
+    assert ttl_from_headers(headers, 600, 3600) == 3600
+
+
+def test_ttl_from_headers_returns_zero_with_no_store():
+    """
+    Is the response not cached when the platform sends no-store?
+    """
+    headers = HTTPHeaders({"Cache-Control": "no-store"})
+    assert ttl_from_headers(headers, 600, 3600) == 0
+
+
+def test_ttl_from_headers_uses_expires_header():
+    """
+    Is the Expires header used when Cache-Control is not sent?
+    """
+    headers = HTTPHeaders({"Expires": "Thu, 01 Jan 1970 00:05:00 GMT"})
+    assert ttl_from_headers(headers, 600, 3600, now=0) == 300
+
+
+@pytest.mark.asyncio
+async def test_get_key_fetches_platform_jwks_once(make_lti13_platform_jwks):
+    """
+    Are the platform's keys fetched only once for consecutive launches?
+    """
+    sut = PlatformJWKSCache()
+    mock_fetch = AsyncMock(return_value=_make_jwks_response(make_lti13_platform_jwks()))
+    with patch.object(AsyncHTTPClient, "fetch", mock_fetch):
+        first_key = await sut.get_key(JWKS_ENDPOINT, "2020-03-01T00:00:01Z")
+        second_key = await sut.get_key(JWKS_ENDPOINT, "2020-03-01T00:00:01Z")
+        other_key = await sut.get_key(JWKS_ENDPOINT, "2020-04-01T00:00:04Z")
+
+    assert mock_fetch.call_count == 1
+    assert first_key is second_key
+    assert other_key is not first_key
+
+
+@pytest.mark.asyncio
+async def test_get_key_refreshes_the_jwks_once_with_an_unknown_kid(
+    make_lti13_platform_jwks,
+):
+    """
+    Is the jwks fetched again only once when the kid is not found?
+    """
+    sut = PlatformJWKSCache(min_refresh_interval=0)
+    mock_fetch = AsyncMock(return_value=_make_jwks_response(make_lti13_platform_jwks()))
+    with patch.object(AsyncHTTPClient, "fetch", mock_fetch):
+        await sut.get_key(JWKS_ENDPOINT, "2020-03-01T00:00:01Z")
+        with pytest.raises(ValueError):
+            await sut.get_key(JWKS_ENDPOINT, "unknown-kid")
+
+    assert mock_fetch.call_count == 2
+
+
+@pytest.mark.asyncio
+async def test_get_key_limits_the_refreshes_caused_by_unknown_kids(
+    make_lti13_platform_jwks,
+):
+    """
+    Do launches with unknown kids fetch the jwks at most once per refresh interval?
+    """
+    sut = PlatformJWKSCache(min_refresh_interval=10)
+    mock_fetch = AsyncMock(return_value=_make_jwks_response(make_lti13_platform_jwks()))
+    with patch.object(AsyncHTTPClient, "fetch", mock_fetch):
+        with patch("illumidesk.authenticators.jwks.time.time", return_value=1000):
+            await sut.get_key(JWKS_ENDPOINT, "2020-03-01T00:00:01Z")
+            for i in range(5):
+                with pytest.raises(ValueError):
+                    await sut.get_key(JWKS_ENDPOINT, f"unknown-kid-{i}")
+        assert mock_fetch.call_count == 1
+        with patch("illumidesk.authenticators.jwks.time.time", return_value=1010):
+            with pytest.raises(ValueError):
+                await sut.get_key(JWKS_ENDPOINT, "unknown-kid")
+
+    assert mock_fetch.call_count == 2
+    assert sut._refreshes == {}
+
+
+@pytest.mark.asyncio
+async def test_get_key_fetches_jwks_again_when_entry_expired(make_lti13_platform_jwks):
+    """
+    Is the jwks fetched again when the platform asks to not cache the response?
+    """
+    sut = PlatformJWKSCache()
+    response = _make_jwks_response(
+        make_lti13_platform_jwks(), headers={"Cache-Control": "no-cache"}
+    )
+    mock_fetch = AsyncMock(return_value=response)
+    with patch.object(AsyncHTTPClient, "fetch", mock_fetch):
+        await sut.get_key(JWKS_ENDPOINT, "2020-03-01T00:00:01Z")
+        await sut.get_key(JWKS_ENDPOINT, "2020-03-01T00:00:01Z")
+
+    assert mock_fetch.call_count == 2
+
+
+@pytest.mark.asyncio
+async def test_get_key_raises_an_error_with_empty_jwks():
+    """
+    Does get_key raise an error when the platform returns an empty jwks?
+    """
+    sut = PlatformJWKSCache()
+    mock_fetch = AsyncMock(return_value=_make_jwks_response({"message": "ok"}))
+    with patch.object(AsyncHTTPClient, "fetch", mock_fetch):
+        with pytest.raises(ValueError):
+            await sut.get_key(JWKS_ENDPOINT, "2020-03-01T00:00:01Z")
@@ -4,7 +4,6 @@ import pytest
 from tornado.web import RequestHandler
 
 from illumidesk.authenticators.authenticator import LTI13Authenticator
-from illumidesk.authenticators.authenticator import LTIUtils
 from illumidesk.authenticators.validator import LTI13LaunchValidator
 
 
@@ -54,14 +53,14 @@ async def test_authenticator_invokes_lti13validator_jwt_verify_and_decode(
 
 
 @pytest.mark.asyncio
-async def test_authenticator_invokes_lti13validator_validate_launch_request(
+async def test_authenticator_invokes_lti13validator_parse_launch_request(
     make_lti13_resource_link_request,
     build_lti13_jwt_id_token,
     make_mock_request_handler,
     mock_nbhelper,
 ):
     """
-    Does the authenticator invoke the LTI13Validator validate_launch_request method?
+    Does the authenticator invoke the LTI13Validator parse_launch_request method?
     """
     authenticator = LTI13Authenticator()
     request_handler = make_mock_request_handler(
@@ -73,21 +72,23 @@ async def test_authenticator_invokes_lti13validator_validate_launch_request(
         return_value=build_lti13_jwt_id_token(make_lti13_resource_link_request),
     ):
         with patch.object(
-            LTI13LaunchValidator, "validate_launch_request", return_value=True
+            LTI13LaunchValidator,
+            "parse_launch_request",
+            wraps=LTI13LaunchValidator().parse_launch_request,
         ) as mock_verify_authentication_request:
             _ = await authenticator.authenticate(request_handler, None)
             assert mock_verify_authentication_request.called
 
 
 @pytest.mark.asyncio
-async def test_authenticator_invokes_lti_utils_normalize_string(
+async def test_authenticator_invokes_normalize_string(
     make_lti13_resource_link_request,
     build_lti13_jwt_id_token,
     make_mock_request_handler,
     mock_nbhelper,
 ):
     """
-    Does the authenticator invoke the LTIUtils normalize_string method?
+    Does the authenticator invoke the normalize_string function?
     """
     authenticator = LTI13Authenticator()
     request_handler = make_mock_request_handler(
@@ -101,8 +102,9 @@ async def test_authenticator_invokes_lti_utils_normalize_string(
         with patch.object(
             LTI13LaunchValidator, "validate_launch_request", return_value=True
         ):
-            with patch.object(
-                LTIUtils, "normalize_string", return_value=True
+            with patch(
+                "illumidesk.authenticators.authenticator.normalize_string",
+                return_value="intro101",
             ) as mock_normalize_string:
                 _ = await authenticator.authenticate(request_handler, None)
                 assert mock_normalize_string.called
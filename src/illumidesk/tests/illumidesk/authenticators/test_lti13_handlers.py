@@ -1,4 +1,8 @@
 import hashlib
+import json
+from unittest.mock import AsyncMock
+from unittest.mock import Mock
+from unittest.mock import PropertyMock
 from unittest.mock import patch
 from uuid import uuid4
 
@@ -8,6 +12,7 @@ from oauthenticator.oauth2 import _serialize_state
 
 from illumidesk.authenticators.authenticator import LTI13LaunchValidator
 from illumidesk.authenticators.handlers import LTI13LoginHandler
+from illumidesk.authenticators.handlers import ProvisioningStatusHandler
 from illumidesk.authenticators.utils import LTIUtils
 
 
@@ -205,3 +210,39 @@ async def test_lti_13_login_handler_sets_state_with_next_url_obtained_from_targe
                 assert login_instance._state
                 state_decoded = _deserialize_state(login_instance._state)
                 state_decoded["next_url"] == expected_state_json["next_url"]
+
+
+@pytest.mark.asyncio
+async def test_provisioning_status_handler_writes_the_user_jobs(
+    make_mock_request_handler, provisioning_queue
+):
+    """
+    Does the provisioning status handler return the current user's jobs?
+    """
+    job_id = await provisioning_queue.enqueue(
+        "setup_course", {}, idempotency_key="key", course_id="intro101", username="foo"
+    )
+    await provisioning_queue.enqueue(
+        "setup_course",
+        {},
+        idempotency_key="other",
+        course_id="intro101",
+        username="bar",
+    )
+    user = Mock(get_auth_state=AsyncMock(return_value={"course_id": "intro101"}))
+    user.name = "foo"
+    local_handler = make_mock_request_handler(ProvisioningStatusHandler)
+    status_handler = ProvisioningStatusHandler(
+        local_handler.application, local_handler.request
+    )
+    with patch.object(
+        ProvisioningStatusHandler, "current_user", new_callable=PropertyMock
+    ) as mock_current_user:
+        mock_current_user.return_value = user
+        with patch.object(ProvisioningStatusHandler, "write") as mock_write:
+            await status_handler.get()
+
+    result = json.loads(mock_write.call_args[0][0])
+    assert result["ready"] is False
+    assert [job["id"] for job in result["jobs"]] == [job_id]
+    assert result["jobs"][0]["status"] == "pending"
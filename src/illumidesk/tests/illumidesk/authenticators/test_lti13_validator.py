@@ -1,5 +1,6 @@
 from unittest.mock import patch
 
+import jwt
 import pytest
 from tornado.web import HTTPError
 
@@ -8,23 +9,99 @@ from illumidesk.authenticators.validator import LTI13LaunchValidator
 
 @pytest.mark.asyncio
 async def test_validator_jwt_verify_and_decode_invokes_retrieve_matching_jwk(
-    make_lti13_resource_link_request, build_lti13_jwt_id_token
+    make_lti13_resource_link_request, build_lti13_rs256_jwt_id_token
 ):
     """
     Does the validator jwt_verify_and_decode method invoke the retrieve_matching_jwk method?
     """
     validator = LTI13LaunchValidator()
     jwks_endoint = "https://my.platform.domain/api/lti/security/jwks"
+    id_token, public_key = build_lti13_rs256_jwt_id_token(
+        make_lti13_resource_link_request
+    )
     with patch.object(
-        validator, "_retrieve_matching_jwk", return_value=None
+        validator, "_retrieve_matching_jwk", return_value=public_key
     ) as mock_retrieve_matching_jwks:
         _ = await validator.jwt_verify_and_decode(
-            build_lti13_jwt_id_token(make_lti13_resource_link_request),
+            id_token,
             jwks_endoint,
             True,
+            audience=make_lti13_resource_link_request["aud"],
         )
 
         assert mock_retrieve_matching_jwks.called
+        assert mock_retrieve_matching_jwks.call_args[0][1] == "test-kid"
+
+
+@pytest.mark.asyncio
+async def test_validator_jwt_verify_and_decode_returns_read_only_claims(
+    make_lti13_resource_link_request, build_lti13_rs256_jwt_id_token
+):
+    """
+    Does the validator jwt_verify_and_decode method return the verified claims as a read-only mapping?
+    """
+    validator = LTI13LaunchValidator()
+    jwks_endoint = "https://my.platform.domain/api/lti/security/jwks"
+    id_token, public_key = build_lti13_rs256_jwt_id_token(
+        make_lti13_resource_link_request
+    )
+    with patch.object(validator, "_retrieve_matching_jwk", return_value=public_key):
+        claims = await validator.jwt_verify_and_decode(
+            id_token,
+            jwks_endoint,
+            True,
+            audience=make_lti13_resource_link_request["aud"],
+        )
+
+    assert claims["sub"] == make_lti13_resource_link_request["sub"]
+    with pytest.raises(TypeError):
+        claims["sub"] = "foo"
+
+
+@pytest.mark.asyncio
+async def test_validator_jwt_verify_and_decode_raises_an_error_with_wrong_key(
+    make_lti13_resource_link_request, build_lti13_rs256_jwt_id_token
+):
+    """
+    Does the validator jwt_verify_and_decode method raise an error when the signature does not match
+    the platform's key?
+    """
+    validator = LTI13LaunchValidator()
+    jwks_endoint = "https://my.platform.domain/api/lti/security/jwks"
+    id_token, _ = build_lti13_rs256_jwt_id_token(make_lti13_resource_link_request)
+    _, other_public_key = build_lti13_rs256_jwt_id_token(
+        make_lti13_resource_link_request
+    )
+    with patch.object(
+        validator, "_retrieve_matching_jwk", return_value=other_public_key
+    ):
+        with pytest.raises(jwt.InvalidSignatureError):
+            await validator.jwt_verify_and_decode(
+                id_token,
+                jwks_endoint,
+                True,
+                audience=make_lti13_resource_link_request["aud"],
+            )
+
+
+@pytest.mark.asyncio
+async def test_validator_jwt_verify_and_decode_does_not_retrieve_jwk_without_verification(
+    make_lti13_resource_link_request, build_lti13_jwt_id_token
+):
+    """
+    Does the validator skip the platform keys when the verification is off?
+    """
+    validator = LTI13LaunchValidator()
+    jwks_endoint = "https://my.platform.domain/api/lti/security/jwks"
+    with patch.object(validator, "_retrieve_matching_jwk") as mock_retrieve:
+        claims = await validator.jwt_verify_and_decode(
+            build_lti13_jwt_id_token(make_lti13_resource_link_request),
+            jwks_endoint,
+            False,
+        )
+
+    assert not mock_retrieve.called
+    assert claims["sub"] == make_lti13_resource_link_request["sub"]
 
 
 @pytest.mark.asyncio
@@ -0,0 +1,206 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from tornado.web import HTTPError
+
+from illumidesk.authenticators.nonce import MemoryNonceStore
+from illumidesk.authenticators.nonce import SQLiteNonceStore
+from illumidesk.authenticators.nonce import TimestampNonceRing
+from illumidesk.authenticators.nonce import create_nonce_store
+from illumidesk.authenticators.nonce import get_login_nonce
+from illumidesk.authenticators.validator import LTI13LaunchValidator
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def nonce_store(request, tmp_path):
+    if request.param == "sqlite":
+        return SQLiteNonceStore(str(tmp_path / "nonces.db"), ttl=60)
+    return MemoryNonceStore(ttl=60, bucket_seconds=10)
+
+
+@pytest.mark.asyncio
+async def test_check_and_add_accepts_new_nonce(nonce_store):
+    """
+    Is a new nonce accepted?
+    """
+    assert await nonce_store.check_and_add("abc", now=1000) is True
+
+
+@pytest.mark.asyncio
+async def test_check_and_add_rejects_replayed_nonce(nonce_store):
+    """
+    Is a nonce rejected when it is used again within the time window?
+    """
+    await nonce_store.check_and_add("abc", now=1000)
+    assert await nonce_store.check_and_add("abc", now=1030) is False
+
+
+@pytest.mark.asyncio
+async def test_check_and_add_accepts_nonce_after_the_time_window(nonce_store):
+    """
+    Is a nonce forgotten once the time window is over?
+    """
+    await nonce_store.check_and_add("abc", now=1000)
+    assert await nonce_store.check_and_add("abc", now=1100) is True
+
+
+@pytest.mark.asyncio
+async def test_memory_nonce_store_size_is_bounded_by_the_time_window():
+    """
+    Are expired nonces dropped from the in-memory store?
+    """
+    sut = MemoryNonceStore(ttl=60, bucket_seconds=10)
+    for second in range(600):
+        for i in range(10):
+            await sut.check_and_add(f"{second}-{i}", now=second)
+
+    assert len(sut) <= 10 * 80
+
+
+@pytest.mark.asyncio
+async def test_sqlite_nonce_store_queries_run_outside_the_event_loop_thread(
+    tmp_path, monkeypatch
+):
+    """
+    Do the sqlite nonce store queries run in the store's thread instead of the event loop?
+    """
+    sut = SQLiteNonceStore(str(tmp_path / "nonces.db"), ttl=60)
+    threads = []
+    check_and_add = sut._check_and_add
+
+    def record_thread(*args):
+        threads.append(threading.get_ident())
+        return check_and_add(*args)
+
+    monkeypatch.setattr(sut, "_check_and_add", record_thread)
+
+    assert await sut.check_and_add("abc", now=1000) is True
+    assert threads and threads[0] != threading.get_ident()
+
+
+def test_create_nonce_store_with_sqlite_url(tmp_path):
+    """
+    Does create_nonce_store create a sqlite store with a sqlite url?
+    """
+    sut = create_nonce_store(f"sqlite:///{tmp_path}/nonces.db")
+    assert isinstance(sut, SQLiteNonceStore)
+    assert sut.path == f"{tmp_path}/nonces.db"
+
+
+def test_create_nonce_store_raises_an_error_with_unknown_scheme():
+    """
+    Does create_nonce_store raise an error with an unsupported url?
+    """
+    with pytest.raises(ValueError):
+        create_nonce_store("foo://bar")
+
+
+@pytest.mark.asyncio
+async def test_validate_nonce_rejects_replayed_launch(make_lti13_resource_link_request):
+    """
+    Does the validator reject a launch when its nonce was already used?
+    """
+    validator = LTI13LaunchValidator()
+    assert await validator.validate_nonce(make_lti13_resource_link_request)
+    with pytest.raises(HTTPError):
+        await validator.validate_nonce(make_lti13_resource_link_request)
+
+
+@pytest.mark.asyncio
+async def test_validate_nonce_rejects_launch_without_nonce(
+    make_lti13_resource_link_request,
+):
+    """
+    Does the validator reject a launch without the nonce claim?
+    """
+    validator = LTI13LaunchValidator()
+    del make_lti13_resource_link_request["nonce"]
+    with pytest.raises(HTTPError):
+        await validator.validate_nonce(make_lti13_resource_link_request)
+
+
+@pytest.mark.asyncio
+async def test_validate_nonce_binds_the_nonce_to_the_login_state(
+    make_lti13_resource_link_request,
+):
+    """
+    Is the launch rejected when its nonce was not derived from the login request's state?
+    """
+    validator = LTI13LaunchValidator()
+    make_lti13_resource_link_request["nonce"] = get_login_nonce("state1")
+    with pytest.raises(HTTPError) as e:
+        await validator.validate_nonce(make_lti13_resource_link_request, state="state2")
+    assert e.value.status_code == 401
+
+    assert await validator.validate_nonce(
+        make_lti13_resource_link_request, state="state1"
+    )
+
+
+def test_timestamp_nonce_ring_rejects_replayed_nonce():
+    """
+    Is a nonce rejected when it is used again with the same timestamp?
+    """
+    sut = TimestampNonceRing(window=30, name="test")
+    assert sut.check_and_add("abc", 1000) is True
+    assert sut.check_and_add("abc", 1000) is False
+    assert sut.rejections["replay"] == 1
+
+
+def test_timestamp_nonce_ring_accepts_nonce_with_other_timestamp():
+    """
+    Is a nonce accepted when it is used with a different timestamp?
+    """
+    sut = TimestampNonceRing(window=30, name="test")
+    sut.check_and_add("abc", 1000)
+    assert sut.check_and_add("abc", 1001) is True
+
+
+def test_timestamp_nonce_ring_drops_expired_buckets():
+    """
+    Are the nonces of expired timestamps evicted when their slot is reused?
+    """
+    sut = TimestampNonceRing(window=30, name="test")
+    for ts in range(1000, 2000):
+        for i in range(5):
+            sut.check_and_add(str(i), ts)
+
+    assert len(sut) == 5 * (2 * 30 + 2)
+    assert sut.evictions == 5 * 1000 - len(sut)
+
+
+def test_timestamp_nonce_ring_rejects_timestamps_older_than_the_ring():
+    """
+    Is a nonce rejected when its bucket was already reused by a newer timestamp?
+    """
+    sut = TimestampNonceRing(window=30, name="test")
+    sut.check_and_add("abc", 1000)
+    sut.check_and_add("abc", 1062)
+    assert sut.check_and_add("abc", 1000) is False
+    assert sut.rejections["expired"] == 1
+
+
+def test_timestamp_nonce_ring_rejects_nonces_above_max_entries():
+    """
+    Does the ring reject new nonces when it is full?
+    """
+    sut = TimestampNonceRing(window=30, max_entries=2, name="test")
+    assert sut.check_and_add("a", 1000) is True
+    assert sut.check_and_add("b", 1000) is True
+    assert sut.check_and_add("c", 1001) is False
+    assert sut.rejections["capacity"] == 1
+    assert len(sut) == 2
+
+
+def test_timestamp_nonce_ring_is_thread_safe():
+    """
+    Is a nonce accepted only once when it is checked from several threads?
+    """
+    sut = TimestampNonceRing(window=30, name="test")
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(
+            executor.map(lambda _: sut.check_and_add("abc", 1000), range(64))
+        )
+
+    assert results.count(True) == 1
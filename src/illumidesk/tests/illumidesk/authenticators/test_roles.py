@@ -0,0 +1,116 @@
+from illumidesk.authenticators.roles import LTI13_ROLE_INDEX
+from illumidesk.authenticators.roles import parse_role
+from illumidesk.authenticators.roles import resolve_roles
+
+
+def test_role_index_includes_the_lis_vocabularies():
+    """
+    Are the role URIs from the constants module parsed at import time?
+    """
+    parsed = LTI13_ROLE_INDEX[
+        "http://purl.imsglobal.org/vocab/lis/v2/membership#instructor#teachingassistant"
+    ]
+
+    assert parsed.scope == "context"
+    assert parsed.name == "instructor"
+    assert parsed.sub_role == "teachingassistant"
+
+
+def test_parse_role_handles_lti11_urns_and_simple_names():
+    """
+    Are LTI 1.1 role URNs and simple names parsed with their scope?
+    """
+    assert parse_role("urn:lti:instrole:ims/lis/Student") == (
+        "institution",
+        "student",
+        "",
+    )
+    assert parse_role("urn:lti:role:ims/lis/Instructor/PrimaryInstructor") == (
+        "context",
+        "instructor",
+        "primaryinstructor",
+    )
+    assert parse_role("Learner") == ("context", "learner", "")
+
+
+def test_resolve_roles_returns_learner_with_lti13_student_roles():
+    """
+    Are the roles sent by Canvas for a student resolved to the learner role?
+    """
+    result = resolve_roles(
+        [
+            "http://purl.imsglobal.org/vocab/lis/v2/institution/person#Student",
+            "http://purl.imsglobal.org/vocab/lis/v2/membership#Learner",
+            "http://purl.imsglobal.org/vocab/lis/v2/system/person#User",
+        ]
+    )
+
+    assert result.user_role == "Learner"
+    assert result.is_student is True
+    assert result.context == frozenset({"learner"})
+    assert result.institution == frozenset({"student"})
+    assert result.system == frozenset({"user"})
+
+
+def test_resolve_roles_maps_teaching_assistants_and_content_developers_to_instructor():
+    """
+    Do teaching assistants and content developers get the instructor role?
+    """
+    assert resolve_roles(
+        [
+            "http://purl.imsglobal.org/vocab/lis/v2/membership/Instructor#TeachingAssistant"
+        ]
+    ).is_instructor
+    assert resolve_roles(
+        [
+            "http://purl.imsglobal.org/vocab/lis/v2/membership/Instructor#TeachingAssistant"
+        ]
+    ).context == frozenset({"instructor#teachingassistant"})
+    assert resolve_roles(
+        ["http://purl.imsglobal.org/vocab/lis/v2/membership#ContentDeveloper"]
+    ).is_instructor
+    assert resolve_roles("urn:lti:role:ims/lis/TeachingAssistant").is_instructor
+
+
+def test_resolve_roles_gives_precedence_to_context_roles():
+    """
+    Do context roles take precedence over institution roles regardless of the order?
+    """
+    roles = [
+        "http://purl.imsglobal.org/vocab/lis/v2/membership#Learner",
+        "http://purl.imsglobal.org/vocab/lis/v2/institution/person#Instructor",
+    ]
+
+    assert resolve_roles(roles).user_role == "Learner"
+    assert resolve_roles(list(reversed(roles))).user_role == "Learner"
+    assert resolve_roles(roles[1:]).user_role == "Instructor"
+
+
+def test_resolve_roles_with_lti11_comma_separated_roles():
+    """
+    Are the comma separated LTI 1.1 roles resolved with the instructor role first?
+    """
+    result = resolve_roles("Learner,urn:lti:role:ims/lis/Instructor")
+
+    assert result.is_instructor is True
+    assert result.is_student is False
+
+
+def test_resolve_roles_returns_empty_user_role_with_unknown_roles():
+    """
+    Does the resolver return an empty user role when no role maps to a user role?
+    """
+    result = resolve_roles("urn:lti:sysrole:ims/lis/Administrator,Unknown")
+
+    assert result.user_role == ""
+    assert result.is_instructor is False
+    assert result.is_student is False
+
+
+def test_resolve_roles_is_memoized():
+    """
+    Is the same role set returned for the same roles?
+    """
+    roles = ["http://purl.imsglobal.org/vocab/lis/v2/membership#Instructor"]
+
+    assert resolve_roles(roles) is resolve_roles(list(roles))
@@ -1,4 +1,6 @@
+import asyncio
 import os
+from unittest.mock import AsyncMock
 from unittest.mock import patch
 
 import pytest
@@ -7,8 +9,12 @@ from tornado.httpclient import AsyncHTTPClient
 from tornado.web import RequestHandler
 
 from illumidesk.apis.jupyterhub_api import JupyterHubAPI
+from illumidesk.apis.nbgrader_service import AsyncNbGraderServiceHelper
 from illumidesk.apis.nbgrader_service import NbGraderServiceHelper
+from illumidesk.authenticators.authenticator import AddJupyterHubUserException
 from illumidesk.authenticators.authenticator import LTI13Authenticator
+from illumidesk.authenticators.authenticator import setup_assignment
+from illumidesk.authenticators.authenticator import setup_course
 from illumidesk.authenticators.authenticator import setup_course_hook
 
 
@@ -346,3 +352,223 @@ async def test_setup_course_hook_does_not_call_add_instructor_to_jupyterhub_grou
                         local_authenticator, local_handler, local_authentication
                     )
                     assert not mock_add_instructor_to_jupyterhub_group.called
+
+
+@pytest.mark.asyncio()
+async def test_setup_course_hook_skips_completed_steps_with_repeated_launches(
+    setup_course_environ,
+    setup_course_hook_environ,
+    make_auth_state_dict,
+    make_http_response,
+    make_mock_request_handler,
+    mock_nbhelper,
+):
+    """
+    Does a repeated launch skip the gradebook, jupyterhub and grader setup service calls?
+    """
+    local_authenticator = Authenticator(post_auth_hook=setup_course_hook)
+    local_handler = make_mock_request_handler(
+        RequestHandler, authenticator=local_authenticator
+    )
+    local_authentication = make_auth_state_dict()
+
+    with patch.object(
+        JupyterHubAPI, "add_student_to_jupyterhub_group", return_value=True
+    ) as mock_add_student_to_jupyterhub_group:
+        with patch.object(
+            AsyncHTTPClient,
+            "fetch",
+            return_value=make_http_response(handler=local_handler.request),
+        ) as mock_fetch:
+            await setup_course_hook(
+                local_authenticator, local_handler, local_authentication
+            )
+            await setup_course_hook(
+                local_authenticator, local_handler, local_authentication
+            )
+
+            assert mock_add_student_to_jupyterhub_group.call_count == 1
+            assert mock_fetch.call_count == 1
+            assert NbGraderServiceHelper.add_user_to_nbgrader_gradebook.call_count == 1
+
+
+@pytest.mark.asyncio()
+async def test_setup_course_hook_retries_steps_that_failed(
+    setup_course_environ,
+    setup_course_hook_environ,
+    make_auth_state_dict,
+    make_http_response,
+    make_mock_request_handler,
+    mock_nbhelper,
+):
+    """
+    Does the next launch run the group membership step again if it failed?
+    """
+    local_authenticator = Authenticator(post_auth_hook=setup_course_hook)
+    local_handler = make_mock_request_handler(
+        RequestHandler, authenticator=local_authenticator
+    )
+    local_authentication = make_auth_state_dict()
+
+    with patch.object(
+        JupyterHubAPI, "add_student_to_jupyterhub_group", return_value=False
+    ) as mock_add_student_to_jupyterhub_group:
+        with patch.object(
+            AsyncHTTPClient,
+            "fetch",
+            return_value=make_http_response(handler=local_handler.request),
+        ) as mock_fetch:
+            await setup_course_hook(
+                local_authenticator, local_handler, local_authentication
+            )
+            await setup_course_hook(
+                local_authenticator, local_handler, local_authentication
+            )
+
+            assert mock_add_student_to_jupyterhub_group.call_count == 2
+            assert mock_fetch.call_count == 1
+
+
+@pytest.mark.asyncio()
+async def test_setup_course_hook_launches_the_grader_service_once_with_concurrent_launches(
+    monkeypatch,
+    setup_course_environ,
+    setup_course_hook_environ,
+    make_auth_state_dict,
+    make_mock_request_handler,
+    mock_nbhelper,
+):
+    """
+    Do concurrent first launches of a course register the grader service once?
+    """
+    calls = []
+
+    async def register_new_service(org_name, course_id):
+        calls.append(course_id)
+        await asyncio.sleep(0.05)
+        return True
+
+    monkeypatch.setattr(
+        "illumidesk.authenticators.authenticator.register_new_service",
+        register_new_service,
+    )
+    local_authenticator = Authenticator(post_auth_hook=setup_course_hook)
+    local_handler = make_mock_request_handler(
+        RequestHandler, authenticator=local_authenticator
+    )
+
+    with patch.object(
+        JupyterHubAPI, "add_student_to_jupyterhub_group", return_value=True
+    ):
+        await asyncio.gather(
+            *[
+                setup_course_hook(
+                    local_authenticator,
+                    local_handler,
+                    make_auth_state_dict(username=f"student{i}", lms_user_id=str(i)),
+                )
+                for i in range(5)
+            ]
+        )
+
+    assert calls == ["intro101"]
+
+
+@pytest.mark.asyncio()
+async def test_setup_course_hook_enqueues_the_setup_when_the_queue_is_enabled(
+    setup_course_environ,
+    setup_course_hook_environ,
+    make_auth_state_dict,
+    make_mock_request_handler,
+    mock_nbhelper,
+    provisioning_queue,
+):
+    """
+    Is the setup enqueued, and only run by the queue, when the provisioning queue is enabled?
+    """
+    local_authenticator = Authenticator(post_auth_hook=setup_course_hook)
+    local_handler = make_mock_request_handler(
+        RequestHandler, authenticator=local_authenticator
+    )
+    local_authentication = make_auth_state_dict()
+
+    with patch.object(
+        JupyterHubAPI, "add_student_to_jupyterhub_group", return_value=True
+    ) as mock_add_student_to_jupyterhub_group:
+        result = await setup_course_hook(
+            local_authenticator, local_handler, local_authentication
+        )
+        assert not mock_add_student_to_jupyterhub_group.called
+
+        job_id = result["auth_state"]["provisioning_job_id"]
+        assert (await provisioning_queue.get(job_id))["kind"] == "setup_course"
+        await provisioning_queue.run_pending()
+        assert mock_add_student_to_jupyterhub_group.called
+
+
+@pytest.mark.asyncio()
+async def test_setup_assignment_creates_the_gradebook_database_once_with_the_course_setup(
+    monkeypatch,
+    setup_course_environ,
+    setup_course_hook_environ,
+    mock_nbhelper,
+):
+    """
+    Do the first launches of a new course and assignment create the gradebook database once?
+    """
+    calls = []
+
+    async def create_database_if_not_exists(self):
+        calls.append(self.course_id)
+        await asyncio.sleep(0.05)
+
+    monkeypatch.setattr(
+        AsyncNbGraderServiceHelper,
+        "create_database_if_not_exists",
+        create_database_if_not_exists,
+    )
+    monkeypatch.setattr(
+        "illumidesk.authenticators.authenticator.create_assignment_source_dir",
+        AsyncMock(return_value=True),
+    )
+    monkeypatch.setattr(
+        "illumidesk.authenticators.authenticator.register_new_service",
+        AsyncMock(return_value=True),
+    )
+
+    with patch.object(
+        JupyterHubAPI, "add_student_to_jupyterhub_group", return_value=True
+    ):
+        await asyncio.gather(
+            setup_course("intro101", "student1", "1", "Learner"),
+            setup_assignment("intro101", "lab1"),
+        )
+
+    assert calls == ["intro101"]
+
+
+@pytest.mark.asyncio()
+async def test_setup_course_logs_the_group_membership_errors(
+    caplog,
+    setup_course_environ,
+    setup_course_hook_environ,
+    mock_nbhelper,
+):
+    """
+    Is an error adding the user to the course group logged with the user and course?
+    """
+    with patch.object(
+        JupyterHubAPI,
+        "add_student_to_jupyterhub_group",
+        side_effect=AddJupyterHubUserException("group error"),
+    ):
+        with patch.object(AsyncHTTPClient, "fetch"):
+            timings = await setup_course(
+                "intro101", "student1", "1", "Learner", wait_all=True
+            )
+
+    assert timings["group"].status == "failure"
+    assert (
+        "An error when adding student username: student1 to course_id: intro101 "
+        "with exception group error"
+    ) in caplog.text
@@ -5,6 +5,9 @@ import pytest
 from tornado.web import RequestHandler
 
 from illumidesk.authenticators.utils import LTIUtils
+from illumidesk.authenticators.utils import email_to_username
+from illumidesk.authenticators.utils import normalize_many
+from illumidesk.authenticators.utils import normalize_string
 from illumidesk.authenticators.utils import user_is_a_student
 from illumidesk.authenticators.utils import user_is_an_instructor
 
@@ -65,6 +68,41 @@ def test_normalize_string_raises_value_error_with_missing_name():
         utils.normalize_string(container_name)
 
 
+def test_normalize_string_function_is_memoized():
+    """
+    Is the same course label normalized once and then served from the cache?
+    """
+    normalize_string.cache_clear()
+    assert normalize_string("Dev-IllumiDesk") == "dev-illumidesk"
+    assert LTIUtils().normalize_string("Dev-IllumiDesk") == "dev-illumidesk"
+
+    cache_info = normalize_string.cache_info()
+    assert cache_info.hits == 1
+    assert cache_info.misses == 1
+
+
+def test_normalize_many_matches_normalize_string():
+    """
+    Does normalize_many return the same values as normalize_string, in order?
+    """
+    names = [
+        "Dev-IllumiDesk",
+        "#$%_this_is_a_container_name",
+        "Dev-IllumiDesk",
+        "x" * 40,
+    ]
+
+    assert normalize_many(names) == [normalize_string(name) for name in names]
+
+
+def test_normalize_many_raises_value_error_with_missing_name():
+    """
+    Does normalize_many raise a value error when a name is empty?
+    """
+    with pytest.raises(ValueError):
+        normalize_many(["foo", ""])
+
+
 def test_get_protocol_with_more_than_one_value():
     """
     Are we able to determine the original protocol from the client's launch request?
@@ -148,6 +186,13 @@ def test_email_to_username_converts_username_in_lowecase():
     assert result == "user_name1"
 
 
+def test_email_to_username_removes_comments():
+    """
+    Does the email_to_username function remove comments and special characters?
+    """
+    assert email_to_username("john.doe(work)@example.com") == "johndoe"
+
+
 def test_email_to_username_retrieves_only_first_part_before_plus_symbol():
     """
     Does the email_to_username method remove '+' symbol?
@@ -12,6 +12,7 @@ from unittest.mock import patch
 import jwt
 import pytest
 from Crypto.PublicKey import RSA
+from cryptography.hazmat.primitives import serialization
 from nbgrader.api import Course
 from oauthlib.oauth1.rfc5849 import signature
 from tornado.httpclient import AsyncHTTPClient
@@ -21,7 +22,73 @@ from tornado.httputil import HTTPServerRequest
 from tornado.web import Application
 from tornado.web import RequestHandler
 
+from illumidesk.apis.jupyterhub_api import get_group_membership_cache
+from illumidesk.apis.provisioning import get_provisioning_ledger
+from illumidesk.apis.provisioning_queue import create_provisioning_queue
+from illumidesk.apis.provisioning_queue import set_provisioning_queue
+from illumidesk.authenticators.nonce import get_nonce_store
 from illumidesk.authenticators.utils import LTIUtils
+from illumidesk.lti13.auth import get_access_token_cache
+
+
+@pytest.fixture(autouse=True)
+def clear_nonce_store():
+    """
+    Clears the process-wide nonce store so tests can reuse the same LTI 1.3 launch requests.
+    """
+    get_nonce_store().clear()
+    yield
+    get_nonce_store().clear()
+
+
+@pytest.fixture(autouse=True)
+def clear_provisioning_ledger():
+    """
+    Clears the process-wide provisioning ledger so the setup steps run with every test.
+    """
+    get_provisioning_ledger().clear()
+    yield
+    get_provisioning_ledger().clear()
+
+
+@pytest.fixture(autouse=True)
+def clear_group_membership_cache():
+    """
+    Clears the process-wide group membership cache so tests fetch the groups again.
+    """
+    get_group_membership_cache().clear()
+    yield
+    get_group_membership_cache().clear()
+
+
+@pytest.fixture(autouse=True)
+def clear_access_token_cache():
+    """
+    Clears the process-wide LMS access token cache so tests request their tokens.
+    """
+    get_access_token_cache().clear()
+    yield
+    get_access_token_cache().clear()
+
+
+@pytest.fixture
+def provisioning_queue(monkeypatch):
+    """
+    Enables the provisioning queue, which is disabled by default, and replaces the
+    process-wide queue with an in-memory queue without workers. Tests run the enqueued
+    jobs with run_pending.
+    """
+    for module in (
+        "illumidesk.authenticators.authenticator",
+        "illumidesk.authenticators.handlers",
+        "illumidesk.lti13.handlers",
+    ):
+        monkeypatch.setattr(f"{module}.PROVISIONING_QUEUE_ENABLED", True)
+    queue = create_provisioning_queue("memory://", workers=0)
+    set_provisioning_queue(queue)
+    yield queue
+    set_provisioning_queue(None)
+    queue.close()
 
 
 @pytest.fixture(scope="module")
@@ -775,3 +842,26 @@ def build_lti13_jwt_id_token() -> str:
         return encoded_jwt
 
     return _make_lti13_jwt_id_token
+
+
+@pytest.fixture(scope="function")
+def build_lti13_rs256_jwt_id_token() -> str:
+    def _make_lti13_rs256_jwt_id_token(json_lti13_launch_request: Dict[str, str]):
+        """
+        Returns a valid jwt lti13 id token signed with a new RS256 key and the public key
+        object that verifies it. The token's exp claim is refreshed so the token is not expired.
+        """
+        key = RSA.generate(2048)
+        claims = dict(json_lti13_launch_request)
+        claims["iat"] = int(time.time())
+        claims["exp"] = int(time.time()) + 300
+        encoded_jwt = jwt.encode(
+            claims,
+            key.exportKey("PEM"),
+            algorithm="RS256",
+            headers={"kid": "test-kid"},
+        )
+        public_key = serialization.load_pem_public_key(key.publickey().exportKey("PEM"))
+        return encoded_jwt, public_key
+
+    return _make_lti13_rs256_jwt_id_token
@@ -0,0 +1,251 @@
+import json
+import time
+from unittest.mock import AsyncMock
+from unittest.mock import Mock
+from unittest.mock import PropertyMock
+from unittest.mock import patch
+
+import pytest
+from tornado.httpclient import AsyncHTTPClient
+from tornado.httputil import HTTPHeaders
+from tornado.web import HTTPError
+
+from illumidesk.apis.nbgrader_service import AsyncNbGraderServiceHelper
+from illumidesk.apis.nbgrader_service import UpsertResult
+from illumidesk.apis.provisioning import assignment_key
+from illumidesk.apis.provisioning import get_provisioning_ledger
+from illumidesk.authenticators.authenticator import process_resource_link_lti_13
+from illumidesk.authenticators.claims import LaunchClaims
+from illumidesk.lti13.ags import AssignmentGradeServicesClient
+from illumidesk.lti13.ags import CourseAssignment
+from illumidesk.lti13.ags import get_course_assignment
+from illumidesk.lti13.ags import sync_assignments
+from illumidesk.lti13.handlers import LTI13AssignmentsSyncHandler
+from illumidesk.metrics import UpsertOutcome
+
+LINEITEMS_URL = "https://my.platform.domain/api/lti/courses/1/line_items"
+
+
+def make_line_item(i: int, **kwargs):
+    line_item = {
+        "id": f"{LINEITEMS_URL}/{i}",
+        "scoreMaximum": 100,
+        "label": f"Lab {i}",
+        "resourceLinkId": f"link-{i}",
+    }
+    line_item.update(kwargs)
+    return line_item
+
+
+async def iterate(line_items):
+    for line_item in line_items:
+        yield line_item
+
+
+def test_get_course_assignment_normalizes_the_label_as_the_launch_does():
+    """
+    Is the assignment name the one used when the resource link is launched?
+    """
+    assert get_course_assignment(make_line_item(1)) == CourseAssignment("lab1")
+    assert get_course_assignment(
+        make_line_item(2, endDateTime="2021-05-31T23:59:00Z")
+    ) == CourseAssignment("lab2", "2021-05-31T23:59:00Z")
+    assert get_course_assignment(make_line_item(3, label="")) is None
+
+
+@pytest.mark.asyncio
+async def test_iter_line_items_follows_the_link_headers(lti13_config_environ):
+    """
+    Are the pages of the line items container requested until there is no next link?
+    """
+    pages = [
+        Mock(
+            body=json.dumps([make_line_item(1), make_line_item(2)]),
+            headers=HTTPHeaders({"Link": f'<{LINEITEMS_URL}?page=2>; rel="next"'}),
+        ),
+        Mock(body=json.dumps([make_line_item(3)]), headers=HTTPHeaders()),
+    ]
+    client = AssignmentGradeServicesClient(page_size=2)
+
+    with patch(
+        "illumidesk.lti13.ags.get_lms_access_token",
+        return_value={"access_token": "token"},
+    ) as mock_get_lms_access_token:
+        with patch.object(
+            AsyncHTTPClient, "fetch", new_callable=AsyncMock, side_effect=pages
+        ) as mock_fetch:
+            line_items = [
+                line_item async for line_item in client.iter_line_items(LINEITEMS_URL)
+            ]
+
+    assert [line_item["label"] for line_item in line_items] == [
+        "Lab 1",
+        "Lab 2",
+        "Lab 3",
+    ]
+    assert mock_get_lms_access_token.call_args[1]["scope"].endswith("lineitem.readonly")
+    assert mock_fetch.call_args_list[0][0][0] == f"{LINEITEMS_URL}?limit=2"
+    assert mock_fetch.call_args_list[1][0][0] == f"{LINEITEMS_URL}?page=2"
+    assert mock_fetch.call_args_list[0][1]["headers"]["Accept"] == (
+        "application/vnd.ims.lis.v2.lineitemcontainer+json"
+    )
+
+
+@pytest.mark.asyncio
+async def test_sync_assignments_sets_up_the_assignments_in_batches():
+    """
+    Are the assignments written in batches and registered in the provisioning ledger, so
+    a second sync and the launches of their resource links skip them?
+    """
+    line_items = [make_line_item(i) for i in range(5)] + [
+        make_line_item(5, label="Lab 0"),
+        make_line_item(6, label=""),
+    ]
+
+    async def upsert_assignments(assignments):
+        return [
+            UpsertResult(assignment["name"], UpsertOutcome.inserted)
+            for assignment in assignments
+        ]
+
+    with patch.object(AsyncNbGraderServiceHelper, "create_database_if_not_exists"):
+        with patch.object(
+            AsyncNbGraderServiceHelper,
+            "bulk_upsert_assignments",
+            side_effect=upsert_assignments,
+        ) as mock_upsert:
+            with patch(
+                "illumidesk.lti13.ags.create_assignment_source_dirs",
+                return_value=True,
+            ) as mock_create_dirs:
+                result = await sync_assignments(
+                    "intro101", iterate(line_items), batch_size=3
+                )
+                repeated = await sync_assignments(
+                    "intro101", iterate(line_items), batch_size=3
+                )
+                with patch(
+                    "illumidesk.authenticators.authenticator.setup_assignment"
+                ) as mock_setup_assignment:
+                    await process_resource_link_lti_13(
+                        Mock(),
+                        "intro101",
+                        LaunchClaims({}, "", resource_link_title="Lab 4"),
+                    )
+
+    assert result == (5, 2, 0)
+    assert repeated == (0, 7, 0)
+    assert mock_upsert.call_count == 2
+    assert mock_create_dirs.call_args_list[0][0] == (
+        "my-org",
+        "intro101",
+        ["lab0", "lab1", "lab2"],
+    )
+    ledger = get_provisioning_ledger()
+    assert await ledger.is_done(assignment_key("intro101", "lab4"))
+    # the synced assignments do not expire with the ledger's ttl
+    assert await ledger.is_done(
+        assignment_key("intro101", "lab4"), now=time.time() + ledger.ttl + 1
+    )
+    assert not mock_setup_assignment.called
+
+
+@pytest.mark.asyncio
+async def test_sync_assignments_does_not_mark_failed_batches():
+    """
+    Are the assignments set up again by the next sync when their directories were not
+    created?
+    """
+
+    async def upsert_assignments(assignments):
+        return [
+            UpsertResult(assignment["name"], UpsertOutcome.updated)
+            for assignment in assignments
+        ]
+
+    with patch.object(AsyncNbGraderServiceHelper, "create_database_if_not_exists"):
+        with patch.object(
+            AsyncNbGraderServiceHelper,
+            "bulk_upsert_assignments",
+            side_effect=upsert_assignments,
+        ):
+            with patch(
+                "illumidesk.lti13.ags.create_assignment_source_dirs",
+                return_value=False,
+            ):
+                result = await sync_assignments(
+                    "intro101", iterate([make_line_item(1)])
+                )
+
+    assert result == (0, 0, 1)
+    assert not await get_provisioning_ledger().is_done(
+        assignment_key("intro101", "lab1")
+    )
+
+
+@pytest.mark.asyncio
+async def test_assignments_sync_handler_enqueues_the_sync(
+    make_mock_request_handler, provisioning_queue
+):
+    """
+    Does the assignments sync handler enqueue a job with the course of the admin's last
+    launch?
+    """
+    user = Mock(
+        admin=True,
+        get_auth_state=AsyncMock(
+            return_value={"course_id": "intro101", "lineitems_url": LINEITEMS_URL}
+        ),
+    )
+    local_handler = make_mock_request_handler(LTI13AssignmentsSyncHandler)
+    local_handler.request.body = b""
+    sync_handler = LTI13AssignmentsSyncHandler(
+        local_handler.application, local_handler.request
+    )
+    with patch.object(
+        LTI13AssignmentsSyncHandler, "current_user", new_callable=PropertyMock
+    ) as mock_current_user:
+        mock_current_user.return_value = user
+        with patch.object(LTI13AssignmentsSyncHandler, "write") as mock_write:
+            await sync_handler.post()
+
+    job_id = json.loads(mock_write.call_args[0][0])["job_id"]
+    job = await provisioning_queue.get(job_id)
+    assert job["kind"] == "sync_assignments"
+    assert job["course_id"] == "intro101"
+    assert sync_handler.get_status() == 202
+
+
+@pytest.mark.asyncio
+async def test_assignments_sync_handler_rejects_lineitems_urls_of_other_hosts(
+    make_mock_request_handler,
+):
+    """
+    Is a lineitems_url of another host than the platform's rejected, so the platform's
+    access token is not sent to it?
+    """
+    user = Mock(
+        admin=True,
+        get_auth_state=AsyncMock(
+            return_value={"course_id": "intro101", "lineitems_url": LINEITEMS_URL}
+        ),
+    )
+    local_handler = make_mock_request_handler(LTI13AssignmentsSyncHandler)
+    local_handler.request.body = json.dumps(
+        {"lineitems_url": "https://attacker.example.com/line_items"}
+    ).encode()
+    sync_handler = LTI13AssignmentsSyncHandler(
+        local_handler.application, local_handler.request
+    )
+    with patch.object(
+        LTI13AssignmentsSyncHandler, "current_user", new_callable=PropertyMock
+    ) as mock_current_user:
+        mock_current_user.return_value = user
+        with patch(
+            "illumidesk.lti13.handlers.sync_course_assignments"
+        ) as mock_sync_course_assignments:
+            with pytest.raises(HTTPError) as e:
+                await sync_handler.post()
+
+    assert e.value.status_code == 400
+    assert not mock_sync_course_assignments.called
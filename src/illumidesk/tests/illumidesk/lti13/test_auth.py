@@ -1,11 +1,21 @@
+import asyncio
+import json
 import os
+import time
+from unittest.mock import AsyncMock
 from unittest.mock import patch
 
+import jwt
 import pem
 import pytest
+from Crypto.PublicKey import RSA
 
+from illumidesk.lti13.auth import KeyStore
+from illumidesk.lti13.auth import LMSAccessTokenCache
+from illumidesk.lti13.auth import get_key_store
 from illumidesk.lti13.auth import get_lms_access_token
 from illumidesk.lti13.auth import get_pem_text_from_file
+from illumidesk.lti13.auth import get_pem_texts_from_file
 
 
 def test_get_pem_text_from_file_raises_an_error_if_pem_cannot_be_read():
@@ -28,17 +38,189 @@ def test_get_pem_text_from_file_parses_the_pem_file(lti13_config_environ):
 
 
 @pytest.mark.asyncio
-@patch("illumidesk.lti13.auth.get_pem_text_from_file")
-@patch("illumidesk.lti13.auth.get_headers_to_jwt_encode")
+@patch("illumidesk.lti13.auth.get_pem_texts_from_file")
 async def test_get_lms_access_token_calls_get_pem_text_from_file(
-    mock_get_headers_to_jwt,
     mock_get_pem_text,
     lti13_config_environ,
     http_async_httpclient_with_simple_response,
 ):
     pem_key = os.environ.get("LTI13_PRIVATE_KEY")
-    mock_get_headers_to_jwt.return_value = None
-    mock_get_pem_text.return_value = pem.parse_file(pem_key)[0].as_text()
+    mock_get_pem_text.return_value = [pem.parse_file(pem_key)[0].as_text()]
     # here we're using a httpclient mocked
     await get_lms_access_token("url", pem_key, "client-id")
     assert mock_get_pem_text.called
+
+
+@pytest.mark.asyncio
+async def test_get_lms_access_token_reuses_the_token_until_it_expires():
+    """
+    Is the token reused by the calls with the same endpoint, client id and scopes?
+    """
+    cache = LMSAccessTokenCache()
+    with patch(
+        "illumidesk.lti13.auth.fetch_lms_access_token",
+        new_callable=AsyncMock,
+        side_effect=[
+            {"access_token": "token1", "expires_in": 3600},
+            {"access_token": "token2", "expires_in": 3600},
+        ],
+    ) as mock_fetch:
+        first = await cache.get_token("url", "key.pem", "client-id", scope="a b")
+        second = await cache.get_token("url", "key.pem", "client-id", scope="b a")
+        other = await cache.get_token("url", "key.pem", "client-id", scope="a")
+
+    assert first["access_token"] == second["access_token"] == "token1"
+    assert other["access_token"] == "token2"
+    assert mock_fetch.call_count == 2
+
+
+@pytest.mark.asyncio
+async def test_get_lms_access_token_coalesces_concurrent_requests():
+    """
+    Do concurrent calls without a cached token share a single token request?
+    """
+    cache = LMSAccessTokenCache()
+
+    async def fetch(*args, **kwargs):
+        await asyncio.sleep(0.01)
+        return {"access_token": "token", "expires_in": 3600}
+
+    with patch(
+        "illumidesk.lti13.auth.fetch_lms_access_token", side_effect=fetch
+    ) as mock_fetch:
+        tokens = await asyncio.gather(
+            *[cache.get_token("url", "key.pem", "client-id") for _ in range(20)]
+        )
+
+    assert {token["access_token"] for token in tokens} == {"token"}
+    assert mock_fetch.call_count == 1
+
+
+@pytest.mark.asyncio
+async def test_get_lms_access_token_refreshes_the_token_before_it_expires():
+    """
+    Is the cached token returned while a new token is requested in the background once
+    the token is about to expire?
+    """
+    cache = LMSAccessTokenCache(refresh_margin=60)
+    with patch(
+        "illumidesk.lti13.auth.fetch_lms_access_token",
+        new_callable=AsyncMock,
+        side_effect=[
+            {"access_token": "token1", "expires_in": 30},
+            {"access_token": "token2", "expires_in": 3600},
+        ],
+    ) as mock_fetch:
+        await cache.get_token("url", "key.pem", "client-id")
+        # short lived tokens are refreshed after half of their lifetime
+        with patch("illumidesk.lti13.auth.time.time", return_value=time.time() + 20):
+            stale = await cache.get_token("url", "key.pem", "client-id")
+            await asyncio.sleep(0)
+        refreshed = await cache.get_token("url", "key.pem", "client-id")
+
+    assert stale["access_token"] == "token1"
+    assert refreshed["access_token"] == "token2"
+    assert mock_fetch.call_count == 2
+
+
+@pytest.mark.asyncio
+async def test_get_lms_access_token_requests_a_new_token_after_the_expiry():
+    """
+    Is a new token requested once the cached token expired or was invalidated?
+    """
+    cache = LMSAccessTokenCache()
+    with patch(
+        "illumidesk.lti13.auth.fetch_lms_access_token",
+        new_callable=AsyncMock,
+        side_effect=[
+            {"access_token": "token1", "expires_in": 30},
+            {"access_token": "token2"},
+            {"access_token": "token3"},
+        ],
+    ):
+        await cache.get_token("url", "key.pem", "client-id")
+        with patch("illumidesk.lti13.auth.time.time", return_value=time.time() + 31):
+            expired = await cache.get_token("url", "key.pem", "client-id")
+        cache.invalidate("url", "client-id")
+        invalidated = await cache.get_token("url", "key.pem", "client-id")
+
+    assert expired["access_token"] == "token2"
+    assert invalidated["access_token"] == "token3"
+
+
+def test_key_store_parses_the_keys_once(lti13_config_environ):
+    """
+    Are the keys parsed once and used to sign jwts with their kid?
+    """
+    pem_key = os.environ.get("LTI13_PRIVATE_KEY")
+    key_store = KeyStore(pem_key, check_interval=0)
+    with patch(
+        "illumidesk.lti13.auth.get_pem_texts_from_file",
+        side_effect=get_pem_texts_from_file,
+    ) as mock_get_pem_texts:
+        jwks = key_store.jwks
+        token = key_store.sign({"iss": "client-id"})
+        key_store.sign({"iss": "client-id"})
+
+    assert mock_get_pem_texts.call_count == 1
+    assert len(jwks["keys"]) == 1
+    kid = jwt.get_unverified_header(token)["kid"]
+    assert kid == jwks["keys"][0]["kid"] == key_store.signing_key.kid
+    public_key = jwt.algorithms.RSAAlgorithm.from_jwk(json.dumps(jwks["keys"][0]))
+    assert jwt.decode(token, public_key, algorithms=["RS256"]) == {"iss": "client-id"}
+
+
+def test_key_store_reloads_the_keys_when_the_pem_file_changes(lti13_config_environ):
+    """
+    Are the keys added to the pem file published, while the first key keeps signing?
+    """
+    pem_key = os.environ.get("LTI13_PRIVATE_KEY")
+    key_store = KeyStore(pem_key, check_interval=0)
+    current_kid = key_store.signing_key.kid
+    with open(pem_key, "ab") as pem_file:
+        pem_file.write(b"\n" + RSA.generate(2048).exportKey("PEM"))
+
+    kids = [jwk["kid"] for jwk in key_store.jwks["keys"]]
+    assert len(kids) == 2
+    assert kids[0] == current_kid
+    assert key_store.signing_key.kid == current_kid
+
+
+def test_key_store_keeps_the_keys_if_the_pem_file_cannot_be_parsed(
+    lti13_config_environ,
+):
+    """
+    Are the current keys kept when the pem file is replaced with an invalid one?
+    """
+    pem_key = os.environ.get("LTI13_PRIVATE_KEY")
+    key_store = KeyStore(pem_key, check_interval=0)
+    jwks = key_store.jwks
+    with open(pem_key, "w") as pem_file:
+        pem_file.write("invalid")
+
+    assert key_store.jwks == jwks
+
+
+def test_key_store_logs_a_missing_pem_file_once(lti13_config_environ, caplog):
+    """
+    Is the error reloading a missing pem file logged once instead of with every check?
+    """
+    pem_key = os.environ.get("LTI13_PRIVATE_KEY")
+    key_store = KeyStore(pem_key, check_interval=0)
+    jwks = key_store.jwks
+    os.remove(pem_key)
+
+    for _ in range(3):
+        assert key_store.jwks == jwks
+
+    warnings = [r for r in caplog.records if "Keeping the current keys" in r.message]
+    assert len(warnings) == 1
+
+
+def test_get_key_store_raises_an_error_without_lti13_private_key(monkeypatch):
+    """
+    Is an environment error raised if the LTI13_PRIVATE_KEY env var is not set?
+    """
+    monkeypatch.delenv("LTI13_PRIVATE_KEY", raising=False)
+    with pytest.raises(EnvironmentError):
+        get_key_store()
@@ -28,7 +28,7 @@ async def test_get_calls_write_method_with_a_json(
     mock_write, lti13_config_environ, make_mock_request_handler
 ):
     """
-    Does the write base method is invoked with a string?
+    Does the write base method is invoked with the serialized json?
     """
     handler = make_mock_request_handler(RequestHandler)
     config_handler = LTI13ConfigHandler(handler.application, handler.request)
@@ -38,7 +38,7 @@ async def test_get_calls_write_method_with_a_json(
     write_args = mock_write.call_args[0]
     # write_args == tuple
     json_arg = write_args[0]
-    assert type(json_arg) == str
+    assert type(json_arg) == bytes
     assert json.loads(json_arg)
 
 
@@ -66,7 +66,7 @@ async def test_get_method_writes_a_json_with_required_keys(
     ]
     # call_args is a list
     # so we're only extracting the json arg
-    json_arg = mock_write.call_args[0][0]
+    json_arg = mock_write.call_args[0][0].decode()
     for required_key in keys_at_0_level_expected:
         assert required_key in json_arg
 
@@ -85,7 +85,7 @@ async def test_get_method_writes_our_company_name_in_the_title_field(
     await config_handler.get()
     # call_args is a list
     # so we're only extracting the json arg
-    json_arg = mock_write.call_args[0][0]
+    json_arg = mock_write.call_args[0][0].decode()
     title = json.loads(json_arg)["title"]
     assert title == "IllumiDesk"
 
@@ -104,7 +104,7 @@ async def test_get_method_writes_email_field_within_custom_fields(
     await config_handler.get()
     # call_args is a list
     # so we're only extracting the json arg
-    json_arg = mock_write.call_args[0][0]
+    json_arg = mock_write.call_args[0][0].decode()
     custom_fields = json.loads(json_arg)["custom_fields"]
     assert "email" in custom_fields
     assert "$Person.email.primary" == custom_fields["email"]
@@ -124,7 +124,7 @@ async def test_get_method_writes_email_custom_field_within_each_course_navigatio
     await config_handler.get()
     # call_args is a list
     # so we're only extracting the json arg
-    json_arg = mock_write.call_args[0][0]
+    json_arg = mock_write.call_args[0][0].decode()
     extensions = json.loads(json_arg)["extensions"]
     course_navigation_placement = None
     for ext in extensions:
@@ -157,7 +157,7 @@ async def test_get_method_writes_lms_user_id_field_within_custom_fields(
     await config_handler.get()
     # call_args is a list
     # so we're only extracting the json arg
-    json_arg = mock_write.call_args[0][0]
+    json_arg = mock_write.call_args[0][0].decode()
     custom_fields = json.loads(json_arg)["custom_fields"]
     assert "lms_user_id" in custom_fields
     assert "$User.id" == custom_fields["lms_user_id"]
@@ -177,7 +177,7 @@ async def test_get_method_writes_lms_user_id_custom_field_within_each_course_nav
     await config_handler.get()
     # call_args is a list
     # so we're only extracting the json arg
-    json_arg = mock_write.call_args[0][0]
+    json_arg = mock_write.call_args[0][0].decode()
     extensions = json.loads(json_arg)["extensions"]
     course_navigation_placement = None
     for ext in extensions:
@@ -194,3 +194,30 @@ async def test_get_method_writes_lms_user_id_custom_field_within_each_course_nav
             assert placement_custom_fields
             assert placement_custom_fields["lms_user_id"]
             assert placement_custom_fields["lms_user_id"] == "$User.id"
+
+
+@pytest.mark.asyncio
+async def test_get_method_replies_not_modified_with_a_matching_etag(
+    lti13_config_environ, make_mock_request_handler
+):
+    """
+    Is the config sent with a strong ETag and Cache-Control, and is a 304 returned
+    when the platform sends the same ETag?
+    """
+    handler = make_mock_request_handler(RequestHandler)
+    handler.request.headers["X-Forwarded-Proto"] = "https"
+    config_handler = LTI13ConfigHandler(handler.application, handler.request)
+    with patch.object(LTI13ConfigHandler, "write") as mock_write:
+        await config_handler.get()
+    etag = config_handler._headers["Etag"]
+    assert not etag.startswith("W/")
+    assert "max-age" in config_handler._headers["Cache-Control"]
+
+    handler = make_mock_request_handler(RequestHandler)
+    handler.request.headers["X-Forwarded-Proto"] = "https"
+    handler.request.headers["If-None-Match"] = etag
+    config_handler = LTI13ConfigHandler(handler.application, handler.request)
+    with patch.object(LTI13ConfigHandler, "write") as mock_write:
+        await config_handler.get()
+    assert config_handler.get_status() == 304
+    assert not mock_write.called
@@ -1,10 +1,13 @@
+import json
 from os import chmod
 from os import environ
 from unittest.mock import patch
 
 import pytest
+from Crypto.PublicKey import RSA
 from tornado.web import RequestHandler
 
+from illumidesk.lti13.auth import get_key_store
 from illumidesk.lti13.handlers import LTI13JWKSHandler
 
 
@@ -44,7 +47,7 @@ def test_get_method_calls_write_method_with_a_dict(
     mock_write_method, lti13_config_environ, make_mock_request_handler
 ):
     """
-    Does the write method is called with a dict?
+    Does the write method is called with the serialized jwks?
     """
     handler = make_mock_request_handler(RequestHandler)
     config_handler = LTI13JWKSHandler(handler.application, handler.request)
@@ -52,9 +55,10 @@ def test_get_method_calls_write_method_with_a_dict(
     config_handler.get()
     assert mock_write_method.called
     write_args = mock_write_method.call_args[0]
-    # make sure we're passing a dict to let tornado convert it as json with the specific content-type
+    # the jwks is serialized once and written as bytes
     assert write_args[0]
-    assert type(write_args[0]) == dict
+    assert type(write_args[0]) == bytes
+    assert json.loads(write_args[0])["keys"]
 
 
 def test_get_method_set_content_type_as_json(
@@ -69,3 +73,34 @@ def test_get_method_set_content_type_as_json(
     config_handler.get()
     assert "Content-Type" in config_handler._headers
     assert "application/json" in config_handler._headers["Content-type"]
+
+
+def test_get_method_changes_the_etag_when_the_keys_rotate(
+    lti13_config_environ, make_mock_request_handler
+):
+    """
+    Is a 304 returned for the current keys and a new ETag sent once a key is added?
+    """
+    key_path = environ.get("LTI13_PRIVATE_KEY")
+    get_key_store(key_path).check_interval = 0
+    handler = make_mock_request_handler(RequestHandler)
+    jwks_handler = LTI13JWKSHandler(handler.application, handler.request)
+    jwks_handler.get()
+    etag = jwks_handler._headers["Etag"]
+
+    handler = make_mock_request_handler(RequestHandler)
+    handler.request.headers["If-None-Match"] = etag
+    jwks_handler = LTI13JWKSHandler(handler.application, handler.request)
+    jwks_handler.get()
+    assert jwks_handler.get_status() == 304
+
+    with open(key_path, "ab") as pem_file:
+        pem_file.write(b"\n" + RSA.generate(2048).exportKey("PEM"))
+    handler = make_mock_request_handler(RequestHandler)
+    handler.request.headers["If-None-Match"] = etag
+    jwks_handler = LTI13JWKSHandler(handler.application, handler.request)
+    with patch.object(LTI13JWKSHandler, "write") as mock_write:
+        jwks_handler.get()
+    assert jwks_handler.get_status() == 200
+    assert jwks_handler._headers["Etag"] != etag
+    assert len(json.loads(mock_write.call_args[0][0])["keys"]) == 2
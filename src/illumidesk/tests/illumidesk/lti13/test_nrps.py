@@ -0,0 +1,245 @@
+import json
+from unittest.mock import AsyncMock
+from unittest.mock import Mock
+from unittest.mock import PropertyMock
+from unittest.mock import patch
+
+import pytest
+from tornado.httpclient import AsyncHTTPClient
+from tornado.httputil import HTTPHeaders
+from tornado.web import HTTPError
+
+from illumidesk.apis.jupyterhub_api import JupyterHubAPI
+from illumidesk.apis.nbgrader_service import AsyncNbGraderServiceHelper
+from illumidesk.apis.provisioning import enrollment_key
+from illumidesk.apis.provisioning import get_provisioning_ledger
+from illumidesk.apis.provisioning import step_key
+from illumidesk.lti13.handlers import LTI13RosterHandler
+from illumidesk.lti13.handlers import get_platform_service_url
+from illumidesk.lti13.nrps import NamesRolesServiceClient
+from illumidesk.lti13.nrps import RosterMember
+from illumidesk.lti13.nrps import get_next_link
+from illumidesk.lti13.nrps import get_roster_member
+from illumidesk.lti13.nrps import provision_roster
+
+MEMBERSHIPS_URL = "https://my.platform.domain/api/lti/courses/1/names_and_roles"
+
+
+def make_member(i: int, role: str = "Learner", **kwargs):
+    member = {
+        "status": "Active",
+        "name": f"Student {i}",
+        "email": f"student{i}@example.com",
+        "user_id": f"user-{i}",
+        "roles": [f"http://purl.imsglobal.org/vocab/lis/v2/membership#{role}"],
+    }
+    member.update(kwargs)
+    return member
+
+
+async def iterate(members):
+    for member in members:
+        yield member
+
+
+def test_get_next_link_returns_the_next_page_url():
+    """
+    Is the url of the next page read from the Link headers?
+    """
+    headers = [
+        f'<{MEMBERSHIPS_URL}?page=1>; rel="current",'
+        f'<{MEMBERSHIPS_URL}?page=2&limit=10>; rel="next"'
+    ]
+
+    assert get_next_link(headers) == f"{MEMBERSHIPS_URL}?page=2&limit=10"
+    assert get_next_link([f'<{MEMBERSHIPS_URL}?page=1>; rel="last"']) is None
+    assert get_next_link([]) is None
+
+
+def test_get_roster_member_normalizes_the_member_as_the_launch_does():
+    """
+    Are the username and role of a member the ones used when the member launches?
+    """
+    assert get_roster_member(make_member(1)) == RosterMember(
+        "student1", "user-1", "Learner"
+    )
+    assert get_roster_member(
+        make_member(2, role="Instructor#TeachingAssistant", email="")
+    ) == RosterMember("student2", "user-2", "Instructor")
+    assert get_roster_member(make_member(3, status="Inactive")) is None
+    assert get_roster_member(make_member(4, user_id="")) is None
+
+
+@pytest.mark.asyncio
+async def test_iter_members_follows_the_link_headers(lti13_config_environ):
+    """
+    Are the pages of the membership container requested until there is no next link?
+    """
+    pages = [
+        Mock(
+            body=json.dumps({"members": [make_member(1), make_member(2)]}),
+            headers=HTTPHeaders({"Link": f'<{MEMBERSHIPS_URL}?page=2>; rel="next"'}),
+        ),
+        Mock(
+            body=json.dumps({"members": [make_member(3)]}),
+            headers=HTTPHeaders(),
+        ),
+    ]
+    client = NamesRolesServiceClient(page_size=2)
+
+    with patch(
+        "illumidesk.lti13.nrps.get_lms_access_token",
+        return_value={"access_token": "token"},
+    ) as mock_get_lms_access_token:
+        with patch.object(
+            AsyncHTTPClient, "fetch", new_callable=AsyncMock, side_effect=pages
+        ) as mock_fetch:
+            members = [member async for member in client.iter_members(MEMBERSHIPS_URL)]
+
+    assert [member["user_id"] for member in members] == ["user-1", "user-2", "user-3"]
+    assert mock_get_lms_access_token.call_args[1]["scope"].endswith(
+        "contextmembership.readonly"
+    )
+    assert mock_fetch.call_args_list[0][0][0] == f"{MEMBERSHIPS_URL}?limit=2"
+    assert mock_fetch.call_args_list[1][0][0] == f"{MEMBERSHIPS_URL}?page=2"
+    headers = mock_fetch.call_args_list[0][1]["headers"]
+    assert headers["Authorization"] == "Bearer token"
+    assert headers["Accept"] == (
+        "application/vnd.ims.lti-nrps.v2.membershipcontainer+json"
+    )
+
+
+@pytest.mark.asyncio
+async def test_provision_roster_writes_members_in_batches(jupyterhub_api_environ):
+    """
+    Are the members written to the gradebook in batches and registered in the
+    provisioning ledger, so a second run (and their first launch) skips them?
+    """
+    members = [make_member(i) for i in range(5)] + [make_member(5, role="Instructor")]
+
+    async def add_users(users):
+        return [username for username, _ in users]
+
+    with patch.object(AsyncNbGraderServiceHelper, "create_database_if_not_exists"):
+        with patch.object(
+            AsyncNbGraderServiceHelper,
+            "add_users_to_nbgrader_gradebook",
+            side_effect=add_users,
+        ) as mock_add_users:
+            with patch.object(
+                JupyterHubAPI, "add_student_to_jupyterhub_group", return_value=True
+            ) as mock_add_student:
+                with patch.object(
+                    JupyterHubAPI,
+                    "add_instructor_to_jupyterhub_group",
+                    return_value=True,
+                ) as mock_add_instructor:
+                    result = await provision_roster(
+                        "intro101", iterate(members), batch_size=4
+                    )
+                    repeated = await provision_roster(
+                        "intro101", iterate(members), batch_size=4
+                    )
+
+    assert result == (6, 0, 0)
+    assert repeated == (0, 6, 0)
+    assert mock_add_users.call_count == 2
+    assert mock_add_student.call_count == 5
+    mock_add_instructor.assert_called_once_with("intro101", "student5")
+    enrollment = enrollment_key("intro101", "student0", "Learner", "user-0")
+    assert await get_provisioning_ledger().is_done(step_key(enrollment, "gradebook"))
+    assert await get_provisioning_ledger().is_done(step_key(enrollment, "group"))
+
+
+@pytest.mark.asyncio
+async def test_roster_handler_enqueues_the_roster_provisioning(
+    make_mock_request_handler, provisioning_queue
+):
+    """
+    Does the roster handler enqueue a job with the course of the admin's last launch?
+    """
+    user = Mock(
+        admin=True,
+        get_auth_state=AsyncMock(
+            return_value={
+                "course_id": "intro101",
+                "context_memberships_url": MEMBERSHIPS_URL,
+            }
+        ),
+    )
+    local_handler = make_mock_request_handler(LTI13RosterHandler)
+    local_handler.request.body = b""
+    roster_handler = LTI13RosterHandler(
+        local_handler.application, local_handler.request
+    )
+    with patch.object(
+        LTI13RosterHandler, "current_user", new_callable=PropertyMock
+    ) as mock_current_user:
+        mock_current_user.return_value = user
+        with patch.object(LTI13RosterHandler, "write") as mock_write:
+            await roster_handler.post()
+
+    job_id = json.loads(mock_write.call_args[0][0])["job_id"]
+    job = await provisioning_queue.get(job_id)
+    assert job["kind"] == "provision_roster"
+    assert job["course_id"] == "intro101"
+    assert roster_handler.get_status() == 202
+
+
+@pytest.mark.asyncio
+async def test_roster_handler_rejects_memberships_urls_of_other_hosts(
+    make_mock_request_handler,
+):
+    """
+    Is a context_memberships_url of another host than the platform's rejected, so the
+    platform's access token is not sent to it?
+    """
+    user = Mock(
+        admin=True,
+        get_auth_state=AsyncMock(
+            return_value={
+                "course_id": "intro101",
+                "context_memberships_url": MEMBERSHIPS_URL,
+            }
+        ),
+    )
+    local_handler = make_mock_request_handler(LTI13RosterHandler)
+    local_handler.request.body = json.dumps(
+        {"context_memberships_url": "https://attacker.example.com/names_and_roles"}
+    ).encode()
+    roster_handler = LTI13RosterHandler(
+        local_handler.application, local_handler.request
+    )
+    with patch.object(
+        LTI13RosterHandler, "current_user", new_callable=PropertyMock
+    ) as mock_current_user:
+        mock_current_user.return_value = user
+        with patch(
+            "illumidesk.lti13.handlers.provision_course_roster"
+        ) as mock_provision_course_roster:
+            with pytest.raises(HTTPError) as e:
+                await roster_handler.post()
+
+    assert e.value.status_code == 400
+    assert not mock_provision_course_roster.called
+
+
+def test_get_platform_service_url_accepts_the_platform_hosts(lti13_config_environ):
+    """
+    Are the urls of the launch's host and of the token endpoint's host accepted?
+    """
+    auth_state = {"context_memberships_url": MEMBERSHIPS_URL}
+    other_course_url = "https://my.platform.domain/api/lti/courses/2/names_and_roles"
+
+    assert (
+        get_platform_service_url("context_memberships_url", {}, auth_state)
+        == MEMBERSHIPS_URL
+    )
+    assert (
+        get_platform_service_url(
+            "context_memberships_url",
+            {"context_memberships_url": other_course_url},
+            {},
+        )
+        == other_course_url
+    )